@@ -0,0 +1,383 @@
+"""Benchmarks for the conversion, read and write hot paths of geotag
+
+Generates synthetic JPEGs of several sizes, with and without existing
+Exif/Xmp geotags, and writes ops per second, p50/p99 latency and peak RSS
+of each benchmark as JSON. Startup benchmarks time a fresh interpreter
+importing geotag, and reading a first image with each backend. Server
+benchmarks time requests to a GeoTagServer on a Unix socket.
+
+Usage:
+    python bench_geotag.py [--sizes 100K,1M,10M,50M] [--repeat 20] [--output bench.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+import threading
+from PIL import Image
+
+import geotag
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_SIZES = '100K,1M,10M,50M'
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+# Geotags written by the benchmarks
+TAGS = (49.9120223, -98.2690366, 261.64)
+ATTITUDE = {'hdg': 45.2, 'roll': 123.1, 'pitch': 234.2, 'yaw': 103.23}
+
+
+# --------------------------------------------------
+# Image Functions
+# --------------------------------------------------
+
+
+def parse_size(size):
+    """Parse a size like 100K or 50M
+
+    Arguments:
+        size {str} -- Size, with an optional K, M or G suffix
+
+    Returns:
+        int -- Size in bytes
+    """
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def make_jpeg(path, size, tagged):
+    """Write a JPEG of about the given size filled with noise
+
+    Arguments:
+        path {str} -- Path to write to
+        size {int} -- Approximate file size in bytes
+        tagged {bool} -- Whether to add Exif and Xmp geotags
+    """
+    # Noise barely compresses, so the pixel count sets the file size
+    bytes_per_pixel = _noise_bytes_per_pixel()
+    pixels = max(64 * 64, int(size / bytes_per_pixel))
+    width = int(pixels ** 0.5)
+    height = max(1, pixels // width)
+
+    img = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    img.save(path, 'JPEG', quality=90)
+    img.close()
+
+    if tagged:
+        geotag.write_geo_tag_fast(path, *TAGS, **ATTITUDE)
+
+
+def _noise_bytes_per_pixel():
+    """Measure the compressed size of noise per pixel
+
+    Returns:
+        float -- Bytes per pixel
+    """
+    path = os.path.join(tempfile.gettempdir(), 'bench_geotag_probe.jpg')
+    img = Image.frombytes('RGB', (256, 256), os.urandom(256 * 256 * 3))
+    img.save(path, 'JPEG', quality=90)
+    img.close()
+    size = os.path.getsize(path)
+    os.unlink(path)
+    return size / (256 * 256)
+
+
+# --------------------------------------------------
+# Measurement Functions
+# --------------------------------------------------
+
+
+def measure(name, func, repeat, **info):
+    """Time repeated calls of a function
+
+    Arguments:
+        name {str} -- Benchmark name
+        func {callable} -- Function to time, called without arguments
+        repeat {int} -- Number of calls
+
+    Keyword Arguments:
+        info -- Extra fields for the result
+
+    Returns:
+        dict -- Benchmark result
+    """
+    result = dict(name=name, **info)
+    latencies = []
+    try:
+        func()  # warm up
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        result['error'] = repr(e)
+        return result
+
+    result.update(summarize(latencies))
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def summarize(latencies):
+    """Summarize latencies
+
+    Arguments:
+        latencies {list} -- Latency of each call, in seconds
+
+    Returns:
+        dict -- n, ops_per_sec, mean, p50 and p99 latency in milliseconds
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'n': len(ordered),
+        'ops_per_sec': len(ordered) / total if total > 0 else None,
+        'mean_ms': total / len(ordered) * 1e3,
+        'p50_ms': percentile(ordered, 50) * 1e3,
+        'p99_ms': percentile(ordered, 99) * 1e3,
+    }
+
+
+def percentile(ordered, p):
+    """Get a percentile of sorted values, interpolating between ranks
+
+    Arguments:
+        ordered {list} -- Sorted values
+        p {float} -- Percentile, between 0 and 100
+
+    Returns:
+        float -- Percentile value
+    """
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def peak_rss_kb():
+    """Get the peak resident set size of this process and its children
+
+    Returns:
+        int -- Peak RSS in KiB, or None if not available
+    """
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1  # macOS reports bytes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    return max(own, children)
+
+
+# --------------------------------------------------
+# Benchmarks
+# --------------------------------------------------
+
+
+def bench_conversions(repeat):
+    """Benchmark the coordinate conversion functions"""
+    dms = geotag.coord_dec_to_dms(TAGS[0])
+    results = [
+        measure('coord_dec_to_dms', lambda: geotag.coord_dec_to_dms(TAGS[0]), repeat),
+        measure('lat_dms_to_dec', lambda: geotag.lat_dms_to_dec(dms, 'N'), repeat),
+        measure('lon_dms_to_dec', lambda: geotag.lon_dms_to_dec(dms, 'W'), repeat),
+        measure('encode_segments', lambda: encode_segments(TAGS), repeat),
+    ]
+    if geotag.np is not None:
+        lats = geotag.np.linspace(-90, 90, 100000)
+        numerators, denominators, refs = geotag.lat_dec_to_dms_array(lats)
+        results.append(measure('lat_dec_to_dms_array', lambda: geotag.lat_dec_to_dms_array(lats),
+                               repeat, points=len(lats)))
+        results.append(measure('lat_dms_to_dec_array',
+                               lambda: geotag.lat_dms_to_dec_array(numerators, denominators, refs),
+                               repeat, points=len(lats)))
+    return results
+
+
+def encode_segments(tags):
+    """Encode geotags into the GPS IFD and Xmp packet of a new Exif/Xmp segment"""
+    exif, xmp = geotag._encode_geo_tags(*tags)
+    return geotag._new_exif(exif), geotag._new_attitude_xmp(xmp)
+
+
+def bench_startup(directory, repeat):
+    """Benchmark importing geotag, and a first read with each backend, in
+    fresh interpreters"""
+    path = os.path.join(directory, 'bench_startup.jpg')
+    make_jpeg(path, 1 << 10, True)
+    scripts = [('import_geotag', 'import geotag', {})]
+    for backend in ['pyexiv2', 'pillow', 'segment']:
+        scripts.append(('first_read', 'import geotag; geotag.read_geo_tag({!r}, backend={!r})'
+                        .format(path, backend), {'backend': backend}))
+
+    results = []
+    for (name, script, info) in scripts:
+        # The interpreter alone is timed too, so it can be subtracted
+        results.append(measure(name, lambda: run_python(script), repeat, **info))
+    results.append(measure('python_startup', lambda: run_python('pass'), repeat))
+    os.unlink(path)
+    return results
+
+
+def run_python(script):
+    """Run a script in a fresh interpreter, raising if it fails"""
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(
+        os.path.abspath(geotag.__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def bench_files(directory, sizes, repeat):
+    """Benchmark single image reads and writes"""
+    results = []
+    for size in sizes:
+        for tagged in [False, True]:
+            path = os.path.join(directory, 'bench_{}_{}.jpg'.format(size, int(tagged)))
+            make_jpeg(path, size, tagged)
+            info = {'size': os.path.getsize(path), 'tagged': tagged}
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            results.append(measure('read_geo_tag', lambda: geotag.read_geo_tag(path),
+                                   repeat, **info))
+            results.append(measure('read_geo_tag_fast', lambda: geotag.read_geo_tag_fast(path),
+                                   repeat, **info))
+            results.append(measure('read_geo_tag_buffer',
+                                   lambda: geotag.read_geo_tag_buffer(data), repeat, **info))
+
+            # Writes start from a fresh copy so every size is measured
+            # from the same starting point
+            copy = path + '.copy.jpg'
+            shutil.copy(path, copy)
+            results.append(measure('write_geo_tag',
+                                   lambda: geotag.write_geo_tag(copy, *TAGS, **ATTITUDE),
+                                   repeat, **info))
+            shutil.copy(path, copy)
+            results.append(measure('write_geo_tag_fast',
+                                   lambda: geotag.write_geo_tag_fast(copy, *TAGS, **ATTITUDE),
+                                   repeat, **info))
+            results.append(measure('write_geo_tag_buffer',
+                                   lambda: geotag.write_geo_tag_buffer(data, *TAGS, **ATTITUDE),
+                                   repeat, **info))
+            os.unlink(copy)
+            os.unlink(path)
+            del data
+    return results
+
+
+def bench_batches(directory, size, count, jobs, repeat):
+    """Benchmark batch reads and writes"""
+    template = os.path.join(directory, 'bench_batch.jpg')
+    make_jpeg(template, size, True)
+    paths = []
+    for i in range(count):
+        paths.append(os.path.join(directory, 'bench_batch_{}.jpg'.format(i)))
+        shutil.copy(template, paths[-1])
+    records = [(path,) + TAGS for path in paths]
+    info = {'size': os.path.getsize(template), 'images': count}
+
+    results = []
+    for n in sorted({1, jobs}):
+        results.append(measure('read_geo_tags_batch',
+                               lambda: check_batch(geotag.read_geo_tags_batch(paths, jobs=n)),
+                               repeat, jobs=n, **info))
+        results.append(measure('write_geo_tags_batch',
+                               lambda: check_batch(geotag.write_geo_tags_batch(records, jobs=n)),
+                               repeat, jobs=n, **info))
+
+    for path in paths + [template]:
+        os.unlink(path)
+    return results
+
+
+def bench_server(directory, size, jobs, repeat):
+    """Benchmark reads and writes through a GeoTagServer"""
+    path = os.path.join(directory, 'bench_server.jpg')
+    make_jpeg(path, size, True)
+    info = {'size': os.path.getsize(path)}
+    address = os.path.join(directory, 'bench.sock')
+
+    results = []
+    for n in sorted({1, jobs}):
+        with geotag.GeoTagServer(address, jobs=n) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            with geotag.GeoTagClient(address) as client:
+                results.append(measure('server_read', lambda: client.read(path),
+                                       repeat, jobs=n, **info))
+                results.append(measure('server_write',
+                                       lambda: client.write(path, *TAGS, **ATTITUDE),
+                                       repeat, jobs=n, **info))
+                results.append(measure('server_read_many',
+                                       lambda: check_batch(client.read_many([path] * 100)),
+                                       max(1, repeat // 10), jobs=n, images=100, **info))
+                stats = client.stats()
+            results[-1]['server'] = {key: stats[key] for key in
+                                     ['batches', 'mean_batch_size', 'max_queue_depth']}
+            server.close()
+            thread.join()
+    os.unlink(path)
+    return results
+
+
+def check_batch(results):
+    """Raise the first per image error of a batch, so failing batches are
+    reported instead of timed"""
+    for (_, _, error) in results:
+        if error is not None:
+            raise error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark geotag')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated image sizes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed calls per benchmark (default: %(default)s)')
+    parser.add_argument('--batch-images', type=int, default=64,
+                        help='images per batch benchmark (default: %(default)s)')
+    parser.add_argument('--batch-size', default='1M',
+                        help='image size for batch benchmarks (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='workers for batch benchmarks (default: %(default)s)')
+    parser.add_argument('--output', default='-',
+                        help='JSON output path, - for stdout (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    results = bench_conversions(args.repeat * 1000)
+    with tempfile.TemporaryDirectory() as directory:
+        results += bench_startup(directory, args.repeat)
+        results += bench_files(directory, sizes, args.repeat)
+        results += bench_batches(directory, parse_size(args.batch_size), args.batch_images,
+                                 args.jobs, max(1, args.repeat // 10))
+        results += bench_server(directory, parse_size(args.batch_size), args.jobs,
+                                args.repeat * 10)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,36 @@
-import pyexiv2
-from PIL import Image
+import os
+import re
+import sys
+import functools
+import time
+import json
+import weakref
+import threading
+import math
+import sqlite3
+import csv
+import bisect
+import heapq
+import mmap
+import shutil
+import struct
+import tempfile
+import array
+import queue
+import builtins
+import importlib.util
+import concurrent.futures
+import contextvars
 from fractions import Fraction
+from datetime import datetime, timezone
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+# pyexiv2, Pillow, numpy and the modules only used by some functions
+# (asyncio, socket, argparse) are imported on first use, see Backend
+# Functions, so importing geotag stays cheap
 
 # --------------------------------------------------
 # Conversion Functions
@@ -17,11 +47,8 @@ def coord_dec_to_dms(coord):
     Returns:
         (Fraction, Fraction, Fraction) -- coordinate in dms
     """
-    abs_coord = abs(_check_lon(coord))
-    d = int(abs_coord)
-    m = int((abs_coord - d) * 60)
-    s = (abs_coord - d - m/60.0) * 3600
-    return Fraction(d, 1), Fraction(m, 1), Fraction(int(s*1e7), int(1e7))
+    (d, _, m, _, s_num, s_den) = _coord_dms_rationals(coord)
+    return Fraction(d, 1), Fraction(m, 1), Fraction(s_num, s_den)
 
 
 def lat_dms_to_dec(lat, lat_ref):
@@ -56,6 +83,104 @@ def lon_dms_to_dec(lon, lon_ref):
     return round(_get_lon_sign(lon_ref) * dec, 7)
 
 
+def lat_dec_to_dms_array(lat):
+    """Convert an array of decimal latitudes to degrees, minutes, seconds.
+    Gives the same values as coord_dec_to_dms and _get_lat_ref.
+
+    Arguments:
+        lat {numpy.ndarray} -- latitudes in decimal degrees
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray) --
+        numerators and denominators of dms, each of shape (n, 3),
+        and latitude refs ('N' or 'S')
+
+    Raises:
+        ValueError -- if a latitude is out of range
+    """
+    lat = _as_float_array(lat)
+    if np.any(np.abs(lat) > 90):
+        raise ValueError('Lat out of range')
+    numerators, denominators = _coord_dec_to_dms_array(lat)
+    return numerators, denominators, np.where(lat >= 0, 'N', 'S')
+
+
+def lon_dec_to_dms_array(lon):
+    """Convert an array of decimal longitudes to degrees, minutes, seconds.
+    Gives the same values as coord_dec_to_dms and _get_lon_ref.
+
+    Arguments:
+        lon {numpy.ndarray} -- longitudes in decimal degrees
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray) --
+        numerators and denominators of dms, each of shape (n, 3),
+        and longitude refs ('E' or 'W')
+
+    Raises:
+        ValueError -- if a longitude is out of range
+    """
+    lon = _as_float_array(lon)
+    if np.any(np.abs(lon) > 180):
+        raise ValueError('Lon out of range')
+    numerators, denominators = _coord_dec_to_dms_array(lon)
+    return numerators, denominators, np.where(lon >= 0, 'E', 'W')
+
+
+def lat_dms_to_dec_array(numerators, denominators, lat_ref):
+    """Convert arrays of latitudes in degrees, minutes, seconds
+    to decimal degrees. Gives the same values as lat_dms_to_dec.
+
+    Arguments:
+        numerators {numpy.ndarray} -- numerators of dms, of shape (n, 3)
+        denominators {numpy.ndarray} -- denominators of dms, of shape (n, 3)
+        lat_ref {numpy.ndarray} -- latitude refs (i.e. 'N', 'S')
+
+    Returns:
+        numpy.ndarray -- latitudes in decimal degrees
+
+    Raises:
+        ImportError -- if numpy is not installed
+        ValueError -- if a latitude or ref is invalid
+    """
+    _require_numpy()
+    numerators = np.asarray(numerators, dtype=np.int64).reshape(-1, 3)
+    if np.any(np.abs(numerators[:, 0]) > 90):
+        raise ValueError('Lat out of range')
+    lat_ref = np.asarray(lat_ref)
+    if not np.all(np.isin(lat_ref, ['N', 'n', 'S', 's'])):
+        raise ValueError('Invalid lat ref')
+    sign = np.where((lat_ref == 'N') | (lat_ref == 'n'), 1, -1)
+    return _dms_to_dec_array(numerators, denominators, sign)
+
+
+def lon_dms_to_dec_array(numerators, denominators, lon_ref):
+    """Convert arrays of longitudes in degrees, minutes, seconds
+    to decimal degrees. Gives the same values as lon_dms_to_dec.
+
+    Arguments:
+        numerators {numpy.ndarray} -- numerators of dms, of shape (n, 3)
+        denominators {numpy.ndarray} -- denominators of dms, of shape (n, 3)
+        lon_ref {numpy.ndarray} -- longitude refs (i.e. 'E', 'W')
+
+    Returns:
+        numpy.ndarray -- longitudes in decimal degrees
+
+    Raises:
+        ImportError -- if numpy is not installed
+        ValueError -- if a longitude or ref is invalid
+    """
+    _require_numpy()
+    numerators = np.asarray(numerators, dtype=np.int64).reshape(-1, 3)
+    if np.any(np.abs(numerators[:, 0]) > 180):
+        raise ValueError('Lon out of range')
+    lon_ref = np.asarray(lon_ref)
+    if not np.all(np.isin(lon_ref, ['E', 'e', 'W', 'w'])):
+        raise ValueError('Invalid lon ref')
+    sign = np.where((lon_ref == 'E') | (lon_ref == 'e'), 1, -1)
+    return _dms_to_dec_array(numerators, denominators, sign)
+
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
@@ -78,6 +203,37 @@ def _check_lat(lat):
     return lat
 
 
+def _coord_dms_rationals(coord):
+    """Convert decimal lat/lon to degrees, minutes, seconds as the
+    integers of reduced rationals, without building Fractions
+
+    Arguments:
+        coord {float} -- coordinate in decimal degrees
+
+    Returns:
+        tuple -- numerator and denominator of degrees, minutes and seconds
+    """
+    abs_coord = abs(_check_lon(coord))
+    d = int(abs_coord)
+    m = int((abs_coord - d) * 60)
+    s = (abs_coord - d - m/60.0) * 3600
+    return (d, 1, m, 1) + _reduce_rational(int(s*1e7), int(1e7))
+
+
+def _reduce_rational(numerator, denominator):
+    """Reduce a rational the way Fraction does
+
+    Arguments:
+        numerator {int} -- Numerator
+        denominator {int} -- Denominator, positive
+
+    Returns:
+        (int, int) -- numerator and denominator in lowest terms
+    """
+    divisor = math.gcd(numerator, denominator)
+    return numerator // divisor, denominator // divisor
+
+
 def _get_lat_ref(lat):
     """Get reference of latitude
     
@@ -211,76 +367,402 @@ def _check_angle(angle):
     return angle
 
 
+def _as_float_array(coord):
+    """Convert coordinates to a 1d float64 array
+
+    Arguments:
+        coord {numpy.ndarray} -- coordinates in decimal degrees
+
+    Returns:
+        numpy.ndarray -- coordinates in decimal degrees
+
+    Raises:
+        ImportError -- if numpy is not installed
+        ValueError -- if a coordinate is not finite
+    """
+    _require_numpy()
+    coord = np.asarray(coord, dtype=np.float64).reshape(-1)
+    if not np.all(np.isfinite(coord)):
+        raise ValueError('Coordinate is not finite')
+    return coord
+
+
+def _numpy():
+    """Import numpy on first use, it is only needed by the array functions
+
+    Returns:
+        module -- numpy, or None if it is not installed
+    """
+    global np
+    try:
+        return np
+    except NameError:
+        pass
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    return np
+
+
+def _require_numpy():
+    """Import numpy for the array conversions
+
+    Raises:
+        ImportError -- if numpy is not installed
+    """
+    if _numpy() is None:
+        raise ImportError('numpy is required for array conversions')
+
+
+def __getattr__(name):
+    # geotag.np imports numpy on first use
+    if name == 'np':
+        return _numpy()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def _coord_dec_to_dms_array(coord):
+    """Vectorized coord_dec_to_dms, without range checks
+
+    Arguments:
+        coord {numpy.ndarray} -- coordinates in decimal degrees
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray) -- numerators and denominators of dms,
+                                          each of shape (n, 3)
+    """
+    # Same float operations as coord_dec_to_dms, so results are identical
+    abs_coord = np.abs(coord)
+    d = np.trunc(abs_coord)
+    m = np.trunc((abs_coord - d) * 60)
+    s = (abs_coord - d - m / 60.0) * 3600
+
+    # Fraction reduces seconds to lowest terms
+    s_num = np.trunc(s * 1e7).astype(np.int64)
+    s_den = np.full_like(s_num, int(1e7))
+    gcd = np.gcd(s_num, s_den)
+
+    numerators = np.stack([d.astype(np.int64), m.astype(np.int64), s_num // gcd], axis=1)
+    denominators = np.stack([np.ones_like(s_num), np.ones_like(s_num), s_den // gcd], axis=1)
+    return numerators, denominators
+
+
+def _dms_to_dec_array(numerators, denominators, sign):
+    """Vectorized dms to decimal conversion shared by lat_dms_to_dec_array
+    and lon_dms_to_dec_array, without range checks
+
+    Arguments:
+        numerators {numpy.ndarray} -- numerators of dms, of shape (n, 3)
+        denominators {numpy.ndarray} -- denominators of dms, of shape (n, 3)
+        sign {numpy.ndarray} -- 1 or -1 per coordinate
+
+    Returns:
+        numpy.ndarray -- coordinates in decimal degrees
+    """
+    denominators = np.asarray(denominators, dtype=np.int64).reshape(-1, 3)
+
+    # Like the scalar functions, only the numerators of d and m are used
+    dec = np.abs(numerators[:, 0]).astype(np.float64)
+    dec += numerators[:, 1] / 60.0
+    dec += numerators[:, 2] / denominators[:, 2] / 3600
+    return _round_array(sign * dec, 7)
+
+
+def _round_array(values, ndigits):
+    """Round an array the same way as round()
+
+    Arguments:
+        values {numpy.ndarray} -- values to round
+        ndigits {int} -- number of decimal digits
+
+    Returns:
+        numpy.ndarray -- rounded values
+    """
+    rounded = np.round(values, ndigits)
+
+    # np.round scales before rounding, which can pick the wrong side of a tie
+    # that round() resolves exactly. Redo values close to a tie with round()
+    scaled = values * 10.0 ** ndigits
+    tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(tie):
+        rounded[i] = round(float(values[i]), ndigits)
+    return rounded
+
+
 # --------------------------------------------------
 # Read/Write Functions
 # --------------------------------------------------
-# Register custom Attitude namespace to store roll, pitch, yaw
-pyexiv2.xmp.register_namespace('attitude/', 'Attitude')
+_GPS_TAGS = ['Exif.GPSInfo.GPSLatitude', 'Exif.GPSInfo.GPSLatitudeRef',
+             'Exif.GPSInfo.GPSLongitude', 'Exif.GPSInfo.GPSLongitudeRef',
+             'Exif.GPSInfo.GPSAltitude', 'Exif.GPSInfo.GPSAltitudeRef',
+             'Exif.GPSInfo.GPSImgDirection']
+_ATTITUDE_TAGS = ['Xmp.Attitude.Roll', 'Xmp.Attitude.Pitch', 'Xmp.Attitude.Yaw']
+
+# Tags each field of read_geo_tag is decoded from
+_FIELD_TAGS = {
+    'lat': ['Exif.GPSInfo.GPSLatitude', 'Exif.GPSInfo.GPSLatitudeRef'],
+    'lon': ['Exif.GPSInfo.GPSLongitude', 'Exif.GPSInfo.GPSLongitudeRef'],
+    'alt': ['Exif.GPSInfo.GPSAltitude', 'Exif.GPSInfo.GPSAltitudeRef'],
+    'hdg': ['Exif.GPSInfo.GPSImgDirection'],
+    'roll': ['Xmp.Attitude.Roll'],
+    'pitch': ['Xmp.Attitude.Pitch'],
+    'yaw': ['Xmp.Attitude.Yaw'],
+}
+
+
+class GeoTag:
+    """Geotags of an image, with the same fields as the dict returned by
+    read_geo_tag. Uses __slots__, so it is much smaller than the dict when
+    many are kept in memory. Missing fields are None.
+
+    Keyword Arguments:
+        lat {float} -- latitude, in decimal degrees (default: {None})
+        lon {float} -- longitude, in decimal degrees (default: {None})
+        alt {float} -- absolute altitude, in metres (default: {None})
+        hdg {float} -- Heading, in degrees (default: {None})
+        roll {float} -- Roll, in degrees (default: {None})
+        pitch {float} -- Pitch, in degrees (default: {None})
+        yaw {float} -- Yaw, in degrees (default: {None})
+    """
+
+    __slots__ = ('lat', 'lon', 'alt', 'hdg', 'roll', 'pitch', 'yaw')
+
+    def __init__(self, lat=None, lon=None, alt=None, hdg=None, roll=None, pitch=None, yaw=None):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.hdg = hdg
+        self.roll = roll
+        self.pitch = pitch
+        self.yaw = yaw
+
+    @classmethod
+    def from_dict(cls, tags):
+        """Create a record from a dict returned by read_geo_tag
+
+        Arguments:
+            tags {dict} -- Geotags
+
+        Returns:
+            GeoTag -- Record
+        """
+        return cls(**tags)
+
+    def to_dict(self):
+        """Get the geotags as the dict returned by read_geo_tag
+
+        Returns:
+            dict -- Geotags
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, GeoTag):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
 
+    def __repr__(self):
+        return 'GeoTag({})'.format(', '.join('{}={!r}'.format(field, getattr(self, field))
+                                             for field in self.__slots__))
 
-def write_geo_tag(img_path, lat, lon, alt_abs, hdg=None, roll=None, pitch=None, yaw=None):
+
+def write_geo_tag(img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None,
+                  skip_unchanged=False, sidecar=False, backend=None):
     """Writes geotags to an image
 
     Arguments:
         img_path {str} -- Path to image
-        lat {float} -- latitude, in decimal degrees
-        lon {float} -- longitude, in decimal degrees
-        alt_abs {float} -- absolute altitude, in metres
+        lat {float or GeoTag} -- latitude, in decimal degrees, or a GeoTag
+                                 holding every geotag, in which case the
+                                 other geotag arguments are not used
 
     Keyword Arguments:
+        lon {float} -- longitude, in decimal degrees (default: {None})
+        alt_abs {float} -- absolute altitude, in metres (default: {None})
         hdg {float} -- Heading, in degrees (default: {None})
         roll {float} -- Roll, in degrees (default: {None})
         pitch {float} -- Pitch, in degrees (default: {None})
         yaw {float} -- Yaw, in degrees (default: {None})
+        skip_unchanged {bool} -- Don't write the image if it already has
+                                 the same tag values, as they would be
+                                 encoded (default: {False})
+        sidecar {bool} -- Write the tags to the Xmp sidecar of the image
+                          (its path with a .xmp extension) and leave the
+                          image untouched (default: {False})
+        backend {str} -- Backend writing the image, 'pyexiv2', 'pillow'
+                         or 'segment' (default: {None}, see get_backend)
 
     Raises:
-        ValueError -- if image is not a JPEG or MPO
+        ValueError -- if image is not a JPEG or MPO, a geotag is missing,
+                      or the backend is unknown
+
+    Returns:
+        bool -- True if the image was written, False if it was skipped
     """
+    start = _stage_start()
+    exif, xmp = _encode_geo_tags(lat, lon, alt_abs, hdg, roll, pitch, yaw)
+    _stage_end('write_geo_tag.encode', start)
+
+    if sidecar:
+        written = _write_sidecar(img_path, exif, xmp, skip_unchanged)
+    else:
+        written = _get_backend(backend).write(img_path, exif, xmp, skip_unchanged)
+    if written:
+        _invalidate_caches(img_path)
+    return written
+
+
+def write_geo_tag_fast(img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None,
+                       frames=None, buffer_size=None):
+    """Writes geotags to an image without pyexiv2, by rebuilding only the
+    Exif and Xmp APP1 segments.
+
+    If the new segments fit in the space of the old ones, the file is
+    patched in place. Otherwise the image data around the segments is
+    copied unchanged to a new file, which replaces the image. Memory use
+    doesn't depend on the size of the image: only the segments before the
+    start of scan are read, and image data is copied in the kernel where
+    possible, else through a buffer of buffer_size bytes.
+
+    The frames of an MPO are found from the MP Index of the first frame,
+    so only their segments are read, and the MP Index is updated if the
+    frames move.
+
+    Arguments:
+        img_path {str} -- Path to image
+        lat {float or GeoTag} -- latitude, in decimal degrees, or a GeoTag
+                                 holding every geotag, in which case the
+                                 other geotag arguments are not used
+
+    Keyword Arguments:
+        lon {float} -- longitude, in decimal degrees (default: {None})
+        alt_abs {float} -- absolute altitude, in metres (default: {None})
+        hdg {float} -- Heading, in degrees (default: {None})
+        roll {float} -- Roll, in degrees (default: {None})
+        pitch {float} -- Pitch, in degrees (default: {None})
+        yaw {float} -- Yaw, in degrees (default: {None})
+        frames {str or iterable} -- Indices of the MPO frames to tag, or
+                                    'all' (default: {None}, first frame)
+        buffer_size {int} -- Size of the buffer image data is copied
+                             through, in bytes (default: {None}, 1 MiB)
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, a geotag is missing,
+                      a frame doesn't exist, or the new metadata does not
+                      fit in an APP1 segment
+
+    Returns:
+        bool -- True if the file was patched in place
+    """
+    exif, xmp = _encode_geo_tags(lat, lon, alt_abs, hdg, roll, pitch, yaw)
+    (in_place, _) = _write_segments(img_path, exif, xmp, frames, buffer_size)
+    _invalidate_caches(img_path)
+    return in_place
 
-    # Only JPEG and MPO have metadata
-    img = Image.open(img_path)
-    if not (img.format == 'JPEG' or img.format == "MPO"):
-        raise ValueError('Image is not a JPEG or MPO')
-    img.close()
 
-    metadata = pyexiv2.ImageMetadata(img_path)
-    metadata.read()
+def _encode_geo_tags(lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None):
+    """Check geotags and convert them to the tag values written to an image
+
+    Arguments:
+        lat {float or GeoTag} -- latitude, in decimal degrees, or a GeoTag
+                                 holding every geotag, in which case the
+                                 other geotag arguments are not used
+
+    Keyword Arguments:
+        lon {float} -- longitude, in decimal degrees (default: {None})
+        alt_abs {float} -- absolute altitude, in metres (default: {None})
+        hdg {float} -- Heading, in degrees (default: {None})
+        roll {float} -- Roll, in degrees (default: {None})
+        pitch {float} -- Pitch, in degrees (default: {None})
+        yaw {float} -- Yaw, in degrees (default: {None})
 
-    # Add standard Exif Tags
-    tags = ['Exif.GPSInfo.GPSLatitude', 'Exif.GPSInfo.GPSLatitudeRef',
-            'Exif.GPSInfo.GPSLongitude', 'Exif.GPSInfo.GPSLongitudeRef',
-            'Exif.GPSInfo.GPSAltitude', 'Exif.GPSInfo.GPSAltitudeRef']
-    values = [coord_dec_to_dms(lat), _get_lat_ref(lat), coord_dec_to_dms(lon),
-              _get_lon_ref(lon), Fraction(int(alt_abs*1e7), int(1e7)),
-              _get_alt_ref(alt_abs)]
+    Raises:
+        ValueError -- if lat, lon or alt_abs is missing
 
-    for (tag, value) in zip(tags, values):
-        metadata[tag] = pyexiv2.ExifTag(tag, value)
+    Returns:
+        (_GPSValues, dict) -- Exif GPS tag values and Xmp attitude tag
+                              values, keyed by pyexiv2 key
+    """
+    if isinstance(lat, GeoTag):
+        (lat, lon, alt_abs, hdg, roll, pitch, yaw) = (lat.lat, lat.lon, lat.alt, lat.hdg,
+                                                     lat.roll, lat.pitch, lat.yaw)
+    if lat is None or lon is None or alt_abs is None:
+        raise ValueError('Missing latitude, longitude or altitude')
 
+    # Standard Exif tags, kept as integers and filled into a precompiled
+    # GPS IFD by the segment writers
+    rationals = _coord_dms_rationals(lat)
+    lat_ref = _get_lat_ref(lat)
+    rationals += _coord_dms_rationals(lon)
+    lon_ref = _get_lon_ref(lon)
+    # Rationals are unsigned, the altitude ref carries the sign
+    rationals += _reduce_rational(int(abs(alt_abs)*1e7), int(1e7))
     if hdg is not None:
-        tag = 'Exif.GPSInfo.GPSImgDirection'
-        metadata[tag] = pyexiv2.ExifTag(tag, Fraction(int(_check_angle(hdg) * 100), 100))
+        rationals += _reduce_rational(int(_check_angle(hdg) * 100), 100)
+    exif = _GPSValues(lat_ref, lon_ref, _get_alt_ref(alt_abs), rationals)
 
     # Add roll, pitch, yaw as custom Xmp tags
-    tags = ['Xmp.Attitude.Roll', 'Xmp.Attitude.Pitch', 'Xmp.Attitude.Yaw']
-    values = [roll, pitch, yaw]
-    attitudes = [roll, pitch, yaw]
+    xmp = {}
+    for (tag, value) in zip(_ATTITUDE_TAGS, [roll, pitch, yaw]):
+        if value is not None:
+            xmp[tag] = str(_check_angle(value))
+
+    return exif, xmp
+
+
+def _geo_tags_unchanged(exif, xmp, current_exif, current_xmp):
+    """Check if an image already has the tag values that would be written
+
+    Arguments:
+        exif {dict} -- Exif GPS tag values, as returned by _encode_geo_tags
+        xmp {dict} -- Xmp attitude tag values, as returned by _encode_geo_tags
+        current_exif {dict} -- Exif GPS tag values of the image, as read by
+                               pyexiv2 or _parse_gps_ifd
+        current_xmp {dict} -- Xmp attitude tag values of the image
 
-    for (attitude, tag, value) in zip(attitudes, tags, values):
-        if attitude is not None:
-            metadata[tag] = pyexiv2.XmpTag(tag, str(_check_angle(value)))
+    Returns:
+        bool -- True if every tag is present with the same value
+    """
+    for (tag, value) in exif.items():
+        # pyexiv2 reads rationals back as lists and bytes as strings
+        if isinstance(value, tuple):
+            value = list(value)
+        elif isinstance(value, bytes):
+            value = value.decode('ascii')
+        if current_exif.get(tag) != value:
+            return False
 
-    metadata.write()
+    for (tag, value) in xmp.items():
+        try:
+            if float(current_xmp[tag]) != float(value):
+                return False
+        except (KeyError, ValueError):
+            return False
+    return True
 
 
-def read_geo_tag(img_path):
+def read_geo_tag(img_path, as_record=False, sidecar=False, fields=None, backend=None):
     """Reads geotags to an image
 
     Arguments:
         img_path {str} -- Path to image
 
+    Keyword Arguments:
+        as_record {bool} -- Return a GeoTag instead of a dict (default: {False})
+        sidecar {bool} -- Merge in the tags of the Xmp sidecar of the image.
+                          Sidecar values take precedence, field by field,
+                          over the ones in the image (default: {False})
+        fields {iterable} -- Fields to read, e.g. ['lat', 'lon']. Tags of
+                             other fields are not decoded, and the Xmp
+                             packet is not parsed unless roll, pitch or yaw
+                             is wanted (default: {None}, all fields)
+        backend {str} -- Backend reading the image, 'pyexiv2', 'pillow'
+                         or 'segment' (default: {None}, see get_backend)
+
     Raises:
-        ValueError -- if image is not a JPEG or MPO
+        ValueError -- if image is not a JPEG or MPO, or a field or the
+                      backend is unknown
 
     Returns:
         dict --
@@ -291,53 +773,257 @@ def read_geo_tag(img_path):
         roll -- Roll, in degrees
         pitch -- Pitch, in degrees
         yaw -- Yaw, in degrees
+        with only the wanted fields if fields is given
+        or GeoTag -- if as_record, with the same fields
     """
-    # Only JPEG and MPO have metadata
-    img = Image.open(img_path)
-    if not (img.format == 'JPEG' or img.format == "MPO"):
-        raise ValueError('Image is not a JPEG or MPO')
-    img.close()
+    exif_tags, xmp_tags, fields = _field_tags(fields)
+    exif, xmp = _get_backend(backend).read(img_path, exif_tags, xmp_tags)
+
+    start = _stage_start()
+    tags = _select_fields(_decode_geo_tags(exif, xmp), fields)
+    start = _stage_end('read_geo_tag.decode', start)
+
+    if sidecar:
+        tags = _merge_geo_tags(tags, _read_sidecar(img_path))
+        _stage_end('read_geo_tag.sidecar', start)
+    return GeoTag(**tags) if as_record else tags
+
+
+def read_geo_tag_fast(img_path, as_record=False, sidecar=False, fields=None):
+    """Reads geotags from an image without pyexiv2, by parsing only the
+    Exif and Xmp APP1 segments in front of the image data
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Keyword Arguments:
+        as_record {bool} -- Return a GeoTag instead of a dict (default: {False})
+        sidecar {bool} -- Merge in the tags of the Xmp sidecar of the image,
+                          see read_geo_tag (default: {False})
+        fields {iterable} -- Fields to read, see read_geo_tag. The Xmp
+                             segment is not read unless roll, pitch or yaw
+                             is wanted (default: {None}, all fields)
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, or a field is unknown
+
+    Returns:
+        dict or GeoTag -- Same as read_geo_tag
+    """
+    with open(img_path, 'rb') as f:
+        tags = _read_segment_geo_tags(f, fields)
+    if sidecar:
+        tags = _merge_geo_tags(tags, _read_sidecar(img_path))
+    return GeoTag(**tags) if as_record else tags
+
+
+def read_geo_tag_buffer(data, as_record=False, fields=None):
+    """Reads geotags from an image in memory, without pyexiv2 or a
+    temporary file. Only the Exif and Xmp segments are parsed.
+
+    Arguments:
+        data {bytes, memoryview or file} -- Image data, or a binary file
+                                            object read from its start
 
-    metadata = pyexiv2.ImageMetadata(img_path)
-    metadata.read()
+    Keyword Arguments:
+        as_record {bool} -- Return a GeoTag instead of a dict (default: {False})
+        fields {iterable} -- Fields to read, see read_geo_tag_fast
+                             (default: {None}, all fields)
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, or a field is unknown
+
+    Returns:
+        dict or GeoTag -- Same as read_geo_tag
+    """
+    tags = _read_segment_geo_tags(_buffer_file(data), fields)
+    return GeoTag(**tags) if as_record else tags
+
+
+def _read_segment_geo_tags(f, fields=None):
+    """Read geotags by parsing the Exif and Xmp APP1 segments of a JPEG
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+
+    Keyword Arguments:
+        fields {iterable} -- Fields to read (default: {None}, all fields)
+
+    Returns:
+        dict -- Same as read_geo_tag
+    """
+    exif_tags, xmp_tags, fields = _field_tags(fields)
+    exif, xmp = _read_segment_tags(f, exif_tags, xmp_tags)
+    return _select_fields(_decode_geo_tags(exif, xmp), fields)
+
+
+def _read_segment_tags(f, exif_tags, xmp_tags):
+    """Read raw tag values from the Exif and Xmp APP1 segments of a JPEG
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+        exif_tags {list} -- Exif keys to read
+        xmp_tags {list} -- Xmp keys to read, the Xmp segment is not read
+                           if empty
+
+    Returns:
+        (dict, dict) -- Exif and Xmp tag values keyed by pyexiv2 key
+    """
+    exif_payload, xmp_payload = _read_app1_segments(f, read_xmp=bool(xmp_tags))
+
+    exif = {}
+    if exif_payload is not None and exif_tags:
+        gps = _parse_gps_ifd(exif_payload)
+        exif = {tag: gps[tag] for tag in exif_tags if tag in gps}
+    xmp = {}
+    if xmp_payload is not None:
+        attitude = _parse_attitude_xmp(xmp_payload)
+        xmp = {tag: attitude[tag] for tag in xmp_tags if tag in attitude}
+    return exif, xmp
+
+
+def _field_tags(fields):
+    """Get the tags the given fields of read_geo_tag are decoded from
+
+    Arguments:
+        fields {iterable} -- Fields, or None for all fields
+
+    Raises:
+        ValueError -- if a field is unknown
+
+    Returns:
+        (list, list, tuple) -- Exif keys, Xmp keys and the fields
+    """
+    if fields is None:
+        return _GPS_TAGS, _ATTITUDE_TAGS, GeoTag.__slots__
+    if isinstance(fields, str):
+        fields = [fields]
+    fields = tuple(fields)
+    for field in fields:
+        if field not in _FIELD_TAGS:
+            raise ValueError('Unknown field {!r}'.format(field))
+    tags = {tag for field in fields for tag in _FIELD_TAGS[field]}
+    return ([tag for tag in _GPS_TAGS if tag in tags],
+            [tag for tag in _ATTITUDE_TAGS if tag in tags], fields)
 
+
+def _select_fields(tags, fields):
+    """Keep only the given fields of decoded geotags
+
+    Arguments:
+        tags {dict} -- Geotags, as returned by _decode_geo_tags
+        fields {tuple} -- Fields to keep
+
+    Returns:
+        dict -- Geotags with only the given fields
+    """
+    if fields is GeoTag.__slots__:
+        return tags
+    return {field: tags[field] for field in fields}
+
+
+def write_geo_tag_buffer(data, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None):
+    """Writes geotags to an image in memory, without pyexiv2 or a
+    temporary file. Only the Exif and Xmp segments are rebuilt, the rest
+    of the image is copied once into the result.
+
+    Arguments:
+        data {bytes, memoryview or file} -- Image data, or a binary file
+                                            object read from its start
+        lat {float or GeoTag} -- latitude, in decimal degrees, or a GeoTag
+                                 holding every geotag, in which case the
+                                 other geotag arguments are not used
+
+    Keyword Arguments:
+        lon {float} -- longitude, in decimal degrees (default: {None})
+        alt_abs {float} -- absolute altitude, in metres (default: {None})
+        hdg {float} -- Heading, in degrees (default: {None})
+        roll {float} -- Roll, in degrees (default: {None})
+        pitch {float} -- Pitch, in degrees (default: {None})
+        yaw {float} -- Yaw, in degrees (default: {None})
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, a geotag is missing,
+                      or the new metadata does not fit in an APP1 segment
+
+    Returns:
+        bytes or bytearray -- Retagged image, a bytearray if data is a
+                              seekable file, which is read straight into it
+    """
+    exif, xmp = _encode_geo_tags(lat, lon, alt_abs, hdg, roll, pitch, yaw)
+    f = _buffer_file(data)
+    edits, _ = _plan_app1_edits(f, exif, xmp)
+
+    if isinstance(f, _BufferFile):
+        # Slices of the buffer are views, so joining them is the only copy
+        pieces = []
+        position = 0
+        for (offset, length, segment) in edits:
+            pieces.append(_read_range(f, position, offset))
+            pieces.append(segment)
+            position = offset + length
+        pieces.append(_read_range(f, position, None))
+        return b''.join(pieces)
+
+    # Reading the pieces and joining them would copy the image twice, so
+    # the result is allocated once and the file read straight into it
+    size = f.seek(0, 2)
+    result = bytearray(size + sum(len(segment) - length for (_, length, segment) in edits))
+    view = memoryview(result)
+    position = out = 0
+    for (offset, length, segment) in edits + [(size, 0, b'')]:
+        _read_into(f, position, view[out:out + offset - position])
+        out += offset - position
+        view[out:out + len(segment)] = segment
+        out += len(segment)
+        position = offset + length
+    return result
+
+
+def _decode_geo_tags(exif, xmp):
+    """Convert raw tag values to the dict returned by read_geo_tag
+
+    Arguments:
+        exif {dict} -- Exif GPS tag values keyed by pyexiv2 key
+        xmp {dict} -- Xmp attitude tag values keyed by pyexiv2 key
+
+    Returns:
+        dict -- Same as read_geo_tag
+    """
     lat = lon = alt = hdg = roll = pitch = yaw = None
 
     # Extract exif tags
     tag = 'Exif.GPSInfo.GPSLatitude'
     tag_ref = 'Exif.GPSInfo.GPSLatitudeRef'
-    if tag in metadata.exif_keys and tag_ref in metadata.exif_keys:
-        lat_ref = metadata[tag_ref].value
-        lat = lat_dms_to_dec(metadata[tag].value, lat_ref)
+    if tag in exif and tag_ref in exif:
+        lat = lat_dms_to_dec(exif[tag], exif[tag_ref])
 
     tag = 'Exif.GPSInfo.GPSLongitude'
     tag_ref = 'Exif.GPSInfo.GPSLongitudeRef'
-    if tag in metadata.exif_keys and tag_ref in metadata.exif_keys:
-        lon_ref = metadata[tag_ref].value
-        lon = lon_dms_to_dec(metadata[tag].value, lon_ref)
+    if tag in exif and tag_ref in exif:
+        lon = lon_dms_to_dec(exif[tag], exif[tag_ref])
 
     tag = 'Exif.GPSInfo.GPSAltitude'
     tag_ref = 'Exif.GPSInfo.GPSAltitudeRef'
-    if tag in metadata.exif_keys and tag_ref in metadata.exif_keys:
-        alt_sign = _get_alt_sign(metadata[tag_ref].value)
-        alt = alt_sign * round(metadata[tag].value.numerator
-                               / metadata[tag].value.denominator, 7)
+    if tag in exif and tag_ref in exif:
+        alt_sign = _get_alt_sign(exif[tag_ref])
+        alt = alt_sign * round(exif[tag].numerator / exif[tag].denominator, 7)
 
     tag = 'Exif.GPSInfo.GPSImgDirection'
-    if tag in metadata.exif_keys:
-        hdg = round(metadata[tag].value.numerator / metadata[tag].value.denominator, 2)
+    if tag in exif:
+        hdg = round(exif[tag].numerator / exif[tag].denominator, 2)
 
     # Extract our custom xmp tags
-    tags = ['Xmp.Attitude.Roll', 'Xmp.Attitude.Pitch', 'Xmp.Attitude.Yaw']
+    tags = _ATTITUDE_TAGS
 
-    if tags[0] in metadata.xmp_keys:
-        roll = float(metadata[tags[0]].value)
+    if tags[0] in xmp:
+        roll = float(xmp[tags[0]])
 
-    if tags[1] in metadata.xmp_keys:
-        pitch = float(metadata[tags[1]].value)
+    if tags[1] in xmp:
+        pitch = float(xmp[tags[1]])
 
-    if tags[2] in metadata.xmp_keys:
-        yaw = float(metadata[tags[2]].value)
+    if tags[2] in xmp:
+        yaw = float(xmp[tags[2]])
 
     return {
         'lat': lat,
@@ -348,3 +1034,4844 @@ def read_geo_tag(img_path):
         'pitch': pitch,
         'yaw': yaw,
     }
+
+
+# --------------------------------------------------
+# Backend Functions
+# --------------------------------------------------
+# Environment variable naming the default backend
+_BACKEND_ENV = 'GEOTAG_BACKEND'
+
+# Default backend, chosen on first use by get_backend
+_backend = None
+
+# pyexiv2 module once imported, with the Attitude namespace registered
+_pyexiv2 = None
+_pyexiv2_lock = threading.Lock()
+
+
+def set_backend(name):
+    """Set the backend read_geo_tag and write_geo_tag use by default.
+    It is also set in the environment, so worker processes started
+    afterwards use it too.
+
+    Arguments:
+        name {str} -- 'pyexiv2', 'pillow' or 'segment'
+
+    Raises:
+        ValueError -- if the backend is unknown
+    """
+    global _backend
+    _get_backend(name)
+    _backend = os.environ[_BACKEND_ENV] = name
+
+
+def get_backend():
+    """Get the backend read_geo_tag and write_geo_tag use by default.
+    Unless set with set_backend, it is the GEOTAG_BACKEND environment
+    variable, or pyexiv2 if it is installed, or else segment.
+
+    Backends are only imported once an image is read or written with them:
+    pyexiv2 -- exiv2, reads and writes every kind of metadata
+    pillow -- Pillow only. Writes rebuild the APP1 segments, like segment,
+              as Pillow can't write metadata without re-encoding the image
+    segment -- pure python, parses and rebuilds only the Exif and Xmp
+               APP1 segments, see read_geo_tag_fast and write_geo_tag_fast
+
+    Raises:
+        ValueError -- if GEOTAG_BACKEND is not a backend
+
+    Returns:
+        str -- Backend name
+    """
+    global _backend
+    if _backend is None:
+        name = os.environ.get(_BACKEND_ENV)
+        if not name:
+            name = 'pyexiv2' if importlib.util.find_spec('pyexiv2') is not None else 'segment'
+        _get_backend(name)
+        _backend = name
+    return _backend
+
+
+def _get_backend(name=None):
+    """Get a backend by name
+
+    Keyword Arguments:
+        name {str} -- Backend name (default: {None}, see get_backend)
+
+    Raises:
+        ValueError -- if the backend is unknown
+
+    Returns:
+        object -- Backend, with read and write methods
+    """
+    if name is None:
+        name = get_backend()
+    try:
+        return _BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown backend {!r}'.format(name)) from None
+
+
+def _load_pyexiv2():
+    """Import pyexiv2 on first use, registering the custom Attitude
+    namespace used to store roll, pitch, yaw
+
+    Returns:
+        module -- pyexiv2
+    """
+    global _pyexiv2
+    if _pyexiv2 is None:
+        with _pyexiv2_lock:
+            if _pyexiv2 is None:
+                import pyexiv2
+                pyexiv2.xmp.register_namespace(_ATTITUDE_NS, 'Attitude')
+                _pyexiv2 = pyexiv2
+    return _pyexiv2
+
+
+def _load_pil():
+    """Import Pillow on first use
+
+    Returns:
+        module -- PIL.Image
+    """
+    from PIL import Image
+    return Image
+
+
+def _check_image_format(img_path):
+    """Check that an image is a JPEG or MPO, as only they have metadata.
+    Only the segments before the start of scan are read.
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO
+
+    Returns:
+        str -- 'JPEG' or 'MPO'
+    """
+    with open(img_path, 'rb') as f:
+        return _image_format(f)
+
+
+class _SegmentBackend:
+    """Reads and writes tags by parsing and rebuilding only the Exif and
+    Xmp APP1 segments, without pyexiv2 or Pillow
+
+    Backends read raw tag values, keyed by pyexiv2 key and of the types
+    pyexiv2 returns, which read_geo_tag decodes. They write the values
+    returned by _encode_geo_tags.
+    """
+
+    def load(self):
+        """Import the modules the backend needs"""
+
+    def read(self, img_path, exif_tags, xmp_tags):
+        """Read raw tag values of an image
+
+        Arguments:
+            img_path {str} -- Path to image
+            exif_tags {list} -- Exif keys to read
+            xmp_tags {list} -- Xmp keys to read
+
+        Raises:
+            ValueError -- if image is not a JPEG or MPO
+
+        Returns:
+            (dict, dict) -- Exif and Xmp tag values keyed by pyexiv2 key
+        """
+        start = _stage_start()
+        with open(img_path, 'rb') as f:
+            f = _counting(f, start)
+            exif, xmp = _read_segment_tags(f, exif_tags, xmp_tags)
+        _stage_end('read_geo_tag.metadata_read', start, _bytes_read(f))
+        return exif, xmp
+
+    def write(self, img_path, exif, xmp, skip_unchanged=False):
+        """Write raw tag values to an image
+
+        Arguments:
+            img_path {str} -- Path to image
+            exif {dict} -- Exif GPS tag values, as returned by _encode_geo_tags
+            xmp {dict} -- Xmp attitude tag values, as returned by _encode_geo_tags
+
+        Keyword Arguments:
+            skip_unchanged {bool} -- Don't write the image if it already
+                                     has the same tag values (default: {False})
+
+        Raises:
+            ValueError -- if image is not a JPEG or MPO
+
+        Returns:
+            bool -- True if the image was written, False if it was skipped
+        """
+        start = _stage_start()
+        if skip_unchanged:
+            with open(img_path, 'rb') as f:
+                f = _counting(f, start)
+                current_exif, current_xmp = _read_segment_tags(f, list(exif), list(xmp))
+            unchanged = _geo_tags_unchanged(exif, xmp, current_exif, current_xmp)
+            start = _stage_end('write_geo_tag.compare', start, _bytes_read(f))
+            if unchanged:
+                return False
+
+        (_, nbytes) = _write_segments(img_path, exif, xmp)
+        _stage_end('write_geo_tag.metadata_write', start, nbytes)
+        return True
+
+
+class _PillowBackend(_SegmentBackend):
+    """Reads tags with Pillow. Writes are the same as _SegmentBackend, as
+    Pillow can't write metadata without re-encoding the image"""
+
+    def load(self):
+        _load_pil()
+
+    def read(self, img_path, exif_tags, xmp_tags):
+        start = _stage_start()
+        with open(img_path, 'rb') as f:
+            f = _counting(f, start)
+            with _load_pil().open(f) as img:
+                if not (img.format == 'JPEG' or img.format == "MPO"):
+                    raise ValueError('Image is not a JPEG or MPO')
+                opened = _bytes_read(f)
+                start = _stage_end('read_geo_tag.image_open', start, opened)
+                gps = img.getexif().get_ifd(_GPS_IFD_POINTER) if exif_tags else {}
+                packet = img.info.get('xmp') if xmp_tags else None
+        start = _stage_end('read_geo_tag.metadata_read', start, _bytes_read(f) - opened)
+
+        exif = {}
+        for (tag_id, value) in gps.items():
+            key = _GPS_TAG_IDS.get(tag_id)
+            if key in exif_tags:
+                value = _pil_exif_value(value)
+                if value is not None:
+                    exif[key] = value
+        xmp = {}
+        if packet:
+            attitude = _parse_attitude_xmp(packet)
+            xmp = {tag: attitude[tag] for tag in xmp_tags if tag in attitude}
+        _stage_end('read_geo_tag.get_tags', start)
+        return exif, xmp
+
+
+class _Pyexiv2Backend:
+    """Reads and writes tags with pyexiv2"""
+
+    def load(self):
+        _load_pyexiv2()
+
+    def read(self, img_path, exif_tags, xmp_tags):
+        pyexiv2 = _load_pyexiv2()
+        start = _stage_start()
+        _check_image_format(img_path)
+        start = _stage_end('read_geo_tag.image_open', start)
+
+        metadata = pyexiv2.ImageMetadata(img_path)
+        metadata.read()
+        # exiv2 does its own I/O, so the most it could have read is recorded
+        start = _stage_end('read_geo_tag.metadata_read', start, _file_size(img_path, start))
+
+        exif = {tag: metadata[tag].value for tag in exif_tags if tag in metadata.exif_keys}
+        # pyexiv2 only parses the Xmp packet once xmp_keys is used
+        xmp = {}
+        if xmp_tags:
+            xmp = {tag: metadata[tag].value for tag in xmp_tags if tag in metadata.xmp_keys}
+        _stage_end('read_geo_tag.get_tags', start)
+        return exif, xmp
+
+    def write(self, img_path, exif, xmp, skip_unchanged=False):
+        pyexiv2 = _load_pyexiv2()
+        start = _stage_start()
+        _check_image_format(img_path)
+        start = _stage_end('write_geo_tag.image_open', start)
+
+        metadata = pyexiv2.ImageMetadata(img_path)
+        metadata.read()
+        start = _stage_end('write_geo_tag.metadata_read', start, _file_size(img_path, start))
+
+        if skip_unchanged:
+            current_exif = {tag: metadata[tag].value for tag in exif if tag in metadata.exif_keys}
+            current_xmp = {tag: metadata[tag].value for tag in xmp if tag in metadata.xmp_keys}
+            unchanged = _geo_tags_unchanged(exif, xmp, current_exif, current_xmp)
+            start = _stage_end('write_geo_tag.compare', start)
+            if unchanged:
+                return False
+
+        for (tag, value) in exif.items():
+            metadata[tag] = pyexiv2.ExifTag(tag, value)
+        for (tag, value) in xmp.items():
+            metadata[tag] = pyexiv2.XmpTag(tag, value)
+        start = _stage_end('write_geo_tag.set_tags', start)
+
+        metadata.write()
+        # exiv2 rewrites the whole file
+        _stage_end('write_geo_tag.metadata_write', start, _file_size(img_path, start))
+        return True
+
+
+_BACKENDS = {
+    'pyexiv2': _Pyexiv2Backend(),
+    'pillow': _PillowBackend(),
+    'segment': _SegmentBackend(),
+}
+
+
+def _pil_exif_value(value):
+    """Convert an Exif value read by Pillow to the type pyexiv2 returns
+
+    Arguments:
+        value -- Pillow value: IFDRational, tuple of them, str, bytes or int
+
+    Returns:
+        Fraction, list, str or None -- pyexiv2 value, None if it can't be
+                                       converted
+    """
+    if isinstance(value, tuple):
+        values = [_pil_exif_value(v) for v in value]
+        if any(v is None for v in values):
+            return None
+        return values if len(values) > 1 else values[0]
+    if isinstance(value, str):
+        return value.split('\x00', 1)[0]
+    if isinstance(value, bytes):
+        # pyexiv2 reports bytes as their decimal string
+        return ' '.join(str(b) for b in value)
+    if isinstance(value, int):
+        return str(value)
+    try:
+        return Fraction(value.numerator, value.denominator)
+    except (AttributeError, TypeError, ZeroDivisionError):
+        return None
+
+
+# --------------------------------------------------
+# JPEG Segment Functions
+# --------------------------------------------------
+_EXIF_HEADER = b'Exif\x00\x00'
+_XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+_ATTITUDE_NS = 'attitude/'
+_RDF_DESCRIPTION = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description'
+
+# Exif GPS IFD tag ids, and the pyexiv2 keys they are reported under
+_GPS_IFD_POINTER = 0x8825
+_GPS_TAG_IDS = {
+    0x01: 'Exif.GPSInfo.GPSLatitudeRef',
+    0x02: 'Exif.GPSInfo.GPSLatitude',
+    0x03: 'Exif.GPSInfo.GPSLongitudeRef',
+    0x04: 'Exif.GPSInfo.GPSLongitude',
+    0x05: 'Exif.GPSInfo.GPSAltitudeRef',
+    0x06: 'Exif.GPSInfo.GPSAltitude',
+    0x11: 'Exif.GPSInfo.GPSImgDirection',
+}
+_GPS_TAG_KEYS = {key: tag_id for (tag_id, key) in _GPS_TAG_IDS.items()}
+
+# Tags pointing to other IFDs, and to the Exif thumbnail
+_EXIF_IFD_POINTER = 0x8769
+_INTEROP_IFD_POINTER = 0xA005
+_THUMBNAIL_OFFSET = 0x0201
+_THUMBNAIL_LENGTH = 0x0202
+
+# Exif IFD tag ids of the capture time
+_DATE_TIME_ORIGINAL = 0x9003
+_SUB_SEC_TIME_ORIGINAL = 0x9291
+
+# Largest payload an APP1 segment can hold
+_MAX_APP1_PAYLOAD = 0xFFFF - 2
+
+# Buffer size used when copying image data without sendfile
+_COPY_BUFFER_SIZE = 1 << 20
+
+# Identifier of the APP2 segment holding the MP Index of an MPO, and the
+# tag of its MP Entry list (CIPA DC-007)
+_MPF_HEADER = b'MPF\x00'
+_MP_ENTRY = 0xB002
+
+# TIFF header and IFD0 of new Exif segments, which hold only a pointer to
+# the GPS IFD that follows them
+_NEW_EXIF_GPS_OFFSET = 8 + 2 + 12 + 4
+_NEW_EXIF_HEADER = (b'II*\x00' + struct.pack('<IH', 8, 1)
+                    + struct.pack('<HHII', _GPS_IFD_POINTER, 4, 1, _NEW_EXIF_GPS_OFFSET)
+                    + struct.pack('<I', 0))
+
+# GPS IFD entries written from _GPSValues, in tag order: tag id, field type,
+# count, and the ref attribute holding the value or the index of the first
+# integer of its rationals
+_GPS_LAYOUT = [
+    (0x01, 2, 2, 'lat_ref'),
+    (0x02, 5, 3, 0),
+    (0x03, 2, 2, 'lon_ref'),
+    (0x04, 5, 3, 6),
+    (0x05, 1, 1, 'alt_ref'),
+    (0x06, 5, 1, 12),
+    (0x11, 5, 1, 14),
+]
+
+# Compiled GPS IFD templates by (byte order, number of entries), and Xmp
+# packet templates by attitude tags, built on first use
+_gps_templates = {}
+_xmp_templates = {}
+
+# Whitespace reserved in new Xmp packets so later edits can be made in place
+_XMP_PADDING = 512
+_XMP_PACKET = ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+               '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+               ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+               '  <rdf:Description rdf:about=""\n'
+               '    xmlns:Attitude="attitude/"{}/>\n'
+               ' </rdf:RDF>\n'
+               '</x:xmpmeta>\n'
+               '{}<?xpacket end="w"?>')
+
+# TIFF field type -> size in bytes of one value
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8}
+
+# TIFF field type -> struct format of the integers its values are made of,
+# to convert raw values between byte orders
+_TIFF_TYPE_UNITS = {3: 'H', 4: 'I', 5: 'I', 8: 'H', 9: 'I', 10: 'I'}
+
+
+def _iter_segments(f):
+    """Iterate over the marker segments of a JPEG up to the start of scan
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image, or
+                    of a frame of an MPO
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO
+
+    Yields:
+        (int, int, int) -- marker, offset of the marker in the file and
+                           length of the segment (including the 2 length bytes).
+                           The last segment yielded is the start of scan
+    """
+    offset = f.tell() + 2
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('Image is not a JPEG or MPO')
+
+    while True:
+        header = f.read(4)
+        # Markers may be preceded by any number of 0xFF fill bytes
+        while header[:2] == b'\xff\xff':
+            header = header[1:] + f.read(1)
+            offset += 1
+        if len(header) < 4 or header[0] != 0xFF:
+            raise ValueError('Corrupt JPEG segment')
+
+        marker = header[1]
+        # Standalone markers have no length
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            f.seek(-2, 1)
+            offset += 2
+            continue
+        if marker == 0xD9:
+            return
+
+        length = int.from_bytes(header[2:4], 'big')
+        yield marker, offset, length
+        if marker == 0xDA:
+            return
+
+        offset += 2 + length
+        f.seek(offset)
+
+
+def _image_format(f):
+    """Tell a JPEG from an MPO by its segments, without decoding the image
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO
+
+    Returns:
+        str -- 'JPEG' or 'MPO'
+    """
+    for (marker, offset, length) in _iter_segments(f):
+        if marker == 0xE2 and length >= 2 + len(_MPF_HEADER):
+            f.seek(offset + 4)
+            if f.read(len(_MPF_HEADER)) == _MPF_HEADER:
+                return 'MPO'
+    return 'JPEG'
+
+
+def _read_mp_index(f):
+    """Read the MP Index of an MPO from the APP2 segment of its first frame
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, or the MP Index is corrupt
+
+    Returns:
+        dict -- None if the image is not an MPO, else
+        segment -- (offset, length) of the APP2 segment
+        base -- Offset in the file MP Entry offsets are relative to
+        entries -- Offset in the file of each 16 byte MP Entry
+        frames -- (offset, size) of each frame in the file
+        endian -- '<' or '>'
+    """
+    for (marker, offset, length) in _iter_segments(f):
+        if marker != 0xE2:
+            continue
+        f.seek(offset + 4)
+        payload = f.read(length - 2)
+        if not payload.startswith(_MPF_HEADER):
+            continue
+
+        tiff = payload[len(_MPF_HEADER):]
+        if tiff[:4] == b'II*\x00':
+            endian = '<'
+        elif tiff[:4] == b'MM\x00*':
+            endian = '>'
+        else:
+            raise ValueError('Corrupt MP Index')
+        base = offset + 4 + len(_MPF_HEADER)
+        try:
+            ifd = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+            (_, n, value_offset) = ifd[_MP_ENTRY]
+            entries, frames = [], []
+            for i in range(n // 16):
+                entry = value_offset + 16 * i
+                (size, frame_offset) = struct.unpack_from(endian + 'II', tiff, entry + 4)
+                # The first frame is at the start of the file, its offset is 0
+                frames.append((base + frame_offset if i else 0, size))
+                entries.append(base + entry)
+        except (KeyError, struct.error):
+            raise ValueError('Corrupt MP Index')
+        return {'segment': (offset, 2 + length), 'base': base, 'entries': entries,
+                'frames': frames, 'endian': endian}
+    return None
+
+
+class _BufferFile:
+    """Read only binary file over a buffer, so the segment functions can
+    parse an image in memory. Reads copy only the bytes asked for.
+
+    Arguments:
+        data {bytes or memoryview} -- Image data
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data).cast('B')
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        self._position = max(start, end)
+        return self.view[start:end].tobytes()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += len(self.view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def _buffer_file(data):
+    """Get a binary file to parse image data from
+
+    Arguments:
+        data {bytes, memoryview or file} -- Image data, or a binary file object
+
+    Returns:
+        file -- Seekable binary file positioned at the start of the image
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return _BufferFile(data)
+    if not data.seekable():
+        return _BufferFile(data.read())
+    data.seek(0)
+    return data
+
+
+def _read_range(f, start, end):
+    """Read a range of a file returned by _buffer_file, without copying
+    if it is in memory
+
+    Arguments:
+        f {file} -- Binary file
+        start {int} -- Start offset
+        end {int} -- End offset, or None for the end of the file
+
+    Returns:
+        bytes or memoryview -- Data in the range
+    """
+    if isinstance(f, _BufferFile):
+        return f.view[start:end]
+    f.seek(start)
+    return f.read(-1 if end is None else end - start)
+
+
+def _read_into(f, start, target):
+    """Read a range of a file into a buffer
+
+    Arguments:
+        f {file} -- Seekable binary file
+        start {int} -- Start offset
+        target {memoryview} -- Buffer to fill, its length is read
+
+    Raises:
+        ValueError -- if the file ends before the buffer is filled
+    """
+    f.seek(start)
+    filled = 0
+    while filled < len(target):
+        n = f.readinto(target[filled:])
+        if not n:
+            raise ValueError('Truncated image data')
+        filled += n
+
+
+def _read_app1_segments(f, read_xmp=True):
+    """Read the Exif and Xmp APP1 payloads of a JPEG, stopping at the
+    start of scan
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+
+    Keyword Arguments:
+        read_xmp {bool} -- Read the Xmp segment. If False, only the start
+                           of each APP1 segment is read, and reading stops
+                           at the Exif segment (default: {True})
+
+    Returns:
+        (bytes, bytes) -- TIFF data of the Exif segment and the Xmp packet,
+                          either is None if the segment is missing or not read
+    """
+    exif = xmp = None
+    for (marker, offset, length) in _iter_segments(f):
+        if marker != 0xE1:
+            continue
+        f.seek(offset + 4)
+        # Check the identifier before reading the rest of the payload
+        header = f.read(min(length - 2, len(_XMP_HEADER)))
+        if exif is None and header.startswith(_EXIF_HEADER):
+            exif = (header + f.read(length - 2 - len(header)))[len(_EXIF_HEADER):]
+            if not read_xmp:
+                break
+        elif read_xmp and xmp is None and header == _XMP_HEADER:
+            xmp = f.read(length - 2 - len(header))
+    return exif, xmp
+
+
+def _read_ifd(tiff, offset, endian):
+    """Read the entries of a TIFF IFD
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+        offset {int} -- Offset of the IFD in the TIFF data
+        endian {str} -- '<' or '>'
+
+    Returns:
+        dict -- tag id -> (type, count, offset of the value in the TIFF data)
+    """
+    count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, type_, n = struct.unpack_from(endian + 'HHI', tiff, entry)
+        if _value_size(type_, n) > 4:
+            value_offset = struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+        else:
+            value_offset = entry + 8
+        entries[tag] = (type_, n, value_offset)
+    return entries
+
+
+def _parse_gps_ifd(tiff):
+    """Parse the GPS tags from the TIFF data of an Exif segment
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+
+    Returns:
+        dict -- GPS tag values keyed by pyexiv2 key, converted to the
+                same types pyexiv2 returns
+    """
+    if tiff[:4] == b'II*\x00':
+        endian = '<'
+    elif tiff[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return {}
+
+    try:
+        ifd0 = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+        if _GPS_IFD_POINTER not in ifd0:
+            return {}
+        (_, _, pointer) = ifd0[_GPS_IFD_POINTER]
+        gps = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, pointer)[0], endian)
+    except struct.error:
+        return {}
+
+    values = {}
+    for (tag_id, (type_, n, offset)) in gps.items():
+        key = _GPS_TAG_IDS.get(tag_id)
+        if key is None:
+            continue
+        # A malformed entry (zero denominator, non-ASCII ref, out of range
+        # offset) is treated as a missing tag
+        try:
+            if type_ == 2:
+                values[key] = tiff[offset:offset + n].split(b'\x00', 1)[0].decode('ascii')
+            elif type_ == 1:
+                # pyexiv2 reports bytes as their decimal string
+                values[key] = ' '.join(str(b) for b in tiff[offset:offset + n])
+            elif type_ == 5:
+                nums = struct.unpack_from(endian + '{}I'.format(2 * n), tiff, offset)
+                rationals = [Fraction(nums[i], nums[i + 1]) for i in range(0, 2 * n, 2)]
+                values[key] = rationals if n > 1 else rationals[0]
+        except (struct.error, ZeroDivisionError, UnicodeDecodeError):
+            continue
+    return values
+
+
+def _value_size(type_, count):
+    """Get the size of a TIFF field value
+
+    Arguments:
+        type_ {int} -- TIFF field type
+        count {int} -- Number of values
+
+    Returns:
+        int -- Size of the value in bytes
+    """
+    return _TIFF_TYPE_SIZES.get(type_, 1) * count
+
+
+def _tiff_regions(tiff, endian):
+    """Get the byte ranges used by the header, IFDs and values of TIFF data,
+    except those of the GPS IFD
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+        endian {str} -- '<' or '>'
+
+    Returns:
+        list -- (start, end) byte ranges
+    """
+    regions = [(0, 8)]
+    # Only IFD0 and IFD1 are chained, the next pointers of sub IFDs
+    # are often garbage
+    pending = [(struct.unpack_from(endian + 'I', tiff, 4)[0], True)]
+    seen = set()
+    while pending:
+        (offset, chained) = pending.pop()
+        if offset == 0 or offset in seen or offset + 2 > len(tiff):
+            continue
+        seen.add(offset)
+
+        count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+        end = offset + 2 + 12 * count
+        regions.append((offset, end + 4))
+        if chained:
+            pending.append((struct.unpack_from(endian + 'I', tiff, end)[0], True))
+
+        entries = _read_ifd(tiff, offset, endian)
+        for (tag, (type_, n, value_offset)) in entries.items():
+            size = _value_size(type_, n)
+            if size > 4:
+                regions.append((value_offset, value_offset + size))
+            if tag in (_EXIF_IFD_POINTER, _INTEROP_IFD_POINTER):
+                pending.append((struct.unpack_from(endian + 'I', tiff, value_offset)[0], False))
+
+        if _THUMBNAIL_OFFSET in entries and _THUMBNAIL_LENGTH in entries:
+            start = struct.unpack_from(endian + 'I', tiff, entries[_THUMBNAIL_OFFSET][2])[0]
+            length = struct.unpack_from(endian + 'I', tiff, entries[_THUMBNAIL_LENGTH][2])[0]
+            regions.append((start, start + length))
+    return regions
+
+
+def _encode_gps_entries(exif, endian):
+    """Encode GPS tag values as raw TIFF field values
+
+    Arguments:
+        exif {dict} -- GPS tag values keyed by pyexiv2 key, as returned
+                       by _encode_geo_tags
+        endian {str} -- '<' or '>'
+
+    Returns:
+        dict -- tag id -> (type, count, raw value)
+    """
+    if isinstance(exif, (_GPSEntries, _GPSValues)):
+        return exif.encode(endian)
+
+    entries = {}
+    for (key, value) in exif.items():
+        if isinstance(value, str):
+            raw = value.encode('ascii') + b'\x00'
+            entries[_GPS_TAG_KEYS[key]] = (2, len(raw), raw)
+        elif isinstance(value, bytes):
+            entries[_GPS_TAG_KEYS[key]] = (1, 1, bytes([int(value)]))
+        else:
+            rationals = value if isinstance(value, (list, tuple)) else [value]
+            raw = b''.join(struct.pack(endian + 'II', r.numerator, r.denominator)
+                           for r in rationals)
+            entries[_GPS_TAG_KEYS[key]] = (5, len(rationals), raw)
+    return entries
+
+
+class _GPSEntries:
+    """Raw GPS IFD entries of an image, written as they are stored instead
+    of being encoded from tag values. Accepted in place of the dict of Exif
+    GPS tag values by the segment writing functions.
+
+    Arguments:
+        entries {dict} -- tag id -> (type, count, raw value)
+        endian {str} -- Byte order of the raw values, '<' or '>'
+    """
+
+    __slots__ = ('entries', 'endian')
+
+    def __init__(self, entries, endian):
+        self.entries = entries
+        self.endian = endian
+
+    def __len__(self):
+        return len(self.entries)
+
+    def encode(self, endian):
+        """Get the entries in a byte order
+
+        Arguments:
+            endian {str} -- '<' or '>'
+
+        Returns:
+            dict -- tag id -> (type, count, raw value)
+        """
+        if endian == self.endian:
+            return dict(self.entries)
+        entries = {}
+        for (tag, (type_, n, raw)) in self.entries.items():
+            unit = _TIFF_TYPE_UNITS.get(type_)
+            if unit is not None:
+                fmt = '{}{}'.format(len(raw) // struct.calcsize(unit), unit)
+                raw = struct.pack(endian + fmt, *struct.unpack(self.endian + fmt, raw))
+            entries[tag] = (type_, n, raw)
+        return entries
+
+
+class _GPSValues(Mapping):
+    """GPS tag values written by the geotag functions, kept as the integers
+    of their rationals and the refs. Reads as the dict of pyexiv2 values
+    (tuples of Fractions, str and bytes) for writers that need them, while
+    the segment writers fill the integers into a precompiled GPS IFD, see
+    _GPSTemplate.
+
+    Arguments:
+        lat_ref {str} -- 'N' or 'S'
+        lon_ref {str} -- 'E' or 'W'
+        alt_ref {bytes} -- b'0' or b'1'
+        rationals {tuple} -- Numerators and denominators of the latitude
+                             and longitude dms, the altitude and, if
+                             present, the heading
+    """
+
+    __slots__ = ('lat_ref', 'lon_ref', 'alt_ref', 'rationals')
+
+    def __init__(self, lat_ref, lon_ref, alt_ref, rationals):
+        self.lat_ref = lat_ref
+        self.lon_ref = lon_ref
+        self.alt_ref = alt_ref
+        self.rationals = rationals
+
+    def __getitem__(self, key):
+        tag_id = _GPS_TAG_KEYS.get(key)
+        for (tag, _, count, source) in _GPS_LAYOUT[:len(self)]:
+            if tag != tag_id:
+                continue
+            if isinstance(source, str):
+                return getattr(self, source)
+            r = self.rationals
+            values = tuple(Fraction(r[i], r[i + 1]) for i in range(source, source + 2 * count, 2))
+            return values if count > 1 else values[0]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(_GPS_TAGS[:len(self)])
+
+    def __len__(self):
+        return 7 if len(self.rationals) > 14 else 6
+
+    def __repr__(self):
+        return '_GPSValues({!r})'.format(dict(self))
+
+    def encode(self, endian):
+        """Get the values as raw TIFF field values
+
+        Arguments:
+            endian {str} -- '<' or '>'
+
+        Returns:
+            dict -- tag id -> (type, count, raw value)
+        """
+        return _gps_template(endian, len(self)).entries(self)
+
+    def ifd(self, base, endian):
+        """Build the GPS IFD holding the values
+
+        Arguments:
+            base {int} -- Offset the IFD will be placed at in the TIFF data
+            endian {str} -- '<' or '>'
+
+        Returns:
+            bytes -- IFD and values, as built by _build_ifd
+        """
+        return _gps_template(endian, len(self)).pack(self, base)
+
+
+class _GPSTemplate:
+    """GPS IFD of the entries of _GPSValues in one byte order, compiled to a
+    struct once. Building an IFD then only fills in the refs, the integers
+    of the rationals and the offsets of the values, which are placed right
+    after the IFD as _build_ifd does.
+
+    Arguments:
+        endian {str} -- '<' or '>'
+        count {int} -- Number of entries, 6 or 7 with the heading
+    """
+
+    __slots__ = ('endian', 'layout', 'struct', 'skeleton', 'ref_slots', 'offset_slots')
+
+    def __init__(self, endian, count):
+        self.endian = endian
+        self.layout = _GPS_LAYOUT[:count]
+        fmt = endian + 'H'
+        skeleton = [count]
+        self.ref_slots = []
+        self.offset_slots = []
+        data_offset = 2 + 12 * count + 4
+        for (tag, type_, n, source) in self.layout:
+            skeleton += [tag, type_, n]
+            if isinstance(source, str):
+                fmt += 'HHI4s'
+                self.ref_slots.append((len(skeleton), source))
+                skeleton.append(b'')
+            else:
+                fmt += 'HHII'
+                self.offset_slots.append(len(skeleton))
+                skeleton.append(data_offset)
+                data_offset += 8 * n
+        skeleton.append(0)
+        self.skeleton = skeleton
+        self.struct = struct.Struct(fmt + 'I{}I'.format((data_offset - 2 - 12 * count - 4) // 4))
+
+    def pack(self, values, base):
+        """Build a GPS IFD
+
+        Arguments:
+            values {_GPSValues} -- GPS tag values
+            base {int} -- Offset the IFD will be placed at in the TIFF data
+
+        Returns:
+            bytes -- IFD and values
+        """
+        args = self.skeleton.copy()
+        for i in self.offset_slots:
+            args[i] += base
+        for (i, source) in self.ref_slots:
+            args[i] = _raw_gps_ref(getattr(values, source))
+        return self.struct.pack(*args, *values.rationals)
+
+    def entries(self, values):
+        """Get raw TIFF field values
+
+        Arguments:
+            values {_GPSValues} -- GPS tag values
+
+        Returns:
+            dict -- tag id -> (type, count, raw value)
+        """
+        r = values.rationals
+        entries = {}
+        for (tag, type_, n, source) in self.layout:
+            if isinstance(source, str):
+                raw = _raw_gps_ref(getattr(values, source))
+            else:
+                raw = struct.pack('{}{}I'.format(self.endian, 2 * n), *r[source:source + 2 * n])
+            entries[tag] = (type_, n, raw)
+        return entries
+
+
+def _gps_template(endian, count):
+    """Get the compiled GPS IFD template, compiling it on first use
+
+    Arguments:
+        endian {str} -- '<' or '>'
+        count {int} -- Number of entries
+
+    Returns:
+        _GPSTemplate -- Template
+    """
+    template = _gps_templates.get((endian, count))
+    if template is None:
+        template = _gps_templates[(endian, count)] = _GPSTemplate(endian, count)
+    return template
+
+
+def _raw_gps_ref(ref):
+    """Get the raw TIFF value of a GPS ref, as _encode_gps_entries does
+
+    Arguments:
+        ref {str or bytes} -- ASCII ref, or altitude ref as b'0' or b'1'
+
+    Returns:
+        bytes -- Raw value
+    """
+    if isinstance(ref, str):
+        return ref.encode('ascii') + b'\x00'
+    return bytes([int(ref)])
+
+
+def _read_gps_entries(tiff):
+    """Read the raw GPS IFD entries from the TIFF data of an Exif segment
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+
+    Raises:
+        ValueError -- if the TIFF data is corrupt
+
+    Returns:
+        _GPSEntries -- Entries, empty if there is no GPS IFD
+    """
+    if tiff[:4] == b'II*\x00':
+        endian = '<'
+    elif tiff[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return _GPSEntries({}, '<')
+
+    entries = {}
+    try:
+        ifd0 = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+        if _GPS_IFD_POINTER in ifd0:
+            (_, _, pointer) = ifd0[_GPS_IFD_POINTER]
+            gps = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, pointer)[0], endian)
+            for (tag, (type_, n, value_offset)) in gps.items():
+                # Values of unknown types can't be converted between byte orders
+                if type_ not in _TIFF_TYPE_SIZES:
+                    continue
+                size = _value_size(type_, n)
+                if value_offset + size > len(tiff):
+                    raise ValueError('Corrupt Exif data')
+                entries[tag] = (type_, n, bytes(tiff[value_offset:value_offset + size]))
+    except struct.error:
+        raise ValueError('Corrupt Exif data')
+    return _GPSEntries(entries, endian)
+
+
+def _build_ifd(entries, base, endian, next_ifd=0):
+    """Build a TIFF IFD followed by its out of line values
+
+    Arguments:
+        entries {dict} -- tag id -> (type, count, raw value)
+        base {int} -- Offset the IFD will be placed at in the TIFF data
+        endian {str} -- '<' or '>'
+
+    Keyword Arguments:
+        next_ifd {int} -- Offset of the next IFD (default: {0})
+
+    Returns:
+        bytes -- IFD and values
+    """
+    data_offset = base + 2 + 12 * len(entries) + 4
+    ifd = bytearray(struct.pack(endian + 'H', len(entries)))
+    data = bytearray()
+    for tag in sorted(entries):
+        (type_, count, raw) = entries[tag]
+        if len(raw) <= 4:
+            ifd += struct.pack(endian + 'HHI', tag, type_, count) + raw.ljust(4, b'\x00')
+        else:
+            ifd += struct.pack(endian + 'HHII', tag, type_, count, data_offset + len(data))
+            data += raw
+            # Values start on a word boundary
+            if len(data) % 2:
+                data += b'\x00'
+    ifd += struct.pack(endian + 'I', next_ifd)
+    return bytes(ifd + data)
+
+
+def _new_exif(exif):
+    """Build the TIFF data of an Exif segment holding only GPS tags
+
+    Arguments:
+        exif {dict} -- GPS tag values keyed by pyexiv2 key
+
+    Returns:
+        bytes -- TIFF data
+    """
+    if isinstance(exif, _GPSValues):
+        return _NEW_EXIF_HEADER + exif.ifd(_NEW_EXIF_GPS_OFFSET, '<')
+    return _NEW_EXIF_HEADER + _build_ifd(_encode_gps_entries(exif, '<'), _NEW_EXIF_GPS_OFFSET, '<')
+
+
+def _build_gps_ifd(entries, exif, base, endian):
+    """Build a GPS IFD, from the precompiled template if the values written
+    are all of its entries, as they are in images tagged before
+
+    Arguments:
+        entries {dict} -- tag id -> (type, count, raw value)
+        exif {dict} -- GPS tag values written, keyed by pyexiv2 key
+        base {int} -- Offset the IFD will be placed at in the TIFF data
+        endian {str} -- '<' or '>'
+
+    Returns:
+        bytes -- IFD and values
+    """
+    if isinstance(exif, _GPSValues) and len(entries) == len(exif):
+        return exif.ifd(base, endian)
+    return _build_ifd(entries, base, endian)
+
+
+def _update_exif(tiff, exif):
+    """Set GPS tags in the TIFF data of an Exif segment. Everything outside
+    the GPS IFD is left untouched, so offsets into the data stay valid.
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+        exif {dict} -- GPS tag values keyed by pyexiv2 key
+
+    Raises:
+        ValueError -- if the TIFF data is corrupt
+
+    Returns:
+        bytes -- New TIFF data
+    """
+    if tiff[:4] == b'II*\x00':
+        endian = '<'
+    elif tiff[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return _new_exif(exif)
+
+    try:
+        ifd0_offset = struct.unpack_from(endian + 'I', tiff, 4)[0]
+        ifd0 = _read_ifd(tiff, ifd0_offset, endian)
+        others = _tiff_regions(tiff, endian)
+
+        # Keep GPS tags we don't write, and find the space used by the old GPS IFD
+        entries = {}
+        old = None
+        if _GPS_IFD_POINTER in ifd0:
+            gps_offset = struct.unpack_from(endian + 'I', tiff, ifd0[_GPS_IFD_POINTER][2])[0]
+            gps = _read_ifd(tiff, gps_offset, endian)
+            count = struct.unpack_from(endian + 'H', tiff, gps_offset)[0]
+            old = [(gps_offset, gps_offset + 2 + 12 * count + 4)]
+            for (tag, (type_, n, value_offset)) in gps.items():
+                size = _value_size(type_, n)
+                entries[tag] = (type_, n, tiff[value_offset:value_offset + size])
+                if size > 4:
+                    old.append((value_offset, value_offset + size))
+    except struct.error:
+        raise ValueError('Corrupt Exif data')
+
+    entries.update(_encode_gps_entries(exif, endian))
+    tiff = bytearray(tiff)
+
+    offset = None
+    if old is not None:
+        start = min(s for (s, _) in old)
+        end = max(e for (_, e) in old)
+        if not any(s < end and e > start for (s, e) in others):
+            following = [s for (s, _) in others if s >= end]
+            gps = _build_gps_ifd(entries, exif, start, endian)
+            if not following and not any(tiff[end:]):
+                # The old GPS IFD is at the end of the data, so it can grow
+                tiff[start:] = gps
+                offset = start
+            elif following and start + len(gps) <= min(following):
+                tiff[start:end] = bytes(end - start)
+                tiff[start:start + len(gps)] = gps
+                offset = start
+
+    if offset is None:
+        if len(tiff) % 2:
+            tiff += b'\x00'
+        offset = len(tiff)
+        tiff += _build_gps_ifd(entries, exif, offset, endian)
+
+    if _GPS_IFD_POINTER in ifd0:
+        struct.pack_into(endian + 'I', tiff, ifd0[_GPS_IFD_POINTER][2], offset)
+    else:
+        # IFD0 has no room for another entry, so append a copy of it with
+        # the GPS pointer added and point the header at the copy. Values
+        # out of line stay where they are, so the entries are copied as is
+        ifd0_entries = {}
+        for (tag, (type_, n, value_offset)) in ifd0.items():
+            if _value_size(type_, n) > 4:
+                ifd0_entries[tag] = (type_, n, struct.pack(endian + 'I', value_offset))
+            else:
+                ifd0_entries[tag] = (type_, n, bytes(tiff[value_offset:value_offset + 4]))
+        ifd0_entries[_GPS_IFD_POINTER] = (4, 1, struct.pack(endian + 'I', offset))
+
+        count = struct.unpack_from(endian + 'H', tiff, ifd0_offset)[0]
+        next_ifd = struct.unpack_from(endian + 'I', tiff, ifd0_offset + 2 + 12 * count)[0]
+        if len(tiff) % 2:
+            tiff += b'\x00'
+        struct.pack_into(endian + 'I', tiff, 4, len(tiff))
+        tiff += _build_ifd(ifd0_entries, len(tiff), endian, next_ifd)
+    return bytes(tiff)
+
+
+def _new_attitude_xmp(xmp):
+    """Build an Xmp packet holding only attitude tags
+
+    Arguments:
+        xmp {dict} -- Attitude values keyed by pyexiv2 key
+
+    Returns:
+        bytes -- Xmp packet
+    """
+    tags = tuple(xmp)
+    template = _xmp_templates.get(tags)
+    if template is None:
+        # Encoded once, with a %s for each value
+        properties = ''.join('\n    Attitude:{}="%s"'.format(tag.rsplit('.', 1)[1]) for tag in tags)
+        padding = (' ' * 99 + '\n') * (_XMP_PADDING // 100)
+        packet = _XMP_PACKET.replace('%', '%%').format(properties, padding)
+        template = _xmp_templates[tags] = packet.encode('utf-8')
+    return template % tuple([value.encode('utf-8') for value in xmp.values()])
+
+
+def _update_attitude_xmp(packet, xmp):
+    """Set attitude tags in an Xmp packet, keeping the rest of the
+    packet as is
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+        xmp {dict} -- Attitude values keyed by pyexiv2 key
+
+    Raises:
+        ValueError -- if the packet has no rdf:RDF element
+
+    Returns:
+        bytes -- New Xmp packet
+    """
+    return _update_xmp(packet, _ATTITUDE_NS, 'Attitude', xmp)
+
+
+def _update_xmp(packet, namespace, default_prefix, values):
+    """Set simple properties of a namespace in an Xmp packet, keeping the
+    rest of the packet as is
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+        namespace {str} -- Namespace URI of the properties
+        default_prefix {str} -- Prefix to declare the namespace with, if
+                                the packet does not declare it
+        values {dict} -- Property values keyed by pyexiv2 key
+
+    Raises:
+        ValueError -- if the packet has no rdf:RDF element
+
+    Returns:
+        bytes -- New Xmp packet
+    """
+    text = packet.decode('utf-8')
+
+    declaration = re.search(r'xmlns:(\w+)\s*=\s*["\']' + re.escape(namespace) + '["\']', text)
+    if declaration is None:
+        description = re.search(r'<rdf:Description\b', text)
+        if description is None:
+            rdf = re.search(r'<rdf:RDF\b[^>]*>', text)
+            if rdf is None:
+                raise ValueError('Invalid Xmp packet')
+            text = text[:rdf.end()] + '<rdf:Description rdf:about=""/>' + text[rdf.end():]
+            description = re.search(r'<rdf:Description\b', text)
+        text = (text[:description.end()] + ' xmlns:' + default_prefix + '="' + namespace + '"'
+                + text[description.end():])
+        declaration = re.search(r'xmlns:(\w+)="' + re.escape(namespace) + '"', text)
+    prefix = declaration.group(1)
+
+    for (tag, value) in values.items():
+        name = re.escape(prefix + ':' + tag.rsplit('.', 1)[1])
+        attribute = re.search(r'\s' + name + r'\s*=\s*(["\'])(.*?)\1', text, re.S)
+        element = re.search(r'<' + name + r'>(.*?)</' + name + '>', text, re.S)
+        if attribute is not None:
+            text = text[:attribute.start(2)] + value + text[attribute.end(2):]
+        elif element is not None:
+            text = text[:element.start(1)] + value + text[element.end(1):]
+        else:
+            # Add an attribute to the rdf:Description the namespace is
+            # declared on, or to the first one if it is declared higher up
+            declaration = re.search(r'xmlns:' + re.escape(prefix) + r'\s*=\s*["\'][^"\']*["\']', text)
+            tag_start = text.rfind('<', 0, declaration.start())
+            if text.startswith('<rdf:Description', tag_start):
+                position = declaration.end()
+            else:
+                position = re.search(r'<rdf:Description\b', text).end()
+            text = (text[:position] + ' ' + prefix + ':' + tag.rsplit('.', 1)[1]
+                    + '="' + value + '"' + text[position:])
+
+    return text.encode('utf-8')
+
+
+def _fit_xmp_padding(packet, size):
+    """Grow or shrink the whitespace padding at the end of an Xmp packet
+    to make the packet a given size
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+        size {int} -- Wanted size in bytes
+
+    Returns:
+        bytes -- Xmp packet, which is not the wanted size if there is
+                 not enough padding
+    """
+    trailer = packet.rfind(b'<?xpacket end')
+    if trailer == -1:
+        trailer = len(packet)
+    padding = trailer
+    while padding > 0 and packet[padding - 1] in b' \t\r\n':
+        padding -= 1
+
+    extra = len(packet) - size
+    if extra < 0:
+        return packet[:trailer] + b' ' * -extra + packet[trailer:]
+    if extra > trailer - padding:
+        return packet
+    return packet[:padding] + packet[padding + extra:]
+
+
+def _app1_segment(header, payload):
+    """Build an APP1 segment
+
+    Arguments:
+        header {bytes} -- Identifier at the start of the payload
+        payload {bytes} -- Rest of the payload
+
+    Raises:
+        ValueError -- if the payload is too large for a segment
+
+    Returns:
+        bytes -- Marker, length and payload
+    """
+    length = 2 + len(header) + len(payload)
+    if length - 2 > _MAX_APP1_PAYLOAD:
+        raise ValueError('Metadata too large for APP1 segment')
+    return b'\xff\xe1' + struct.pack('>H', length) + header + payload
+
+
+def _plan_app1_edits(f, exif, xmp):
+    """Work out how to replace the Exif and Xmp segments of a JPEG
+
+    New segments that are no larger than the old ones are padded to the old
+    size, so they can be written over them.
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image, or
+                    of a frame of an MPO
+        exif {dict} -- GPS tag values keyed by pyexiv2 key
+        xmp {dict} -- Attitude values keyed by pyexiv2 key
+
+    Returns:
+        (list, int) -- (offset, length, segment) edits in file order, where
+                       length bytes at offset are replaced with segment,
+                       and the offset of the start of scan
+    """
+    exif_segment = xmp_segment = sos = None
+    start = insert_at = f.tell() + 2
+    for (marker, offset, length) in _iter_segments(f):
+        if marker == 0xDA:
+            sos = offset
+        # JFIF requires its APP0 segment to come first
+        if marker == 0xE0 and offset == insert_at == start:
+            insert_at = offset + 2 + length
+        if marker == 0xE1:
+            f.seek(offset + 4)
+            payload = f.read(length - 2)
+            if exif_segment is None and payload.startswith(_EXIF_HEADER):
+                exif_segment = (offset, length, payload[len(_EXIF_HEADER):])
+            elif xmp_segment is None and payload.startswith(_XMP_HEADER):
+                xmp_segment = (offset, length, payload[len(_XMP_HEADER):])
+    if sos is None:
+        raise ValueError('Corrupt JPEG segment')
+
+    edits = []
+    if exif_segment is not None:
+        (offset, length, tiff) = exif_segment
+        tiff = _update_exif(tiff, exif)
+        if len(tiff) <= length - 2 - len(_EXIF_HEADER):
+            tiff = tiff.ljust(length - 2 - len(_EXIF_HEADER), b'\x00')
+        edits.append((offset, 2 + length, _app1_segment(_EXIF_HEADER, tiff)))
+        insert_at = offset + 2 + length
+    else:
+        edits.append((insert_at, 0, _app1_segment(_EXIF_HEADER, _new_exif(exif))))
+
+    if xmp:
+        if xmp_segment is not None:
+            (offset, length, packet) = xmp_segment
+            packet = _fit_xmp_padding(_update_attitude_xmp(packet, xmp),
+                                      length - 2 - len(_XMP_HEADER))
+            edits.append((offset, 2 + length, _app1_segment(_XMP_HEADER, packet)))
+        else:
+            edits.append((insert_at, 0, _app1_segment(_XMP_HEADER, _new_attitude_xmp(xmp))))
+
+    return sorted(edits, key=lambda edit: edit[0]), sos
+
+
+def _write_segments(img_path, exif, xmp, frames=None, buffer_size=None):
+    """Rebuild the Exif and Xmp APP1 segments of an image file. Patches the
+    file in place if the new segments fit in the space of the old ones,
+    otherwise streams the image to a new file which replaces it.
+
+    Arguments:
+        img_path {str} -- Path to image
+        exif {dict} -- GPS tag values keyed by pyexiv2 key
+        xmp {dict} -- Attitude values keyed by pyexiv2 key
+
+    Keyword Arguments:
+        frames {str or iterable} -- Indices of the MPO frames to tag, or
+                                    'all' (default: {None}, first frame)
+        buffer_size {int} -- Size of the buffer image data is copied
+                             through (default: {None}, _COPY_BUFFER_SIZE)
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, a frame doesn't exist,
+                      or the new metadata does not fit in an APP1 segment
+
+    Returns:
+        (bool, int) -- True if the file was patched in place, and the
+                       number of bytes written
+    """
+    with open(img_path, 'r+b') as f:
+        if frames is None:
+            edits, _ = _plan_app1_edits(f, exif, xmp)
+        else:
+            edits = _plan_frame_edits(f, exif, xmp, frames)
+        in_place = all(len(segment) == length for (_, length, segment) in edits)
+        if in_place:
+            _patch_segments(f, edits)
+            nbytes = sum(len(segment) for (_, _, segment) in edits)
+        else:
+            (tmp_path, nbytes) = _stream_segments(f, img_path, edits, buffer_size)
+
+    if not in_place:
+        shutil.copymode(img_path, tmp_path)
+        os.replace(tmp_path, img_path)
+    return in_place, nbytes
+
+
+def _plan_frame_edits(f, exif, xmp, frames):
+    """Work out how to replace the Exif and Xmp segments of frames of an
+    MPO, and update its MP Index for the frames that move
+
+    Arguments:
+        f {file} -- Binary file positioned at the start of the image
+        exif {dict} -- GPS tag values keyed by pyexiv2 key
+        xmp {dict} -- Attitude values keyed by pyexiv2 key
+        frames {str or iterable} -- Indices of the frames, or 'all'
+
+    Raises:
+        ValueError -- if a frame doesn't exist
+
+    Returns:
+        list -- (offset, length, segment) edits in file order, as
+                returned by _plan_app1_edits
+    """
+    mp_index = _read_mp_index(f)
+    if mp_index is None:
+        # A JPEG has one frame
+        mp_index = {'frames': [(0, None)]}
+    count = len(mp_index['frames'])
+    indices = range(count) if frames == 'all' else sorted(set(frames))
+    for i in indices:
+        if not 0 <= i < count:
+            raise ValueError('Image has no frame {}'.format(i))
+
+    edits = []
+    for i in indices:
+        f.seek(mp_index['frames'][i][0])
+        edits += _plan_app1_edits(f, exif, xmp)[0]
+    if all(len(segment) == length for (_, length, segment) in edits) or count == 1:
+        return edits
+
+    def moved(position):
+        return position + sum(len(segment) - length for (offset, length, segment) in edits
+                              if offset < position)
+
+    # Point the MP Entries at where the frames will be, with their new sizes
+    # Frames end where the next one starts, as writers don't always get
+    # the sizes right
+    f.seek(0, 2)
+    starts = sorted({frame_offset for (frame_offset, _) in mp_index['frames']} | {f.tell()})
+
+    (offset, length) = mp_index['segment']
+    f.seek(offset)
+    segment = bytearray(f.read(length))
+    endian = mp_index['endian']
+    base = moved(mp_index['base'])
+    for (i, (frame_offset, size)) in enumerate(mp_index['frames']):
+        end = min([start for start in starts if start > frame_offset], default=frame_offset)
+        growth = sum(len(s) - n for (o, n, s) in edits if frame_offset <= o < end)
+        new_offset = moved(frame_offset) - base if i else 0
+        struct.pack_into(endian + 'II', segment, mp_index['entries'][i] - offset + 4,
+                         size + growth, new_offset)
+    edits.append((offset, length, bytes(segment)))
+    # Inserted segments go before a segment replaced at the same offset
+    return sorted(edits, key=lambda edit: (edit[0], edit[1]))
+
+
+def _patch_segments(f, edits):
+    """Write segments over old ones of the same size through a memory map
+
+    Arguments:
+        f {file} -- Binary file opened for update
+        edits {list} -- (offset, length, segment) edits
+    """
+    f.flush()
+    end = max(offset + length for (offset, length, _) in edits)
+    with mmap.mmap(f.fileno(), end) as mapped:
+        for (offset, length, segment) in edits:
+            mapped[offset:offset + length] = segment
+        mapped.flush()
+
+
+def _stream_segments(f, img_path, edits, buffer_size=None):
+    """Write a copy of a JPEG with segments replaced to a temporary file
+    next to it. Everything between the segments is copied in bulk.
+
+    Arguments:
+        f {file} -- Binary file of the image
+        img_path {str} -- Path to image
+        edits {list} -- (offset, length, segment) edits
+
+    Keyword Arguments:
+        buffer_size {int} -- Size of the buffer image data is copied
+                             through (default: {None}, _COPY_BUFFER_SIZE)
+
+    Returns:
+        (str, int) -- Path to the temporary file and its size
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(img_path)),
+                                    suffix='.tmp')
+    try:
+        with open(fd, 'wb') as out:
+            position = 0
+            for (offset, length, segment) in edits:
+                _copy_range(f, out, position, offset - position, buffer_size)
+                out.write(segment)
+                position = offset + length
+            f.seek(0, 2)
+            _copy_range(f, out, position, f.tell() - position, buffer_size)
+            nbytes = out.tell()
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, nbytes
+
+
+def _copy_range(src, dst, offset, count, buffer_size=None):
+    """Copy a range of one file to the end of another, in the kernel
+    where possible
+
+    Arguments:
+        src {file} -- Binary file to copy from
+        dst {file} -- Binary file to copy to
+        offset {int} -- Offset of the range in src
+        count {int} -- Size of the range in bytes
+
+    Keyword Arguments:
+        buffer_size {int} -- Size of the buffer used without sendfile
+                             (default: {None}, _COPY_BUFFER_SIZE)
+    """
+    if count <= 0:
+        return
+    if buffer_size is None:
+        buffer_size = _COPY_BUFFER_SIZE
+    if buffer_size < 1:
+        raise ValueError('Invalid buffer size')
+    dst.flush()
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except OSError:
+            pass
+        dst.seek(0, 2)
+
+    src.seek(offset)
+    while count > 0:
+        chunk = src.read(min(count, buffer_size))
+        if not chunk:
+            break
+        dst.write(chunk)
+        count -= len(chunk)
+
+
+def _parse_capture_time(tiff):
+    """Parse DateTimeOriginal and SubSecTimeOriginal from the TIFF data
+    of an Exif segment
+
+    Arguments:
+        tiff {bytes} -- TIFF data
+
+    Returns:
+        datetime -- Capture time, without a timezone, or None if missing
+    """
+    if tiff[:4] == b'II*\x00':
+        endian = '<'
+    elif tiff[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return None
+
+    try:
+        ifd0 = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+        if _EXIF_IFD_POINTER not in ifd0:
+            return None
+        pointer = ifd0[_EXIF_IFD_POINTER][2]
+        exif = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, pointer)[0], endian)
+    except struct.error:
+        return None
+    if _DATE_TIME_ORIGINAL not in exif:
+        return None
+
+    def ascii(tag):
+        (_, n, offset) = exif[tag]
+        return tiff[offset:offset + n].split(b'\x00', 1)[0].decode('ascii').strip()
+
+    try:
+        capture_time = datetime.strptime(ascii(_DATE_TIME_ORIGINAL), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    if _SUB_SEC_TIME_ORIGINAL in exif:
+        sub_sec = ascii(_SUB_SEC_TIME_ORIGINAL)
+        if sub_sec.isdigit():
+            capture_time = capture_time.replace(microsecond=int(sub_sec[:6].ljust(6, '0')))
+    return capture_time
+
+
+def _parse_attitude_xmp(packet):
+    """Parse the custom Attitude properties from an Xmp packet
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+
+    Returns:
+        dict -- Attitude values keyed by pyexiv2 key
+    """
+    return _parse_xmp(packet, _ATTITUDE_NS, _ATTITUDE_TAGS)
+
+
+def _parse_xmp(packet, namespace, tags):
+    """Parse simple properties of a namespace from an Xmp packet
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+        namespace {str} -- Namespace URI of the properties
+        tags {list} -- pyexiv2 keys of the properties
+
+    Returns:
+        dict -- Property values keyed by pyexiv2 key
+    """
+    values = {}
+    if namespace.encode() not in packet:
+        return values
+
+    try:
+        root = ElementTree.fromstring(packet)
+    except ElementTree.ParseError:
+        return values
+
+    # Properties are written either as attributes or as child elements
+    # of rdf:Description
+    for description in root.iter(_RDF_DESCRIPTION):
+        for key in tags:
+            ns_name = '{' + namespace + '}' + key.rsplit('.', 1)[1]
+            if ns_name in description.attrib:
+                values[key] = description.attrib[ns_name]
+            else:
+                element = description.find(ns_name)
+                if element is not None and element.text is not None:
+                    values[key] = element.text
+    return values
+
+
+# --------------------------------------------------
+# Sidecar Functions
+# --------------------------------------------------
+_EXIF_NS = 'http://ns.adobe.com/exif/1.0/'
+
+# Xmp properties holding the Exif GPS tags in a sidecar
+_SIDECAR_GPS_TAGS = {
+    'Exif.GPSInfo.GPSLatitude': 'Xmp.exif.GPSLatitude',
+    'Exif.GPSInfo.GPSLongitude': 'Xmp.exif.GPSLongitude',
+    'Exif.GPSInfo.GPSAltitude': 'Xmp.exif.GPSAltitude',
+    'Exif.GPSInfo.GPSAltitudeRef': 'Xmp.exif.GPSAltitudeRef',
+    'Exif.GPSInfo.GPSImgDirection': 'Xmp.exif.GPSImgDirection',
+}
+
+
+def _sidecar_path(img_path):
+    """Get the path of the Xmp sidecar of an image, the image path with
+    .xmp appended. The extension is kept so images differing only in
+    extension (p.jpg and p.mpo) don't share a sidecar.
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Returns:
+        str -- Path to sidecar
+    """
+    return img_path + '.xmp'
+
+
+def _write_sidecar(img_path, exif, xmp, skip_unchanged=False):
+    """Write geotags to the Xmp sidecar of an image, creating it if
+    missing. Other properties of an existing sidecar are kept.
+
+    Arguments:
+        img_path {str} -- Path to image
+        exif {dict} -- Exif GPS tag values, as returned by _encode_geo_tags
+        xmp {dict} -- Xmp attitude tag values, as returned by _encode_geo_tags
+
+    Keyword Arguments:
+        skip_unchanged {bool} -- Don't write the sidecar if it already has
+                                 the same tag values (default: {False})
+
+    Returns:
+        bool -- True if the sidecar was written, False if it was skipped
+    """
+    path = _sidecar_path(img_path)
+    try:
+        with open(path, 'rb') as f:
+            packet = f.read()
+    except FileNotFoundError:
+        packet = _XMP_PACKET.format('', '').encode('utf-8')
+    else:
+        if skip_unchanged and _geo_tags_unchanged(exif, xmp, *_parse_sidecar(packet)):
+            return False
+
+    gps = {}
+    for (tag, xmp_tag) in _SIDECAR_GPS_TAGS.items():
+        if tag in exif:
+            gps[xmp_tag] = _xmp_gps_value(exif[tag], exif.get(tag + 'Ref'))
+    packet = _update_xmp(packet, _EXIF_NS, 'exif', gps)
+    packet = _update_attitude_xmp(packet, xmp)
+
+    # Write to a temporary file first so a failed write never leaves a
+    # truncated sidecar
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(packet)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def _read_sidecar(img_path):
+    """Read the geotags in the Xmp sidecar of an image
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Returns:
+        dict -- Same as read_geo_tag, all None if there is no sidecar
+    """
+    try:
+        with open(_sidecar_path(img_path), 'rb') as f:
+            packet = f.read()
+    except FileNotFoundError:
+        return _decode_geo_tags({}, {})
+    return _decode_geo_tags(*_parse_sidecar(packet))
+
+
+def _parse_sidecar(packet):
+    """Parse the geotags of an Xmp sidecar into the raw tag values of an
+    image, so they can be decoded and compared the same way
+
+    Arguments:
+        packet {bytes} -- Xmp packet
+
+    Returns:
+        (dict, dict) -- Exif GPS tag values and Xmp attitude tag values,
+                        keyed by pyexiv2 key
+    """
+    gps = _parse_xmp(packet, _EXIF_NS, list(_SIDECAR_GPS_TAGS.values()))
+    exif = {}
+    for (tag, xmp_tag) in _SIDECAR_GPS_TAGS.items():
+        if xmp_tag not in gps:
+            continue
+        try:
+            value = gps[xmp_tag].strip()
+            if tag in ['Exif.GPSInfo.GPSLatitude', 'Exif.GPSInfo.GPSLongitude']:
+                exif[tag], exif[tag + 'Ref'] = _parse_xmp_coordinate(value)
+            elif tag == 'Exif.GPSInfo.GPSAltitudeRef':
+                exif[tag] = value
+            else:
+                exif[tag] = Fraction(value)
+        except (ValueError, ZeroDivisionError):
+            continue
+
+    # Other tools may leave out the altitude ref when above sea level
+    if 'Exif.GPSInfo.GPSAltitude' in exif:
+        exif.setdefault('Exif.GPSInfo.GPSAltitudeRef', '0')
+    return exif, _parse_attitude_xmp(packet)
+
+
+def _xmp_gps_value(value, ref=None):
+    """Format an Exif GPS tag value as its Xmp property value
+
+    Arguments:
+        value -- Tag value, as returned by _encode_geo_tags
+
+    Keyword Arguments:
+        ref {str} -- Ref of a latitude or longitude (default: {None})
+
+    Returns:
+        str -- Xmp value
+    """
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    if isinstance(value, (list, tuple)):
+        # Xmp GPSCoordinate, DDD,MM,SSk. Seconds are written in full so
+        # they read back as the same Fraction
+        (d, m, s) = value
+        return '{},{},{}{}'.format(d.numerator, m.numerator, _fraction_decimal(s), ref)
+    return '{}/{}'.format(value.numerator, value.denominator)
+
+
+def _fraction_decimal(value):
+    """Format a non-negative Fraction as a decimal, exact if its
+    denominator divides 10**20
+
+    Arguments:
+        value {Fraction} -- Value
+
+    Returns:
+        str -- Decimal
+    """
+    digits = 0
+    while 10 ** digits % value.denominator and digits < 20:
+        digits += 1
+    if digits == 0:
+        return str(value.numerator)
+    scaled = round(value * 10 ** digits)
+    return '{}.{:0{}d}'.format(scaled // 10 ** digits, scaled % 10 ** digits, digits)
+
+
+def _parse_xmp_coordinate(value):
+    """Parse an Xmp GPSCoordinate, either DDD,MM,SSk or DDD,MM.mmk
+
+    Arguments:
+        value {str} -- Coordinate
+
+    Raises:
+        ValueError -- if the coordinate is invalid
+
+    Returns:
+        (list, str) -- Degrees, minutes and seconds as Fractions, and ref
+    """
+    ref = value[-1:].upper()
+    if ref not in ['N', 'S', 'E', 'W']:
+        raise ValueError('Invalid Xmp coordinate')
+    parts = [Fraction(part) for part in value[:-1].split(',')]
+    if len(parts) == 3:
+        return parts, ref
+    if len(parts) == 2:
+        minutes = int(parts[1])
+        return [parts[0], Fraction(minutes), (parts[1] - minutes) * 60], ref
+    raise ValueError('Invalid Xmp coordinate')
+
+
+def _merge_geo_tags(embedded, sidecar):
+    """Merge geotags read from an image and from its sidecar. The sidecar
+    takes precedence, field by field: fields missing from the sidecar are
+    taken from the image.
+
+    Arguments:
+        embedded {dict} -- Geotags read from the image
+        sidecar {dict} -- Geotags read from the sidecar
+
+    Returns:
+        dict -- Merged geotags
+    """
+    return {field: sidecar[field] if sidecar[field] is not None else value
+            for (field, value) in embedded.items()}
+
+
+# --------------------------------------------------
+# Telemetry Functions
+# --------------------------------------------------
+# Default CSV columns of a telemetry log
+_TELEMETRY_COLUMNS = {
+    'time': 'time',
+    'lat': 'lat',
+    'lon': 'lon',
+    'alt': 'alt',
+    'hdg': 'hdg',
+    'roll': 'roll',
+    'pitch': 'pitch',
+    'yaw': 'yaw',
+}
+_TELEMETRY_ANGLES = ['hdg', 'roll', 'pitch', 'yaw']
+
+
+def read_capture_time(img_path):
+    """Reads the capture time (DateTimeOriginal) of an image
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Raises:
+        ValueError -- if image is not a JPEG or MPO, or has no capture time
+
+    Returns:
+        datetime -- Capture time, without a timezone
+    """
+    with open(img_path, 'rb') as f:
+        exif_payload, _ = _read_app1_segments(f, read_xmp=False)
+    capture_time = _parse_capture_time(exif_payload) if exif_payload is not None else None
+    if capture_time is None:
+        raise ValueError('Image has no capture time')
+    return capture_time
+
+
+def sync_telemetry(log_path, img_paths, time_offset=0, columns=None):
+    """Match images to a telemetry log on capture time, interpolating
+    the position and attitude between the log rows on either side
+
+    The log is streamed once and must be sorted by time. Only the capture
+    times of the images are held in memory, so memory does not grow
+    with the length of the log.
+
+    Arguments:
+        log_path {str} -- Path to CSV telemetry log with a header row
+        img_paths {iterable} -- Paths to images
+
+    Keyword Arguments:
+        time_offset {float} -- Seconds added to image capture times to bring
+                               them to the time base of the log (default: {0})
+        columns {dict} -- Log column name of each field (time, lat, lon, alt,
+                          hdg, roll, pitch, yaw), for columns not named
+                          like the field (default: {None})
+
+    Raises:
+        ValueError -- if the log is not sorted by time
+
+    Returns:
+        list -- (img_path, tags, error) per image, in input order. tags is a
+                dict of write_geo_tag keyword arguments, or None on error
+    """
+    img_paths = list(img_paths)
+    results = [None] * len(img_paths)
+
+    # Sorted index of capture times, as seconds in the time base of the log
+    times = []
+    for (i, img_path) in enumerate(img_paths):
+        try:
+            times.append((_timestamp(read_capture_time(img_path)) + time_offset, i))
+        except Exception as e:
+            results[i] = (img_path, None, e)
+    times.sort()
+    sorted_times = [t for (t, _) in times]
+
+    # Stream the log, matching the images between each pair of rows
+    start = 0
+    previous = None
+    for row in _read_telemetry(log_path, columns):
+        if previous is None:
+            start = bisect.bisect_left(sorted_times, row['time'])
+        elif row['time'] < previous['time']:
+            raise ValueError('Telemetry log is not sorted by time')
+        else:
+            end = bisect.bisect_right(sorted_times, row['time'], start)
+            for (t, i) in times[start:end]:
+                results[i] = (img_paths[i], _interpolate_telemetry(previous, row, t), None)
+            start = end
+        previous = row
+
+    for (i, result) in enumerate(results):
+        if result is None:
+            results[i] = (img_paths[i], None, ValueError('Image time is outside the telemetry log'))
+    return results
+
+
+def write_geo_tags_from_telemetry(log_path, img_paths, time_offset=0, columns=None, jobs=1):
+    """Writes geotags interpolated from a telemetry log to images
+
+    Arguments:
+        log_path {str} -- Path to CSV telemetry log with a header row
+        img_paths {iterable} -- Paths to images
+
+    Keyword Arguments:
+        time_offset {float} -- Seconds added to image capture times to bring
+                               them to the time base of the log (default: {0})
+        columns {dict} -- Log column names, see sync_telemetry (default: {None})
+        jobs {int} -- Number of worker processes for writing (default: {1})
+
+    Returns:
+        list -- (img_path, tags, error) per image, in input order
+    """
+    results = sync_telemetry(log_path, img_paths, time_offset, columns)
+    records = [dict(tags, img_path=img_path) for (img_path, tags, error) in results
+               if error is None]
+    errors = iter(error for (_, _, error) in write_geo_tags_batch(records, jobs))
+    return [(img_path, tags, next(errors) if error is None else error)
+            for (img_path, tags, error) in results]
+
+
+def _read_telemetry(log_path, columns):
+    """Stream the rows of a CSV telemetry log
+
+    Arguments:
+        log_path {str} -- Path to CSV telemetry log with a header row
+        columns {dict} -- Log column name of each field, or None
+
+    Raises:
+        ValueError -- if a required column is missing
+
+    Yields:
+        dict -- time in seconds, and each field as a float or None. Rows
+                without a lat, lon or alt (no position fix) or without a
+                valid time are skipped
+    """
+    names = dict(_TELEMETRY_COLUMNS, **(columns or {}))
+    with open(log_path, newline='') as f:
+        reader = csv.DictReader(f)
+        for field in ['time', 'lat', 'lon', 'alt']:
+            if names[field] not in (reader.fieldnames or []):
+                raise ValueError('Telemetry log has no {} column'.format(names[field]))
+
+        for line in reader:
+            value = line.get(names['time'])
+            if value is None or not value.strip():
+                continue
+            try:
+                time = _parse_log_time(value)
+            except ValueError:
+                continue
+            if not math.isfinite(time):
+                continue
+            row = {'time': time}
+            for field in ['lat', 'lon', 'alt'] + _TELEMETRY_ANGLES:
+                value = line.get(names[field])
+                row[field] = float(value) if value not in (None, '') else None
+            if row['lat'] is None or row['lon'] is None or row['alt'] is None:
+                continue
+            yield row
+
+
+def _interpolate_telemetry(before, after, t):
+    """Linearly interpolate two telemetry rows
+
+    Arguments:
+        before {dict} -- Row at or before t
+        after {dict} -- Row at or after t
+        t {float} -- Time in seconds
+
+    Returns:
+        dict -- write_geo_tag keyword arguments
+    """
+    span = after['time'] - before['time']
+    w = (t - before['time']) / span if span > 0 else 0.0
+
+    tags = {}
+    for (field, tag) in [('lat', 'lat'), ('alt', 'alt_abs')]:
+        tags[tag] = before[field] + (after[field] - before[field]) * w
+    # Along the shorter arc, so tracks crossing the antimeridian stay near it
+    delta = (after['lon'] - before['lon'] + 180) % 360 - 180
+    lon = before['lon'] + delta * w
+    if lon > 180:
+        lon -= 360
+    elif lon < -180:
+        lon += 360
+    tags['lon'] = lon
+    for field in _TELEMETRY_ANGLES:
+        if before[field] is None or after[field] is None:
+            tags[field] = None
+        else:
+            tags[field] = _interpolate_angle(before[field], after[field], w)
+    return tags
+
+
+def _interpolate_angle(a, b, w):
+    """Interpolate between two angles along the shorter arc
+
+    Arguments:
+        a {float} -- angle in degrees
+        b {float} -- angle in degrees
+        w {float} -- weight of b, between 0 and 1
+
+    Returns:
+        float -- angle in degrees, between 0 (inclusive) and 360 (exclusive)
+    """
+    delta = (b - a + 180) % 360 - 180
+    angle = (a + delta * w) % 360
+    # _check_angle only accepts up to 359.99
+    if angle > 359.99:
+        angle = 0.0 if angle >= 359.995 else 359.99
+    return angle
+
+
+def _parse_log_time(value):
+    """Parse a telemetry log time, either seconds since the epoch or ISO 8601
+
+    Arguments:
+        value {str} -- Time
+
+    Returns:
+        float -- Seconds since the epoch
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return _timestamp(datetime.fromisoformat(value.strip().replace('Z', '+00:00')))
+
+
+def _timestamp(time):
+    """Convert a datetime to seconds since the epoch, taking times without
+    a timezone as UTC
+
+    Arguments:
+        time {datetime} -- Time
+
+    Returns:
+        float -- Seconds since the epoch
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+# --------------------------------------------------
+# Batch Functions
+# --------------------------------------------------
+
+
+def write_geo_tags_batch(records, jobs=None, chunksize=None, skip_unchanged=False):
+    """Writes geotags to many images using a pool of worker processes
+
+    Arguments:
+        records {iterable} -- One record per image, either a dict of
+                              write_geo_tag keyword arguments (including
+                              img_path) or a tuple of its positional arguments
+
+    Keyword Arguments:
+        jobs {int} -- Number of worker processes, 1 runs in this process
+                      (default: {None}, one per cpu)
+        chunksize {int} -- Number of images per work unit (default: {None})
+        skip_unchanged {bool} -- Skip images that already have the tags,
+                                 see write_geo_tag (default: {False})
+
+    Returns:
+        list -- (img_path, written, error) per record, in input order.
+                written is False if the image was skipped, None on error.
+                error is the exception raised for that image, or None
+    """
+    worker = _write_chunk
+    if skip_unchanged:
+        worker = functools.partial(_write_chunk, writer=functools.partial(write_geo_tag,
+                                                                          skip_unchanged=True))
+    return _run_batch(worker, list(records), jobs, chunksize)
+
+
+def read_geo_tags_batch(img_paths, jobs=None, chunksize=None, columnar=False, fields=None):
+    """Reads geotags from many images using a pool of worker processes
+
+    Arguments:
+        img_paths {iterable} -- Paths to images
+
+    Keyword Arguments:
+        jobs {int} -- Number of worker processes, 1 runs in this process
+                      (default: {None}, one per cpu)
+        chunksize {int} -- Number of images per work unit (default: {None})
+        columnar {bool} -- Return a GeoTagColumns instead of a list
+                           (default: {False})
+        fields {iterable} -- Fields to read, see read_geo_tag. Columns of
+                             other fields are all NaN (default: {None})
+
+    Returns:
+        list -- (img_path, tags, error) per image, in input order.
+                tags is the dict returned by read_geo_tag, or None on error
+        or GeoTagColumns -- if columnar, in input order
+    """
+    read_chunk, read_columns_chunk = _read_chunk, _read_columns_chunk
+    if fields is not None:
+        reader = functools.partial(read_geo_tag, fields=_field_tags(fields)[2])
+        read_chunk = functools.partial(_read_chunk, reader=reader)
+        read_columns_chunk = functools.partial(_read_columns_chunk, reader=reader)
+
+    if columnar:
+        return GeoTagColumns.concat(_run_batch(read_columns_chunk, list(img_paths),
+                                               jobs, chunksize))
+    return _run_batch(read_chunk, list(img_paths), jobs, chunksize)
+
+
+def propagate_geo_tags(ref_path, img_paths, jobs=None, chunksize=None):
+    """Copies the geotags of a reference image to many images, e.g. the
+    frames of a burst or bracket, which share one position.
+
+    The GPS IFD entries and Xmp attitude values of the reference are read
+    once and written to every image as they are stored, so rationals are
+    copied exactly and nothing is decoded or encoded per image. Other GPS
+    tags of the images are kept.
+
+    Arguments:
+        ref_path {str} -- Path to the reference image
+        img_paths {iterable} -- Paths to the images to tag
+
+    Keyword Arguments:
+        jobs {int} -- Number of worker processes, 1 runs in this process
+                      (default: {None}, one per cpu)
+        chunksize {int} -- Number of images per work unit (default: {None})
+
+    Raises:
+        ValueError -- if the reference is not a JPEG or MPO, or has no
+                      GPS tags
+
+    Returns:
+        list -- (img_path, written, error) per image, in input order.
+                written is True, or None on error. error is the exception
+                raised for that image, or None
+    """
+    with open(ref_path, 'rb') as f:
+        tiff, packet = _read_app1_segments(f)
+    exif = _read_gps_entries(tiff) if tiff is not None else None
+    if not exif:
+        raise ValueError('Reference image has no GPS tags')
+    xmp = _parse_attitude_xmp(packet) if packet is not None else {}
+
+    worker = functools.partial(_propagate_chunk, exif=exif, xmp=xmp)
+    return _run_batch(worker, list(img_paths), jobs, chunksize)
+
+
+def _run_batch(worker, items, jobs, chunksize):
+    """Split items into chunks and run worker on each chunk
+
+    Arguments:
+        worker {callable} -- Function taking a list of items and returning
+                             a list of results
+        items {list} -- Work items
+        jobs {int} -- Number of worker processes, or None for one per cpu
+        chunksize {int} -- Number of items per chunk, or None to pick one
+
+    Returns:
+        list -- Concatenated results of every chunk, in input order
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError('Invalid number of jobs')
+
+    if jobs == 1 or len(items) <= 1:
+        return worker(items)
+
+    if chunksize is None:
+        # Aim for a few chunks per worker so slow files don't leave cores idle
+        chunksize = max(1, min(64, len(items) // (jobs * 4)))
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(chunks))) as executor:
+        for chunk_results in executor.map(worker, chunks):
+            results.extend(chunk_results)
+    return results
+
+
+def _imap_batch(worker, items, jobs, chunksize=64):
+    """Like _run_batch, but streams items in and results out, keeping only
+    a few chunks per worker in flight
+
+    Arguments:
+        worker {callable} -- Function taking a list of items and returning
+                             a list of results
+        items {iterable} -- Work items
+        jobs {int} -- Number of worker processes
+
+    Keyword Arguments:
+        chunksize {int} -- Number of items per chunk (default: {64})
+
+    Yields:
+        object -- Results, in input order
+    """
+    if jobs < 1:
+        raise ValueError('Invalid number of jobs')
+
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if jobs == 1:
+        for chunk in chunks():
+            yield from worker(chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for chunk in chunks():
+            pending.append(executor.submit(worker, chunk))
+            if len(pending) >= 2 * jobs:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _write_chunk(records, writer=None):
+    """Write geotags for a chunk of records, collecting errors per record
+
+    Arguments:
+        records {list} -- Records as accepted by write_geo_tags_batch
+
+    Keyword Arguments:
+        writer {callable} -- Function writing the tags of an image
+                             (default: {write_geo_tag})
+
+    Returns:
+        list -- (img_path, written, error) per record
+    """
+    if writer is None:
+        writer = write_geo_tag
+    results = []
+    for record in records:
+        if isinstance(record, _InvalidRecord):
+            results.append((record.img_path, None, record.error))
+            continue
+        if isinstance(record, Mapping):
+            img_path = record.get('img_path')
+        else:
+            img_path = record[0] if record else None
+        try:
+            if isinstance(record, Mapping):
+                written = writer(**record)
+            else:
+                written = writer(*record)
+        except Exception as e:
+            results.append((img_path, None, e))
+        else:
+            results.append((img_path, written, None))
+    return results
+
+
+def _propagate_chunk(img_paths, exif, xmp):
+    """Write raw geotags to a chunk of images, collecting errors per image
+
+    Arguments:
+        img_paths {list} -- Paths to images
+        exif {_GPSEntries} -- GPS IFD entries of the reference image
+        xmp {dict} -- Xmp attitude values of the reference image
+
+    Returns:
+        list -- (img_path, written, error) per image
+    """
+    results = []
+    for img_path in img_paths:
+        try:
+            _write_segments(img_path, exif, xmp)
+            _invalidate_caches(img_path)
+        except Exception as e:
+            results.append((img_path, None, e))
+        else:
+            results.append((img_path, True, None))
+    return results
+
+
+def _read_chunk(img_paths, reader=None):
+    """Read geotags for a chunk of images, collecting errors per image
+
+    Arguments:
+        img_paths {list} -- Paths to images
+
+    Keyword Arguments:
+        reader {callable} -- Function reading the tags of an image
+                             (default: {read_geo_tag})
+
+    Returns:
+        list -- (img_path, tags, error) per image
+    """
+    if reader is None:
+        reader = read_geo_tag
+    results = []
+    for img_path in img_paths:
+        try:
+            results.append((img_path, reader(img_path), None))
+        except Exception as e:
+            results.append((img_path, None, e))
+    return results
+
+
+def _read_columns_chunk(img_paths, reader=None):
+    """Read geotags for a chunk of images into columns, so workers send
+    back a few arrays instead of a dict per image
+
+    Arguments:
+        img_paths {list} -- Paths to images
+
+    Keyword Arguments:
+        reader {callable} -- Function reading the tags of an image
+                             (default: {read_geo_tag})
+
+    Returns:
+        list -- The GeoTagColumns of the chunk
+    """
+    columns = GeoTagColumns()
+    for (img_path, tags, error) in _read_chunk(img_paths, reader):
+        columns.append(img_path, tags, error)
+    return [columns]
+
+
+class GeoTagColumns:
+    """Geotags of many images stored by field: one float64 array per
+    GeoTag field, NaN where a tag is missing or the read failed, with the
+    path and error of each image in parallel lists.
+
+    Columns are numpy arrays if numpy is installed, else array.array('d').
+    to_dict() can be passed straight to pandas.DataFrame.
+
+    Attributes:
+        paths {list} -- Path of each image
+        errors {list} -- Exception raised reading each image, or None
+        lat, lon, alt, hdg, roll, pitch, yaw -- Columns
+    """
+
+    fields = GeoTag.__slots__
+
+    def __init__(self):
+        self.paths = []
+        self.errors = []
+        self._columns = {field: array.array('d') for field in self.fields}
+
+    @classmethod
+    def concat(cls, parts):
+        """Join columns, in order
+
+        Arguments:
+            parts {iterable} -- GeoTagColumns to join
+
+        Returns:
+            GeoTagColumns -- Joined columns
+        """
+        result = cls()
+        for part in parts:
+            result.paths.extend(part.paths)
+            result.errors.extend(part.errors)
+            for field in cls.fields:
+                result._columns[field].extend(part._columns[field])
+        return result
+
+    def append(self, img_path, tags, error=None):
+        """Add the geotags of an image
+
+        Arguments:
+            img_path {str} -- Path to image
+            tags {dict or GeoTag} -- Geotags, or None if the read failed
+
+        Keyword Arguments:
+            error {Exception} -- Exception raised reading the image
+                                 (default: {None})
+        """
+        if isinstance(tags, GeoTag):
+            tags = tags.to_dict()
+        self.paths.append(img_path)
+        self.errors.append(error)
+        for field in self.fields:
+            value = tags.get(field) if tags is not None else None
+            self._columns[field].append(value if value is not None else math.nan)
+
+    def column(self, field):
+        """Get the values of a field
+
+        Arguments:
+            field {str} -- GeoTag field
+
+        Returns:
+            array -- Copy of the float64 values, a numpy array if numpy is
+                     installed, so appends and edits don't affect each other
+        """
+        values = self._columns[field]
+        if _numpy() is not None:
+            return np.array(values, dtype=np.float64)
+        return array.array('d', values)
+
+    def record(self, i):
+        """Get the geotags of one image
+
+        Arguments:
+            i {int} -- Index of the image
+
+        Returns:
+            GeoTag -- Geotags, with None for NaN values
+        """
+        values = [self._columns[field][i] for field in self.fields]
+        return GeoTag(*[None if math.isnan(value) else value for value in values])
+
+    def to_dict(self):
+        """Get the paths and columns
+
+        Returns:
+            dict -- path list and one column per field
+        """
+        columns = {'path': self.paths}
+        columns.update((field, self.column(field)) for field in self.fields)
+        return columns
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getattr__(self, name):
+        if name in GeoTagColumns.fields:
+            return self.column(name)
+        raise AttributeError(name)
+
+
+# --------------------------------------------------
+# Export Functions
+# --------------------------------------------------
+# Number of capture times sorted in memory before a sorted run is spilled
+# to a temporary file
+_EXPORT_RUN_SIZE = 1 << 16
+
+_EXPORT_FORMATS = ['geojson', 'gpx', 'kml']
+
+
+def export_geo_tags(img_paths, f, export_format='geojson', jobs=1):
+    """Writes the geotags of images as GeoJSON, GPX or KML, ordered by
+    capture time. Output is written as images are read, and memory use
+    does not grow with the number of images.
+
+    Images that fail to read or have no latitude/longitude are left out.
+
+    Arguments:
+        img_paths {iterable} -- Paths to images
+        f {file} -- Text file to write to
+
+    Keyword Arguments:
+        export_format {str} -- 'geojson', 'gpx' or 'kml' (default: {'geojson'})
+        jobs {int} -- Number of worker processes reading images (default: {1})
+
+    Raises:
+        ValueError -- if the format is unknown
+
+    Returns:
+        int -- Number of images written
+    """
+    count = 0
+    for (chunk, n) in _iter_export(img_paths, export_format, jobs):
+        f.write(chunk)
+        count += n
+    return count
+
+
+def iter_export_geo_tags(img_paths, export_format='geojson', jobs=1):
+    """Same as export_geo_tags, but yields the output in pieces instead of
+    writing it to a file
+
+    Arguments:
+        img_paths {iterable} -- Paths to images
+
+    Keyword Arguments:
+        export_format {str} -- 'geojson', 'gpx' or 'kml' (default: {'geojson'})
+        jobs {int} -- Number of worker processes reading images (default: {1})
+
+    Raises:
+        ValueError -- if the format is unknown
+
+    Yields:
+        str -- Output
+    """
+    for (chunk, _) in _iter_export(img_paths, export_format, jobs):
+        yield chunk
+
+
+def iter_geo_tags_by_time(img_paths, jobs=1):
+    """Reads geotags from images in order of capture time. Images without
+    a capture time come last, in input order.
+
+    Capture times are sorted in memory in runs, spilled to temporary files
+    and merged, so only a bounded number of images is held at once.
+
+    Arguments:
+        img_paths {iterable} -- Paths to images
+
+    Keyword Arguments:
+        jobs {int} -- Number of worker processes reading images (default: {1})
+
+    Yields:
+        tuple -- (img_path, capture_time, tags, error) per image.
+                 capture_time is a datetime or None, tags the dict returned
+                 by read_geo_tag or None on error
+    """
+    times = deque()
+
+    def paths():
+        for (img_path, capture_time) in _sort_by_capture_time(img_paths, jobs):
+            times.append(capture_time)
+            yield img_path
+
+    for (img_path, tags, error) in _imap_batch(_read_chunk, paths(), jobs):
+        yield (img_path, times.popleft(), tags, error)
+
+
+def _iter_export(img_paths, export_format, jobs):
+    """Yield (output, number of images in it) pieces of an export"""
+    if export_format not in _EXPORT_FORMATS:
+        raise ValueError('Unknown export format {!r}'.format(export_format))
+    header, footer, feature = {
+        'geojson': (_GEOJSON_HEADER, _GEOJSON_FOOTER, _geojson_feature),
+        'gpx': (_GPX_HEADER, _GPX_FOOTER, _gpx_point),
+        'kml': (_KML_HEADER, _KML_FOOTER, _kml_placemark),
+    }[export_format]
+
+    yield (header, 0)
+    first = True
+    for (img_path, capture_time, tags, error) in iter_geo_tags_by_time(img_paths, jobs):
+        if error is not None or tags['lat'] is None or tags['lon'] is None:
+            continue
+        # GeoJSON features are comma separated
+        separator = ',\n' if export_format == 'geojson' and not first else ''
+        first = False
+        yield (separator + feature(img_path, capture_time, tags), 1)
+    yield (footer, 0)
+
+
+_GEOJSON_HEADER = '{"type": "FeatureCollection", "features": [\n'
+_GEOJSON_FOOTER = '\n]}\n'
+
+# GPX has no element for the direction the camera faces (magvar is the
+# magnetic variation), so the heading goes in an extension element
+_GPX_EXTENSION_NS = 'geotag/'
+_GPX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<gpx version="1.1" creator="geotag" xmlns="http://www.topografix.com/GPX/1/1"'
+               ' xmlns:geotag="' + _GPX_EXTENSION_NS + '">\n'
+               ' <trk>\n'
+               '  <trkseg>\n')
+_GPX_FOOTER = ('  </trkseg>\n'
+               ' </trk>\n'
+               '</gpx>\n')
+
+_KML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+               ' <Document>\n')
+_KML_FOOTER = (' </Document>\n'
+               '</kml>\n')
+
+
+def _geojson_feature(img_path, capture_time, tags):
+    """Format the geotags of an image as a GeoJSON Point feature"""
+    coordinates = [tags['lon'], tags['lat']]
+    if tags['alt'] is not None:
+        coordinates.append(tags['alt'])
+    properties = {'path': img_path,
+                  'time': capture_time.isoformat() if capture_time is not None else None}
+    properties.update((field, tags[field]) for field in ['alt', 'hdg', 'roll', 'pitch', 'yaw'])
+    return json.dumps({
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': coordinates},
+        'properties': properties,
+    })
+
+
+def _gpx_point(img_path, capture_time, tags):
+    """Format the geotags of an image as a GPX track point"""
+    point = '   <trkpt lat="{}" lon="{}">'.format(tags['lat'], tags['lon'])
+    if tags['alt'] is not None:
+        point += '<ele>{}</ele>'.format(tags['alt'])
+    if capture_time is not None:
+        point += '<time>{}</time>'.format(capture_time.isoformat())
+    point += '<name>{}</name>'.format(_xml_escape(os.path.basename(img_path)))
+    if tags['hdg'] is not None:
+        point += '<extensions><geotag:heading>{}</geotag:heading></extensions>'.format(tags['hdg'])
+    return point + '</trkpt>\n'
+
+
+def _kml_placemark(img_path, capture_time, tags):
+    """Format the geotags of an image as a KML Placemark"""
+    placemark = '  <Placemark><name>{}</name>'.format(_xml_escape(os.path.basename(img_path)))
+    placemark += '<description>{}</description>'.format(_xml_escape(img_path))
+    if capture_time is not None:
+        placemark += '<TimeStamp><when>{}</when></TimeStamp>'.format(capture_time.isoformat())
+    if tags['alt'] is not None:
+        placemark += '<Point><altitudeMode>absolute</altitudeMode><coordinates>{},{},{}'.format(
+            tags['lon'], tags['lat'], tags['alt'])
+    else:
+        placemark += '<Point><coordinates>{},{}'.format(tags['lon'], tags['lat'])
+    return placemark + '</coordinates></Point></Placemark>\n'
+
+
+def _xml_escape(text):
+    """Escape &, < and > in XML text"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _sort_by_capture_time(img_paths, jobs, run_size=_EXPORT_RUN_SIZE):
+    """Sort images by capture time with an external merge sort
+
+    Arguments:
+        img_paths {iterable} -- Paths to images
+        jobs {int} -- Number of worker processes reading capture times
+
+    Keyword Arguments:
+        run_size {int} -- Images sorted in memory at a time
+                          (default: {_EXPORT_RUN_SIZE})
+
+    Yields:
+        tuple -- (img_path, capture_time) in order of capture time, then
+                 input order. Images without a capture time come last
+    """
+    runs = []
+    run = []
+    try:
+        items = _imap_batch(_capture_time_chunk, img_paths, jobs)
+        for (i, (img_path, timestamp)) in enumerate(items):
+            # Sort key, then the path
+            run.append((timestamp is None, timestamp or 0.0, i, img_path))
+            if len(run) == run_size:
+                runs.append(_spill_run(run))
+                run = []
+        run.sort()
+        merged = heapq.merge(run, *[_read_run(f) for f in runs]) if runs else run
+
+        for (missing, timestamp, _, img_path) in merged:
+            capture_time = None
+            if not missing:
+                capture_time = datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+            yield (img_path, capture_time)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _spill_run(run):
+    """Sort a run and write it to a temporary file
+
+    Arguments:
+        run {list} -- Sort items
+
+    Returns:
+        file -- Temporary file, positioned at its start
+    """
+    run.sort()
+    f = tempfile.TemporaryFile('w+', encoding='utf-8')
+    for item in run:
+        f.write(json.dumps(item) + '\n')
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    """Read back the items of a spilled run
+
+    Arguments:
+        f {file} -- File written by _spill_run
+
+    Yields:
+        tuple -- Sort items
+    """
+    for line in f:
+        yield tuple(json.loads(line))
+
+
+def _capture_time_chunk(img_paths):
+    """Read capture times for a chunk of images
+
+    Arguments:
+        img_paths {list} -- Paths to images
+
+    Returns:
+        list -- (img_path, timestamp) per image, timestamp being None if
+                the image has no capture time or cannot be read
+    """
+    results = []
+    for img_path in img_paths:
+        try:
+            timestamp = _timestamp(read_capture_time(img_path))
+        except (OSError, ValueError):
+            timestamp = None
+        results.append((img_path, timestamp))
+    return results
+
+
+# --------------------------------------------------
+# Index Functions
+# --------------------------------------------------
+# Mean radius of the earth, in metres
+_EARTH_RADIUS = 6371008.8
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    lat REAL, lon REAL, alt REAL, hdg REAL, roll REAL, pitch REAL, yaw REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS images_rtree USING rtree (
+    id, min_lat, max_lat, min_lon, max_lon
+);
+"""
+_INDEX_FIELDS = ['lat', 'lon', 'alt', 'hdg', 'roll', 'pitch', 'yaw']
+
+
+class GeoTagIndex:
+    """Persistent spatial index of the geotags of an image library,
+    stored in SQLite with an R-tree over lat/lon
+
+    Arguments:
+        db_path {str} -- Path to index database, created if missing
+    """
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path)
+        self._conn.executescript(_INDEX_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the index database"""
+        self._conn.close()
+
+    def update(self, img_paths, jobs=1):
+        """Add images to the index, rereading only images that are new or
+        whose mtime or size changed since they were indexed
+
+        Arguments:
+            img_paths {iterable} -- Paths to images
+
+        Keyword Arguments:
+            jobs {int} -- Number of worker processes for reading (default: {1})
+
+        Returns:
+            list -- (img_path, error) for each image that was reread, error
+                    is the exception raised reading it, or None
+        """
+        stale = []
+        for img_path in img_paths:
+            path = os.path.abspath(img_path)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                stale.append((path, None, e))
+                continue
+            row = self._conn.execute('SELECT mtime_ns, size FROM images WHERE path = ?',
+                                     (path,)).fetchone()
+            if row != (st.st_mtime_ns, st.st_size):
+                stale.append((path, st, None))
+
+        results = read_geo_tags_batch([path for (path, st, _) in stale if st is not None], jobs)
+        results = iter(results)
+
+        updated = []
+        with self._conn:
+            for (path, st, error) in stale:
+                tags = None
+                if error is None:
+                    (_, tags, error) = next(results)
+                if error is not None:
+                    self._remove(path)
+                else:
+                    self._upsert(path, st, tags)
+                updated.append((path, error))
+        return updated
+
+    def prune(self):
+        """Remove images that no longer exist from the index
+
+        Returns:
+            int -- Number of images removed
+        """
+        missing = [path for (path,) in self._conn.execute('SELECT path FROM images')
+                   if not os.path.exists(path)]
+        with self._conn:
+            for path in missing:
+                self._remove(path)
+        return len(missing)
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Find images inside a bounding box
+
+        Arguments:
+            min_lat {float} -- southern edge, in decimal degrees
+            min_lon {float} -- western edge, in decimal degrees
+            max_lat {float} -- northern edge, in decimal degrees
+            max_lon {float} -- eastern edge, in decimal degrees. Boxes
+                               crossing the antimeridian have
+                               max_lon < min_lon
+
+        Returns:
+            list -- (img_path, tags) per image, with tags as returned
+                    by read_geo_tag
+        """
+        _check_lat(min_lat)
+        _check_lat(max_lat)
+        _check_lon(min_lon)
+        _check_lon(max_lon)
+        if max_lon < min_lon:
+            lon_ranges = [(min_lon, 180), (-180, max_lon)]
+        else:
+            lon_ranges = [(min_lon, max_lon)]
+
+        results = []
+        for (west, east) in lon_ranges:
+            results.extend(self._query(min_lat, max_lat, west, east))
+        return results
+
+    def query_radius(self, lat, lon, radius):
+        """Find images within a distance of a point
+
+        Arguments:
+            lat {float} -- latitude, in decimal degrees
+            lon {float} -- longitude, in decimal degrees
+            radius {float} -- distance, in metres
+
+        Returns:
+            list -- (img_path, tags) per image, nearest first, with tags
+                    as returned by read_geo_tag
+        """
+        _check_lat(lat)
+        _check_lon(lon)
+
+        # Search the bounding box of the circle, then filter on distance
+        dlat = math.degrees(radius / _EARTH_RADIUS)
+        min_lat = max(lat - dlat, -90)
+        max_lat = min(lat + dlat, 90)
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        if min_lat == -90 or max_lat == 90 or radius >= cos_lat * math.pi * _EARTH_RADIUS:
+            lon_ranges = [(-180, 180)]
+        else:
+            dlon = math.degrees(radius / (_EARTH_RADIUS * cos_lat))
+            lon_ranges = [(max(lon - dlon, -180), min(lon + dlon, 180))]
+            if lon - dlon < -180:
+                lon_ranges.append((lon - dlon + 360, 180))
+            if lon + dlon > 180:
+                lon_ranges.append((-180, lon + dlon - 360))
+
+        results = []
+        for (west, east) in lon_ranges:
+            for (path, tags) in self._query(min_lat, max_lat, west, east):
+                distance = _haversine(lat, lon, tags['lat'], tags['lon'])
+                if distance <= radius:
+                    results.append((distance, path, tags))
+        results.sort(key=lambda result: result[0])
+        return [(path, tags) for (_, path, tags) in results]
+
+    def _query(self, min_lat, max_lat, min_lon, max_lon):
+        rows = self._conn.execute(
+            'SELECT images.path, ' + ', '.join('images.' + f for f in _INDEX_FIELDS)
+            + ' FROM images_rtree JOIN images ON images.id = images_rtree.id'
+            ' WHERE images_rtree.min_lat <= ? AND images_rtree.max_lat >= ?'
+            ' AND images_rtree.min_lon <= ? AND images_rtree.max_lon >= ?'
+            # The R-tree stores 32 bit floats, so check the exact values too
+            ' AND images.lat BETWEEN ? AND ? AND images.lon BETWEEN ? AND ?',
+            (max_lat, min_lat, max_lon, min_lon, min_lat, max_lat, min_lon, max_lon))
+        return [(row[0], dict(zip(_INDEX_FIELDS, row[1:]))) for row in rows]
+
+    def _upsert(self, path, st, tags):
+        self._conn.execute(
+            'INSERT INTO images (path, mtime_ns, size, ' + ', '.join(_INDEX_FIELDS) + ')'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET'
+            ' mtime_ns = excluded.mtime_ns, size = excluded.size, '
+            + ', '.join('{0} = excluded.{0}'.format(f) for f in _INDEX_FIELDS),
+            [path, st.st_mtime_ns, st.st_size] + [tags[f] for f in _INDEX_FIELDS])
+        (row_id,) = self._conn.execute('SELECT id FROM images WHERE path = ?', (path,)).fetchone()
+        if tags['lat'] is not None and tags['lon'] is not None:
+            self._conn.execute('INSERT OR REPLACE INTO images_rtree VALUES (?, ?, ?, ?, ?)',
+                               (row_id, tags['lat'], tags['lat'], tags['lon'], tags['lon']))
+        else:
+            self._conn.execute('DELETE FROM images_rtree WHERE id = ?', (row_id,))
+
+    def _remove(self, path):
+        row = self._conn.execute('SELECT id FROM images WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM images_rtree WHERE id = ?', row)
+            self._conn.execute('DELETE FROM images WHERE id = ?', row)
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Get the great circle distance between two points
+
+    Arguments:
+        lat1 {float} -- latitude of first point, in decimal degrees
+        lon1 {float} -- longitude of first point, in decimal degrees
+        lat2 {float} -- latitude of second point, in decimal degrees
+        lon2 {float} -- longitude of second point, in decimal degrees
+
+    Returns:
+        float -- distance, in metres
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+# --------------------------------------------------
+# Queue Functions
+# --------------------------------------------------
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    record TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+_QUEUE_STATES = ['pending', 'claimed', 'done', 'failed']
+
+# Positional arguments of write_geo_tag, to store tuple records as dicts
+_WRITE_ARGS = ['img_path', 'lat', 'lon', 'alt_abs', 'hdg', 'roll', 'pitch', 'yaw']
+
+
+class GeoTagQueue:
+    """Durable queue of write_geo_tag jobs, stored in SQLite, that any
+    number of processes or hosts can work through together.
+
+    Workers claim jobs in batches under a lease. Jobs whose lease expires
+    without being completed (e.g. the worker crashed) are handed out
+    again, and jobs that failed or expired max_attempts times are marked
+    failed. A job is only ever completed by the worker holding its lease,
+    so a restarted run picks up exactly the unfinished jobs.
+
+    The database can live on a shared filesystem if it supports POSIX
+    locks. Leases use the clock of each host, so hosts should be in sync.
+
+    Arguments:
+        db_path {str} -- Path to queue database, created if missing
+
+    Keyword Arguments:
+        lease {float} -- Seconds a claim is valid for (default: {300})
+        max_attempts {int} -- Attempts before a job is marked failed
+                              (default: {3})
+        worker {str} -- Name of this worker (default: {None}, host:pid)
+    """
+
+    def __init__(self, db_path, lease=300, max_attempts=3, worker=None):
+        if lease <= 0:
+            raise ValueError('Invalid lease')
+        if max_attempts < 1:
+            raise ValueError('Invalid number of attempts')
+        self.db_path = db_path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        if worker is None:
+            import socket
+            worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.worker = worker
+        # Transactions are managed explicitly, see _transaction
+        self._conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        with self._transaction():
+            for statement in _QUEUE_SCHEMA.split(';'):
+                if statement.strip():
+                    self._conn.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the queue database"""
+        self._conn.close()
+
+    def put(self, records):
+        """Add write_geo_tag jobs to the queue
+
+        Arguments:
+            records {iterable} -- Records as accepted by write_geo_tags_batch
+
+        Returns:
+            int -- Number of jobs added
+        """
+        rows = [(json.dumps(_record_kwargs(record)),) for record in records]
+        with self._transaction():
+            self._conn.executemany('INSERT INTO jobs (record) VALUES (?)', rows)
+        return len(rows)
+
+    def claim(self, n=16):
+        """Claim pending jobs, and jobs whose lease expired
+
+        Keyword Arguments:
+            n {int} -- Maximum number of jobs to claim (default: {16})
+
+        Returns:
+            list -- (job_id, write_geo_tag keyword arguments) per job
+        """
+        now = time.time()
+        with self._transaction():
+            self._conn.execute("UPDATE jobs SET state = 'failed', error = 'Lease expired'"
+                               " WHERE state = 'claimed' AND lease_until < ? AND attempts >= ?",
+                               (now, self.max_attempts))
+            rows = self._conn.execute("SELECT id, record FROM jobs WHERE state = 'pending'"
+                                      " OR (state = 'claimed' AND lease_until < ?)"
+                                      " ORDER BY id LIMIT ?", (now, n)).fetchall()
+            self._conn.executemany("UPDATE jobs SET state = 'claimed', worker = ?,"
+                                   " lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                   [(self.worker, now + self.lease, job_id)
+                                    for (job_id, _) in rows])
+        return [(job_id, json.loads(record)) for (job_id, record) in rows]
+
+    def renew(self, job_ids):
+        """Extend the lease of claimed jobs
+
+        Arguments:
+            job_ids {iterable} -- Ids of jobs claimed by this worker
+
+        Returns:
+            int -- Number of jobs whose lease was extended
+        """
+        lease_until = time.time() + self.lease
+        with self._transaction():
+            return sum(self._conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ?"
+                                          " AND state = 'claimed' AND worker = ?",
+                                          (lease_until, job_id, self.worker)).rowcount
+                       for job_id in job_ids)
+
+    def complete(self, results):
+        """Record the outcome of claimed jobs. Failed jobs are retried
+        until they have been attempted max_attempts times.
+
+        Arguments:
+            results {iterable} -- (job_id, error) per job, error being None
+                                  or the exception raised running it
+
+        Returns:
+            int -- Number of jobs recorded. Jobs no longer claimed by this
+                   worker, because their lease expired, are ignored
+        """
+        count = 0
+        with self._transaction():
+            for (job_id, error) in results:
+                if error is None:
+                    cursor = self._conn.execute(
+                        "UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL"
+                        " WHERE id = ? AND state = 'claimed' AND worker = ?",
+                        (job_id, self.worker))
+                else:
+                    cursor = self._conn.execute(
+                        "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed'"
+                        " ELSE 'pending' END, lease_until = NULL, error = ?"
+                        " WHERE id = ? AND state = 'claimed' AND worker = ?",
+                        (self.max_attempts, '{}: {}'.format(type(error).__name__, error),
+                         job_id, self.worker))
+                count += cursor.rowcount
+        return count
+
+    def retry_failed(self):
+        """Put failed jobs back in the queue with their attempts reset
+
+        Returns:
+            int -- Number of jobs requeued
+        """
+        with self._transaction():
+            return self._conn.execute("UPDATE jobs SET state = 'pending', attempts = 0"
+                                      " WHERE state = 'failed'").rowcount
+
+    def failed(self):
+        """Get the failed jobs
+
+        Returns:
+            list -- (job_id, write_geo_tag keyword arguments, error) per job
+        """
+        rows = self._conn.execute("SELECT id, record, error FROM jobs WHERE state = 'failed'"
+                                  " ORDER BY id")
+        return [(job_id, json.loads(record), error) for (job_id, record, error) in rows]
+
+    def stats(self):
+        """Count jobs by state
+
+        Returns:
+            dict -- Number of pending, claimed, done and failed jobs
+        """
+        counts = dict.fromkeys(_QUEUE_STATES, 0)
+        counts.update(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        return counts
+
+    def run(self, jobs=1, batch=16, skip_unchanged=False, writer=None):
+        """Work through the queue until no job can be claimed
+
+        Keyword Arguments:
+            jobs {int} -- Number of worker processes, each claiming jobs on
+                          its own (default: {1}, this process)
+            batch {int} -- Jobs claimed at a time (default: {16})
+            skip_unchanged {bool} -- Passed to write_geo_tag (default: {False})
+            writer {callable} -- Function writing the tags of an image
+                                 (default: {write_geo_tag})
+
+        Returns:
+            dict -- Number of jobs done and failed by the workers
+        """
+        if jobs < 1:
+            raise ValueError('Invalid number of jobs')
+        if writer is None:
+            writer = write_geo_tag
+        if skip_unchanged:
+            writer = functools.partial(writer, skip_unchanged=True)
+
+        if jobs == 1:
+            return self._work(batch, writer)
+
+        counts = {'done': 0, 'failed': 0}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_run_queue, self.db_path, self.lease, self.max_attempts,
+                                       '{}/{}'.format(self.worker, i), batch, writer)
+                       for i in range(jobs)]
+            for future in futures:
+                for (key, value) in future.result().items():
+                    counts[key] += value
+        return counts
+
+    def _work(self, batch, writer):
+        counts = {'done': 0, 'failed': 0}
+        while True:
+            claimed = self.claim(batch)
+            if not claimed:
+                return counts
+            results = []
+            for (job_id, kwargs) in claimed:
+                try:
+                    writer(**kwargs)
+                except Exception as e:
+                    results.append((job_id, e))
+                    counts['failed'] += 1
+                else:
+                    results.append((job_id, None))
+                    counts['done'] += 1
+            self.complete(results)
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers
+        # can never select the same jobs to claim
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+
+def _run_queue(db_path, lease, max_attempts, worker, batch, writer):
+    """Work through a queue in a worker process
+
+    Arguments:
+        db_path {str} -- Path to queue database
+        lease {float} -- Seconds a claim is valid for
+        max_attempts {int} -- Attempts before a job is marked failed
+        worker {str} -- Name of the worker
+        batch {int} -- Jobs claimed at a time
+        writer {callable} -- Function writing the tags of an image
+
+    Returns:
+        dict -- Number of jobs done and failed
+    """
+    with GeoTagQueue(db_path, lease, max_attempts, worker) as queue:
+        return queue._work(batch, writer)
+
+
+def _record_kwargs(record):
+    """Convert a write record to write_geo_tag keyword arguments that can
+    be stored as JSON
+
+    Arguments:
+        record {dict or tuple} -- Record as accepted by write_geo_tags_batch
+
+    Returns:
+        dict -- write_geo_tag keyword arguments
+    """
+    if isinstance(record, Mapping):
+        kwargs = dict(record)
+    else:
+        kwargs = dict(zip(_WRITE_ARGS, record))
+    if isinstance(kwargs.get('lat'), GeoTag):
+        tag = kwargs.pop('lat')
+        kwargs.update(lat=tag.lat, lon=tag.lon, alt_abs=tag.alt, hdg=tag.hdg, roll=tag.roll,
+                      pitch=tag.pitch, yaw=tag.yaw)
+    return kwargs
+
+
+# --------------------------------------------------
+# Cache Functions
+# --------------------------------------------------
+# Caches in this process, so writes can invalidate their entries
+_caches = weakref.WeakSet()
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS geo_tags (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    tags TEXT NOT NULL
+)
+"""
+
+
+class GeoTagCache:
+    """LRU cache of read_geo_tag results, keyed on the path, inode, mtime
+    and size of each image, so a changed file is always reread.
+
+    Writes through write_geo_tag and write_geo_tag_fast in this process
+    drop the entry of the image from every cache.
+
+    Keyword Arguments:
+        maxsize {int} -- Number of images to keep in memory (default: {1024})
+        db_path {str} -- Path to SQLite database backing the cache on disk,
+                         created if missing (default: {None}, memory only)
+        reader {callable} -- Function reading the tags of an image
+                             (default: {read_geo_tag})
+    """
+
+    def __init__(self, maxsize=1024, db_path=None, reader=None):
+        if maxsize < 1:
+            raise ValueError('Invalid cache size')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._reader = reader if reader is not None else read_geo_tag
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path is not None:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(_CACHE_SCHEMA)
+        _caches.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the on disk store"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def read(self, img_path):
+        """Reads geotags from an image, or from the cache if the image
+        has not changed since it was cached
+
+        Arguments:
+            img_path {str} -- Path to image
+
+        Returns:
+            dict -- Same as read_geo_tag
+        """
+        path = os.path.abspath(img_path)
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return dict(entry[1])
+
+            tags = self._load(path, key)
+            if tags is not None:
+                self.hits += 1
+                self._put(path, key, tags)
+                return dict(tags)
+            self.misses += 1
+
+        tags = self._reader(img_path)
+
+        with self._lock:
+            self._put(path, key, tags)
+            self._store(path, key, tags)
+        return dict(tags)
+
+    def invalidate(self, img_path):
+        """Drop the cached tags of an image
+
+        Arguments:
+            img_path {str} -- Path to image
+        """
+        path = os.path.abspath(img_path)
+        with self._lock:
+            self._entries.pop(path, None)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM geo_tags WHERE path = ?', (path,))
+
+    def clear(self):
+        """Drop all cached tags and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM geo_tags')
+
+    def stats(self):
+        """Get the cache counters
+
+        Returns:
+            dict -- hits, misses, evictions, size and maxsize
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def _put(self, path, key, tags):
+        self._entries[path] = (key, tags)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, path, key):
+        if self._conn is None:
+            return None
+        row = self._conn.execute('SELECT inode, mtime_ns, size, tags FROM geo_tags'
+                                 ' WHERE path = ?', (path,)).fetchone()
+        if row is None or tuple(row[:3]) != key:
+            return None
+        return json.loads(row[3])
+
+    def _store(self, path, key, tags):
+        if self._conn is None:
+            return
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO geo_tags VALUES (?, ?, ?, ?, ?)',
+                               (path,) + key + (json.dumps(tags),))
+
+
+def _invalidate_caches(img_path):
+    """Drop the cached tags of an image from every cache in this process
+
+    Arguments:
+        img_path {str} -- Path to image
+    """
+    for cache in list(_caches):
+        cache.invalidate(img_path)
+
+
+# --------------------------------------------------
+# Profiling Functions
+# --------------------------------------------------
+# Stage collectors active in the current thread or task. Stages are only
+# timed while this is not empty
+_collectors = contextvars.ContextVar('geotag_collectors', default=())
+
+# Upper bounds of the histogram buckets, in seconds (1us to ~17min)
+_HISTOGRAM_BOUNDS = [1e-6 * 2 ** i for i in range(31)]
+
+
+class StageStats:
+    """Collects the duration and bytes of each stage of read_geo_tag and
+    write_geo_tag, aggregated into a histogram per stage
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, nbytes=0):
+        """Record one run of a stage
+
+        Arguments:
+            stage {str} -- Stage name, e.g. 'read_geo_tag.metadata_read'
+            seconds {float} -- Duration of the stage
+
+        Keyword Arguments:
+            nbytes {int} -- Bytes read or written by the stage (default: {0})
+        """
+        bucket = bisect.bisect_left(_HISTOGRAM_BOUNDS, seconds)
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {
+                    'count': 0,
+                    'seconds': 0.0,
+                    'min': seconds,
+                    'max': seconds,
+                    'bytes': 0,
+                    'buckets': [0] * (len(_HISTOGRAM_BOUNDS) + 1),
+                }
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+            stats['bytes'] += nbytes
+            stats['buckets'][bucket] += 1
+
+    def stages(self):
+        """Get the names of the recorded stages
+
+        Returns:
+            list -- Stage names, sorted
+        """
+        with self._lock:
+            return sorted(self._stages)
+
+    def percentile(self, stage, p):
+        """Estimate a percentile of the duration of a stage from its histogram
+
+        Arguments:
+            stage {str} -- Stage name
+            p {float} -- Percentile, between 0 and 100
+
+        Returns:
+            float -- Upper bound of the bucket holding the percentile, in seconds
+        """
+        with self._lock:
+            stats = self._stages[stage]
+            rank = stats['count'] * p / 100
+            seen = 0
+            for (bound, count) in zip(_HISTOGRAM_BOUNDS, stats['buckets']):
+                seen += count
+                if seen >= rank and seen > 0:
+                    return min(bound, stats['max'])
+            return stats['max']
+
+    def to_dict(self):
+        """Export the stats
+
+        Returns:
+            dict -- Per stage count, total/mean/min/max seconds, bytes, and a
+                    cumulative histogram as [upper bound in seconds, count]
+                    pairs, the last bound being null for infinity
+        """
+        with self._lock:
+            exported = {}
+            for (stage, stats) in sorted(self._stages.items()):
+                histogram = []
+                total = 0
+                for (bound, count) in zip(_HISTOGRAM_BOUNDS + [None], stats['buckets']):
+                    total += count
+                    histogram.append([bound, total])
+                exported[stage] = {
+                    'count': stats['count'],
+                    'seconds': stats['seconds'],
+                    'mean': stats['seconds'] / stats['count'],
+                    'min': stats['min'],
+                    'max': stats['max'],
+                    'bytes': stats['bytes'],
+                    'histogram': histogram,
+                }
+            return exported
+
+
+@contextmanager
+def collect_stages(collector=None):
+    """Time the stages of read_geo_tag and write_geo_tag while in the context.
+    Only stages run by the current thread (or asyncio task) are collected.
+
+    Keyword Arguments:
+        collector {object} -- Object with a record(stage, seconds, nbytes)
+                              method (default: {None}, a new StageStats)
+
+    Yields:
+        object -- The collector
+    """
+    if collector is None:
+        collector = StageStats()
+    token = _collectors.set(_collectors.get() + (collector,))
+    try:
+        yield collector
+    finally:
+        _collectors.reset(token)
+
+
+def _stage_start():
+    """Start timing a stage
+
+    Returns:
+        float -- Start time, or None if no collector is active
+    """
+    return time.perf_counter() if _collectors.get() else None
+
+
+def _stage_end(stage, start, nbytes=0):
+    """Finish timing a stage and record it with the active collectors
+
+    Arguments:
+        stage {str} -- Stage name
+        start {float} -- Start time from _stage_start, or None
+
+    Keyword Arguments:
+        nbytes {int} -- Bytes read or written by the stage (default: {0})
+
+    Returns:
+        float -- Start time of the next stage, or None if not timing
+    """
+    if start is None:
+        return None
+    end = time.perf_counter()
+    for collector in _collectors.get():
+        collector.record(stage, end - start, nbytes)
+    # Don't count the time spent recording towards the next stage
+    return time.perf_counter()
+
+
+class _CountingFile:
+    """Wraps a binary file to count the bytes read from it"""
+
+    def __init__(self, f):
+        self._f = f
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.nbytes += len(data)
+        return data
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        self.nbytes += n or 0
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def _counting(f, start):
+    """Count the bytes read from a file while a stage is being timed
+
+    Arguments:
+        f {file} -- Binary file
+        start {float} -- Start time from _stage_start, or None
+
+    Returns:
+        file -- f, wrapped in a _CountingFile if timing
+    """
+    return f if start is None else _CountingFile(f)
+
+
+def _bytes_read(f):
+    """Get the bytes read from a file returned by _counting
+
+    Arguments:
+        f {file} -- File returned by _counting
+
+    Returns:
+        int -- Bytes read, or 0 if the file isn't counted
+    """
+    return f.nbytes if isinstance(f, _CountingFile) else 0
+
+
+def _file_size(path, start):
+    """Get the size of a file while a stage is being timed
+
+    Arguments:
+        path {str} -- Path to file
+        start {float} -- Start time from _stage_start, or None
+
+    Returns:
+        int -- Size of the file, or 0 if not timing
+    """
+    return 0 if start is None else os.path.getsize(path)
+
+
+# --------------------------------------------------
+# Async Functions
+# --------------------------------------------------
+# Default tagger of each event loop, used by the module level async functions
+_async_taggers = weakref.WeakKeyDictionary()
+
+
+class AsyncGeoTagger:
+    """Runs geotag reads and writes on an executor so they do not block
+    the event loop, with at most max_open images being read or written at
+    a time.
+
+    Cancelling a call that is still waiting for a slot, or whose work has
+    not started, drops it. Work already running in the executor cannot be
+    interrupted: it finishes in the background and holds its slot until
+    then, so the limit on open files is kept.
+
+    Keyword Arguments:
+        max_open {int} -- Images read or written at a time (default: {16})
+        executor {Executor} -- Executor to run on (default: {None}, a
+                               thread pool of max_open threads owned by
+                               the tagger)
+        reader {callable} -- Function reading the tags of an image
+                             (default: {read_geo_tag})
+        writer {callable} -- Function writing the tags of an image
+                             (default: {write_geo_tag})
+    """
+
+    def __init__(self, max_open=16, executor=None, reader=None, writer=None):
+        import asyncio
+
+        if max_open < 1:
+            raise ValueError('Invalid number of open images')
+        self.max_open = max_open
+        self._executor = executor
+        self._own_executor = executor is None
+        self._reader = reader
+        self._writer = writer
+        self._semaphore = asyncio.Semaphore(max_open)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Shut down the executor if it is owned by the tagger, waiting for
+        running work to finish"""
+        if self._own_executor and self._executor is not None:
+            import asyncio
+
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    async def read(self, img_path):
+        """Reads geotags from an image
+
+        Arguments:
+            img_path {str} -- Path to image
+
+        Returns:
+            dict -- Same as read_geo_tag
+        """
+        return await self._run(self._reader or read_geo_tag, img_path)
+
+    async def write(self, img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None):
+        """Writes geotags to an image, same as write_geo_tag"""
+        return await self._run(self._writer or write_geo_tag,
+                               img_path, lat, lon, alt_abs, hdg, roll, pitch, yaw)
+
+    async def read_many(self, img_paths):
+        """Reads geotags from many images, yielding results as they complete
+
+        Arguments:
+            img_paths {iterable} -- Paths to images, may be an async iterable
+
+        Yields:
+            tuple -- (img_path, tags, error) per image, error being None or
+                     the exception raised
+        """
+        async for result in self._as_completed(self.read, img_paths):
+            yield result
+
+    async def write_many(self, records):
+        """Writes geotags to many images, yielding results as they complete
+
+        Arguments:
+            records {iterable} -- Records as accepted by write_geo_tags_batch,
+                                  may be an async iterable
+
+        Yields:
+            tuple -- (img_path, None, error) per record, error being None or
+                     the exception raised
+        """
+        async def write(record):
+            if isinstance(record, Mapping):
+                return await self.write(**record)
+            return await self.write(*record)
+
+        async for result in self._as_completed(write, records):
+            yield result
+
+    async def _run(self, func, *args):
+        import asyncio
+
+        await self._semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_open, thread_name_prefix='geotag')
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        # Release the slot when the work is actually done, not when the
+        # caller stops waiting for it
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self._semaphore.release)
+            except RuntimeError:
+                pass  # loop closed
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def _as_completed(self, func, items):
+        # Only max_open items are scheduled ahead, so a long or endless
+        # input is consumed as results are taken
+        import asyncio
+
+        pending = {}
+        iterator = _aiter(items)
+        exhausted = False
+        try:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < self.max_open:
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending[asyncio.ensure_future(func(item))] = item
+
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    img_path = _record_path(pending.pop(task))
+                    error = task.exception()
+                    if error is not None:
+                        yield (img_path, None, error)
+                    else:
+                        yield (img_path, task.result(), None)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+
+async def read_geo_tag_async(img_path):
+    """Reads geotags from an image without blocking the event loop, on the
+    default AsyncGeoTagger of the running loop
+
+    Arguments:
+        img_path {str} -- Path to image
+
+    Returns:
+        dict -- Same as read_geo_tag
+    """
+    return await _async_tagger().read(img_path)
+
+
+async def write_geo_tag_async(img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None,
+                              pitch=None, yaw=None):
+    """Writes geotags to an image without blocking the event loop, on the
+    default AsyncGeoTagger of the running loop. Arguments are the same as
+    write_geo_tag
+    """
+    return await _async_tagger().write(img_path, lat, lon, alt_abs, hdg, roll, pitch, yaw)
+
+
+def _async_tagger():
+    """Get the default AsyncGeoTagger of the running event loop
+
+    Returns:
+        AsyncGeoTagger -- Default tagger
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    tagger = _async_taggers.get(loop)
+    if tagger is None:
+        tagger = _async_taggers[loop] = AsyncGeoTagger()
+    return tagger
+
+
+def _aiter(items):
+    """Get an async iterator over a sync or async iterable
+
+    Arguments:
+        items {iterable} -- Items
+
+    Returns:
+        async iterator -- Iterator over items
+    """
+    if hasattr(items, '__aiter__'):
+        return items.__aiter__()
+
+    async def iterate():
+        for item in items:
+            yield item
+    return iterate()
+
+
+def _record_path(record):
+    """Get the image path of a path or write record
+
+    Arguments:
+        record {str, dict or tuple} -- Path, or record as accepted by
+                                       write_geo_tags_batch
+
+    Returns:
+        str -- Path to image
+    """
+    if isinstance(record, Mapping):
+        return record['img_path']
+    if isinstance(record, (tuple, list)):
+        return record[0]
+    return record
+
+
+# --------------------------------------------------
+# Server Functions
+# --------------------------------------------------
+# Seconds between checks for shutdown while waiting for connections
+_SERVER_POLL_INTERVAL = 0.2
+
+# Keyword arguments, besides the geotags, taken from requests
+_SERVER_READ_ARGS = ['fields', 'sidecar']
+_SERVER_WRITE_ARGS = ['skip_unchanged', 'sidecar']
+
+
+class GeoTagServer:
+    """Long running local service reading and writing geotags, so callers
+    don't pay for starting python and importing geotag and its backends
+    for every image.
+
+    Clients send JSON Lines requests over a Unix socket, or TCP on
+    localhost, and may send more before reading the responses:
+        {"id": 1, "op": "read", "path": "a.jpg", "fields": ["lat", "lon"]}
+        {"id": 2, "op": "write", "path": "a.jpg", "lat": 49.9, "lon": -98.3, "alt": 261.6}
+        {"id": 3, "op": "stats"}
+    Each request gets one response line with its id, in completion order:
+        {"id": 1, "result": {"lat": 49.9, "lon": -98.3}}
+        {"id": 2, "error": "ValueError: Lat out of range"}
+    Write requests take the fields of write_geo_tags_batch records, plus
+    skip_unchanged and sidecar. Read requests take fields and sidecar.
+
+    Requests of every connection go through one queue. Whenever a worker
+    is free, the waiting requests (up to batch, waiting up to linger
+    seconds for more) are sent to it as one batch, so batches grow with
+    the load. Once max_queue requests are waiting, connections are not
+    read until the queue drains, which holds back their clients.
+
+    Arguments:
+        address {str or tuple} -- Unix socket path, or (host, port) to
+                                  listen on TCP. Port 0 picks a free port
+
+    Keyword Arguments:
+        jobs {int} -- Number of worker processes, 1 runs in a thread of
+                      this process (default: {None}, one per cpu)
+        batch {int} -- Most requests per batch (default: {64})
+        max_queue {int} -- Most requests waiting (default: {1024})
+        linger {float} -- Seconds to wait for a batch to fill
+                          (default: {0}, send what is waiting)
+    """
+
+    def __init__(self, address, jobs=None, batch=64, max_queue=1024, linger=0):
+        import socket
+
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError('Invalid number of jobs')
+        if batch < 1:
+            raise ValueError('Invalid batch size')
+        if max_queue < 1:
+            raise ValueError('Invalid queue size')
+        self.jobs = jobs
+        self.batch = batch
+        self.max_queue = max_queue
+        self.linger = linger
+
+        if isinstance(address, str):
+            # Remove the socket of a server that didn't shut down cleanly
+            if os.path.exists(address) and _is_socket(address):
+                os.unlink(address)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._socket.bind(address)
+            self._socket.listen(128)
+        except OSError:
+            self._socket.close()
+            raise
+        self._socket.settimeout(_SERVER_POLL_INTERVAL)
+        self.address = self._socket.getsockname()
+
+        self._queue = queue.Queue(max_queue)
+        # Batches in flight, a few per worker so workers never wait on the
+        # dispatcher
+        self._slots = threading.Semaphore(2 * jobs)
+        self._closed = threading.Event()
+        # Set once the dispatcher has stopped taking requests off the queue
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._latency = StageStats()
+        self._counts = {'requests': 0, 'errors': 0, 'batches': 0, 'in_flight': 0,
+                        'max_queue_depth': 0}
+
+        if jobs == 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='geotag-server')
+        else:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_load_backend)
+        # Start the workers now, so the first requests don't wait for them
+        concurrent.futures.wait([self._executor.submit(_load_backend) for _ in range(jobs)])
+        _load_backend()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='geotag-dispatch',
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def serve_forever(self):
+        """Accept connections until close is called"""
+        while not self._closed.is_set():
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                # Timed out to check for close, or closed
+                continue
+            conn.settimeout(None)
+            if not isinstance(self.address, str):
+                _set_nodelay(conn)
+            threading.Thread(target=self._handle, args=(conn,), name='geotag-connection',
+                             daemon=True).start()
+
+    def close(self):
+        """Stop accepting connections, finish the waiting requests and shut
+        down the workers"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._stopped.set()
+        self._reject_queued()
+        self._executor.shutdown()
+        self._socket.close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def stats(self):
+        """Get queue and request stats
+
+        Returns:
+            dict --
+            queue_depth -- requests waiting for a batch
+            max_queue_depth -- most requests that have been waiting
+            in_flight -- requests in batches being run
+            requests -- requests answered
+            errors -- requests answered with an error
+            batches -- batches run
+            mean_batch_size -- mean requests per batch
+            latency -- per op count, mean, p50, p99 and max seconds from
+                       receiving a request to sending its response
+        """
+        with self._lock:
+            stats = dict(self._counts)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['mean_batch_size'] = stats['requests'] / stats['batches'] if stats['batches'] else None
+        latency = {}
+        for (op, op_stats) in self._latency.to_dict().items():
+            latency[op] = {
+                'count': op_stats['count'],
+                'mean': op_stats['mean'],
+                'p50': self._latency.percentile(op, 50),
+                'p99': self._latency.percentile(op, 99),
+                'max': op_stats['max'],
+            }
+        stats['latency'] = latency
+        return stats
+
+    def _handle(self, conn):
+        connection = _ServerConnection(conn)
+        try:
+            for line in conn.makefile('rb'):
+                if not line.strip():
+                    continue
+                received = time.perf_counter()
+                request = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get('id')
+                    op = request.get('op')
+                    if op == 'stats':
+                        connection.send({'id': request_id, 'result': self.stats()})
+                        continue
+                    if self._closed.is_set():
+                        raise RuntimeError('Server is shutting down')
+                    kwargs = _server_kwargs(op, request)
+                except (ValueError, TypeError, AttributeError, RuntimeError) as e:
+                    request_id = request.get('id') if isinstance(request, dict) else None
+                    connection.send({'id': request_id,
+                                     'error': '{}: {}'.format(type(e).__name__, e)})
+                    continue
+
+                connection.expect()
+                # Blocks while the queue is full, so this connection isn't
+                # read until it drains
+                self._queue.put((connection, request_id, op, kwargs, received))
+                depth = self._queue.qsize()
+                with self._lock:
+                    if depth > self._counts['max_queue_depth']:
+                        self._counts['max_queue_depth'] = depth
+                # Queued after close rejected what was waiting, so nothing
+                # else will take it off the queue
+                if self._stopped.is_set():
+                    self._reject_queued()
+        except OSError:
+            pass  # connection reset
+        finally:
+            connection.finish()
+
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            self._slots.acquire()
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.linger
+            while len(batch) < self.batch:
+                try:
+                    timeout = deadline - time.perf_counter()
+                    if timeout > 0:
+                        item = self._queue.get(timeout=timeout)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            with self._lock:
+                self._counts['in_flight'] += len(batch)
+            requests = [(op, kwargs) for (_, _, op, kwargs, _) in batch]
+            future = self._executor.submit(_serve_chunk, requests)
+            future.add_done_callback(functools.partial(self._reply, batch))
+
+    def _reject_queued(self):
+        # Requests left on the queue once the dispatcher stopped are answered
+        # with an error, so their clients don't wait for a response
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                continue
+            (connection, request_id, _, _, _) = item
+            with self._lock:
+                self._counts['requests'] += 1
+                self._counts['errors'] += 1
+            connection.send({'id': request_id, 'error': 'RuntimeError: Server is shutting down'},
+                            done=True)
+
+    def _reply(self, batch, future):
+        self._slots.release()
+        try:
+            results = future.result()
+        except Exception as e:
+            # The worker died, so the whole batch failed
+            results = [(None, '{}: {}'.format(type(e).__name__, e))] * len(batch)
+
+        # Stats are updated first, so they include requests once answered
+        now = time.perf_counter()
+        for (_, _, op, _, received) in batch:
+            self._latency.record(op, now - received)
+        with self._lock:
+            self._counts['in_flight'] -= len(batch)
+            self._counts['requests'] += len(batch)
+            self._counts['errors'] += sum(error is not None for (_, error) in results)
+            self._counts['batches'] += 1
+
+        for ((connection, request_id, _, _, _), (result, error)) in zip(batch, results):
+            if error is not None:
+                connection.send({'id': request_id, 'error': error}, done=True)
+            else:
+                connection.send({'id': request_id, 'result': result}, done=True)
+
+
+class _ServerConnection:
+    """Client connection of a GeoTagServer. Responses are sent by a thread
+    of their own, so a slow client doesn't hold up the others. The socket
+    is closed once the client stops sending and every response is sent.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._responses = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._reading = True
+        threading.Thread(target=self._send_responses, name='geotag-responses',
+                         daemon=True).start()
+
+    def expect(self):
+        """Count a request whose response will be sent later"""
+        with self._lock:
+            self._pending += 1
+
+    def send(self, response, done=False):
+        """Queue a response
+
+        Arguments:
+            response {dict} -- Response
+
+        Keyword Arguments:
+            done {bool} -- The response is for a request counted with
+                           expect (default: {False})
+        """
+        self._responses.put(json.dumps(response).encode('utf-8') + b'\n')
+        if done:
+            with self._lock:
+                self._pending -= 1
+                last = not self._reading and self._pending == 0
+            if last:
+                self._responses.put(None)
+
+    def finish(self):
+        """Mark that the client stopped sending"""
+        with self._lock:
+            self._reading = False
+            last = self._pending == 0
+        if last:
+            self._responses.put(None)
+
+    def _send_responses(self):
+        try:
+            while True:
+                response = self._responses.get()
+                if response is None:
+                    break
+                # Send what else is ready along with it
+                pieces = [response]
+                while True:
+                    try:
+                        response = self._responses.get_nowait()
+                    except queue.Empty:
+                        break
+                    if response is None:
+                        break
+                    pieces.append(response)
+                self._conn.sendall(b''.join(pieces))
+                if response is None:
+                    break
+        except OSError:
+            pass  # client gone
+        finally:
+            self._conn.close()
+
+
+class GeoTagClient:
+    """Client of a GeoTagServer, keeping one connection open. It can be
+    shared between threads, which take turns sending requests.
+
+    Errors of a request are raised as the exception type the server
+    reported if it is a builtin one, otherwise as RuntimeError.
+
+    Arguments:
+        address {str or tuple} -- Unix socket path, or (host, port)
+
+    Keyword Arguments:
+        timeout {float} -- Socket timeout, in seconds (default: {None})
+    """
+
+    def __init__(self, address, timeout=None):
+        import socket
+
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _set_nodelay(self._socket)
+        self._socket.settimeout(timeout)
+        try:
+            self._socket.connect(address)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile('rb')
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connection"""
+        self._file.close()
+        self._socket.close()
+
+    def read(self, img_path, fields=None, sidecar=False):
+        """Reads geotags from an image, see read_geo_tag
+
+        Returns:
+            dict -- Same as read_geo_tag
+        """
+        return self._request(_read_request(img_path, fields, sidecar))
+
+    def write(self, img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None,
+              skip_unchanged=False, sidecar=False):
+        """Writes geotags to an image, see write_geo_tag
+
+        Returns:
+            bool -- True if the image was written, False if it was skipped
+        """
+        return self._request(_write_request(img_path, lat, lon, alt_abs, hdg, roll, pitch, yaw,
+                                            skip_unchanged, sidecar))
+
+    def stats(self):
+        """Get the stats of the server, see GeoTagServer.stats
+
+        Returns:
+            dict -- Stats
+        """
+        return self._request({'op': 'stats'})
+
+    def read_many(self, img_paths, fields=None, window=64):
+        """Reads geotags from many images, with up to window requests sent
+        ahead of their responses
+
+        Arguments:
+            img_paths {iterable} -- Paths to images
+
+        Keyword Arguments:
+            fields {iterable} -- Fields to read (default: {None}, all fields)
+            window {int} -- Most requests awaiting a response (default: {64})
+
+        Yields:
+            tuple -- (img_path, tags, error) per image, as completed
+        """
+        requests = (_read_request(img_path, fields) for img_path in img_paths)
+        for (request, result, error) in self._pipeline(requests, window):
+            yield (request['path'], result, error)
+
+    def write_many(self, records, window=64):
+        """Writes geotags to many images, with up to window requests sent
+        ahead of their responses
+
+        Arguments:
+            records {iterable} -- Records as accepted by write_geo_tags_batch
+
+        Keyword Arguments:
+            window {int} -- Most requests awaiting a response (default: {64})
+
+        Yields:
+            tuple -- (img_path, written, error) per record, as completed
+        """
+        def requests():
+            for record in records:
+                if isinstance(record, Mapping):
+                    yield _write_request(**record)
+                else:
+                    yield _write_request(*record)
+
+        for (request, result, error) in self._pipeline(requests(), window):
+            yield (request['path'], result, error)
+
+    def _request(self, request):
+        for (_, result, error) in self._pipeline([request], 1):
+            if error is not None:
+                raise error
+            return result
+
+    def _pipeline(self, requests, window):
+        if window < 1:
+            raise ValueError('Invalid window')
+        with self._lock:
+            pending = {}
+            requests = iter(requests)
+            exhausted = False
+            while pending or not exhausted:
+                # Send up to window requests, then wait for a response
+                pieces = []
+                while not exhausted and len(pending) + len(pieces) < window:
+                    try:
+                        request = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self._next_id += 1
+                    request['id'] = self._next_id
+                    pending[self._next_id] = request
+                    pieces.append(json.dumps(request).encode('utf-8') + b'\n')
+                if pieces:
+                    self._socket.sendall(b''.join(pieces))
+                if not pending:
+                    break
+
+                line = self._file.readline()
+                if not line:
+                    raise ConnectionError('Server closed the connection')
+                response = json.loads(line)
+                # Responses of requests abandoned by an earlier call are skipped
+                request = pending.pop(response.get('id'), None)
+                if request is None:
+                    continue
+                if 'error' in response:
+                    yield (request, None, _remote_error(response['error']))
+                else:
+                    yield (request, response['result'], None)
+
+
+def _read_request(img_path, fields=None, sidecar=False):
+    """Build a read request"""
+    request = {'op': 'read', 'path': img_path, 'sidecar': sidecar}
+    if fields is not None:
+        request['fields'] = [fields] if isinstance(fields, str) else list(fields)
+    return request
+
+
+def _write_request(img_path, lat, lon=None, alt_abs=None, hdg=None, roll=None, pitch=None, yaw=None,
+                   skip_unchanged=False, sidecar=False):
+    """Build a write request"""
+    if isinstance(lat, GeoTag):
+        (lat, lon, alt_abs, hdg, roll, pitch, yaw) = (lat.lat, lat.lon, lat.alt, lat.hdg,
+                                                     lat.roll, lat.pitch, lat.yaw)
+    return {'op': 'write', 'path': img_path, 'lat': lat, 'lon': lon, 'alt_abs': alt_abs,
+            'hdg': hdg, 'roll': roll, 'pitch': pitch, 'yaw': yaw,
+            'skip_unchanged': skip_unchanged, 'sidecar': sidecar}
+
+
+def _server_kwargs(op, request):
+    """Convert a request to read_geo_tag or write_geo_tag keyword arguments
+
+    Arguments:
+        op {str} -- 'read' or 'write'
+        request {dict} -- Request
+
+    Raises:
+        ValueError -- if the op is unknown or the path is missing
+
+    Returns:
+        dict -- Keyword arguments
+    """
+    if op == 'read':
+        kwargs = {'img_path': request.get('img_path', request.get('path'))}
+        names = _SERVER_READ_ARGS
+    elif op == 'write':
+        kwargs = _parse_record(request)
+        names = _SERVER_WRITE_ARGS
+    else:
+        raise ValueError('Unknown op {!r}'.format(op))
+    if not isinstance(kwargs['img_path'], str):
+        raise ValueError('Missing path')
+    for name in names:
+        if request.get(name) is not None:
+            kwargs[name] = request[name]
+    return kwargs
+
+
+def _serve_chunk(requests):
+    """Run a batch of server requests, collecting errors per request
+
+    Arguments:
+        requests {list} -- (op, keyword arguments) per request
+
+    Returns:
+        list -- (result, error) per request, error being None or the
+                exception raised, formatted as 'Type: message'
+    """
+    results = []
+    for (op, kwargs) in requests:
+        try:
+            if op == 'read':
+                result = read_geo_tag(**kwargs)
+            else:
+                result = write_geo_tag(**kwargs)
+        except Exception as e:
+            results.append((None, '{}: {}'.format(type(e).__name__, e)))
+        else:
+            results.append((result, None))
+    return results
+
+
+def _load_backend():
+    """Import the default backend, so the first request doesn't pay for it"""
+    _get_backend().load()
+
+
+def _remote_error(error):
+    """Convert an error reported by the server to an exception
+
+    Arguments:
+        error {str} -- Error, as 'Type: message'
+
+    Returns:
+        Exception -- Exception of the builtin type, or RuntimeError
+    """
+    name, _, message = error.partition(': ')
+    cls = getattr(builtins, name, None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        return cls(message)
+    return RuntimeError(error)
+
+
+def _is_socket(path):
+    """Check if a path is a Unix socket"""
+    import stat
+    return stat.S_ISSOCK(os.stat(path).st_mode)
+
+
+def _set_nodelay(sock):
+    """Send small responses/requests right away instead of waiting to
+    coalesce them, which would add tens of milliseconds per request"""
+    import socket
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+# --------------------------------------------------
+# Command Line Functions
+# --------------------------------------------------
+_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.mpo')
+
+# Seconds between progress updates
+_PROGRESS_INTERVAL = 0.5
+
+
+def main(argv=None):
+    """Command line entry point
+
+    Usage:
+        python -m geotag read [--jobs N] [--fast] IMAGE...
+        python -m geotag write [--jobs N] [--fast | --skip-unchanged] [--format csv|jsonl]
+                               RECORDS
+        python -m geotag scan [--jobs N] [--fast] [--tagged | --untagged] DIR...
+        python -m geotag serve (--socket PATH | --port N [--host HOST]) [--jobs N]
+                               [--batch N] [--max-queue N] [--linger SECONDS]
+
+    Results are written to stdout as JSON Lines, one object per image.
+    serve runs a GeoTagServer until interrupted or terminated.
+
+    Keyword Arguments:
+        argv {list} -- Arguments (default: {None}, sys.argv[1:])
+
+    Returns:
+        int -- Exit status, 1 if any image failed
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='geotag',
+                                     description='Read and write exif/xmp geotags of JPEG images')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    read = subparsers.add_parser('read', help='read geotags of images')
+    read.add_argument('images', nargs='+', help='image paths, - to read paths from stdin')
+
+    write = subparsers.add_parser('write', help='write geotags from a records file')
+    write.add_argument('records', help='CSV or JSON Lines records, - for stdin. Fields are '
+                                       'img_path, lat, lon, alt_abs, hdg, roll, pitch, yaw')
+    write.add_argument('--format', choices=['csv', 'jsonl'],
+                       help='records format (default: from the file extension, else jsonl)')
+    write.add_argument('--skip-unchanged', action='store_true',
+                       help='don\'t rewrite images that already have the tags')
+
+    scan = subparsers.add_parser('scan', help='read geotags of every image under directories')
+    scan.add_argument('dirs', nargs='+', help='directories to walk')
+    group = scan.add_mutually_exclusive_group()
+    group.add_argument('--tagged', action='store_true', help='only output images with lat/lon')
+    group.add_argument('--untagged', action='store_true', help='only output images without lat/lon')
+
+    serve = subparsers.add_parser('serve', help='run a local server for read/write requests')
+    group = serve.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='Unix socket path to listen on')
+    group.add_argument('--port', type=int, help='TCP port to listen on')
+    serve.add_argument('--host', default='127.0.0.1', help='TCP host (default: %(default)s)')
+    serve.add_argument('--batch', type=int, default=64,
+                       help='most requests per batch (default: %(default)s)')
+    serve.add_argument('--max-queue', type=int, default=1024,
+                       help='most requests waiting before clients are held back '
+                            '(default: %(default)s)')
+    serve.add_argument('--linger', type=float, default=0,
+                       help='seconds to wait for a batch to fill (default: %(default)s)')
+    serve.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                       help='worker processes (default: %(default)s)')
+
+    for subparser in [read, write, scan]:
+        subparser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                               help='worker processes (default: %(default)s)')
+        subparser.add_argument('--fast', action='store_true',
+                               help='use the pure python segment reader/writer')
+        subparser.add_argument('--progress', action=argparse.BooleanOptionalAction,
+                               default=sys.stderr.isatty(),
+                               help='show progress on stderr (default: if stderr is a terminal)')
+
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if args.command == 'serve':
+        address = args.socket if args.socket is not None else (args.host, args.port)
+        try:
+            server = GeoTagServer(address, jobs=args.jobs, batch=args.batch,
+                                  max_queue=args.max_queue, linger=args.linger)
+        except ValueError as e:
+            parser.error(str(e))
+        _serve(server)
+        return 0
+
+    if args.command == 'write':
+        if args.fast and args.skip_unchanged:
+            parser.error('--skip-unchanged is not supported with --fast')
+        writer = write_geo_tag_fast if args.fast else write_geo_tag
+        if args.skip_unchanged:
+            writer = functools.partial(write_geo_tag, skip_unchanged=True)
+        worker = functools.partial(_write_chunk, writer=writer)
+        results = _imap_batch(worker, _read_records(args.records, args.format), args.jobs)
+    else:
+        worker = functools.partial(_read_chunk,
+                                   reader=read_geo_tag_fast if args.fast else read_geo_tag)
+        if args.command == 'read':
+            img_paths = _read_paths(args.images)
+        else:
+            img_paths = _walk_images(args.dirs)
+        results = _imap_batch(worker, img_paths, args.jobs)
+
+    progress = _Progress(sys.stderr) if args.progress else None
+    failed = False
+    for (img_path, tags, error) in results:
+        failed = failed or error is not None
+        if progress is not None:
+            progress.update(error is not None)
+
+        if args.command == 'scan' and error is None:
+            tagged = tags['lat'] is not None and tags['lon'] is not None
+            if (args.tagged and not tagged) or (args.untagged and tagged):
+                continue
+
+        line = {'path': img_path}
+        if error is not None:
+            line['error'] = '{}: {}'.format(type(error).__name__, error)
+        elif args.command == 'write':
+            if args.skip_unchanged:
+                line['written'] = tags
+        elif tags is not None:
+            line.update(tags)
+        sys.stdout.write(json.dumps(line) + '\n')
+
+    if progress is not None:
+        progress.finish()
+    return 1 if failed else 0
+
+
+def _serve(server):
+    """Run a server until interrupted or terminated
+
+    Arguments:
+        server {GeoTagServer} -- Server
+    """
+    import signal
+
+    # Terminating shuts down like an interrupt, finishing waiting requests
+    signal.signal(signal.SIGTERM, lambda *_: server.close())
+    sys.stderr.write('geotag: listening on {}\n'.format(server.address))
+    sys.stderr.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+class _Progress:
+    """Progress and throughput line written to a terminal
+
+    Arguments:
+        stream {file} -- Text stream to write to
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._start = self._last = time.monotonic()
+        self.count = 0
+        self.errors = 0
+
+    def update(self, error):
+        self.count += 1
+        self.errors += error
+        now = time.monotonic()
+        if now - self._last >= _PROGRESS_INTERVAL:
+            self._last = now
+            self._write(now)
+
+    def finish(self):
+        self._write(time.monotonic())
+        self._stream.write('\n')
+        self._stream.flush()
+
+    def _write(self, now):
+        rate = self.count / max(now - self._start, 1e-9)
+        self._stream.write('\r{} images, {} errors, {:.1f} images/s'.format(
+            self.count, self.errors, rate))
+        self._stream.flush()
+
+
+def _walk_images(dirs):
+    """Find JPEG and MPO images under directories, by extension
+
+    Arguments:
+        dirs {list} -- Directories to walk
+
+    Yields:
+        str -- Paths to images
+    """
+    pending = list(reversed(dirs))
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.lower().endswith(_IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.path
+        pending.extend(reversed(subdirs))
+
+
+def _read_paths(paths):
+    """Expand - in a list of paths to the paths on stdin, one per line
+
+    Arguments:
+        paths {list} -- Paths
+
+    Yields:
+        str -- Paths
+    """
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.rstrip('\r\n')
+        else:
+            yield path
+
+
+def _read_records(records_path, records_format=None):
+    """Stream write_geo_tag records from a CSV or JSON Lines file
+
+    Arguments:
+        records_path {str} -- Path to records, - for stdin
+
+    Keyword Arguments:
+        records_format {str} -- 'csv' or 'jsonl' (default: {None}, from the
+                                file extension, else jsonl)
+
+    Yields:
+        dict or _InvalidRecord -- write_geo_tag keyword arguments, or the
+                                  error of a row that can't be parsed
+    """
+    if records_format is None:
+        records_format = 'csv' if records_path.lower().endswith('.csv') else 'jsonl'
+
+    f = sys.stdin if records_path == '-' else open(records_path, newline='')
+    try:
+        if records_format == 'csv':
+            reader = csv.DictReader(f)
+            rows = ((reader.line_num, row) for row in reader)
+        else:
+            rows = ((line_num, line) for (line_num, line) in enumerate(f, 1) if line.strip())
+        for (line_num, row) in rows:
+            # A bad row fails on its own, like a record that fails to write
+            try:
+                if records_format != 'csv':
+                    row = json.loads(row)
+                record = _parse_record(row)
+            except (ValueError, TypeError, AttributeError) as e:
+                img_path = row.get('img_path', row.get('path')) if isinstance(row, dict) else None
+                record = _InvalidRecord(img_path, ValueError('Invalid record on line {}: {}'.format(
+                    line_num, e)))
+            yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _parse_record(row):
+    """Convert a records file row to write_geo_tag keyword arguments
+
+    Arguments:
+        row {dict} -- Row, with img_path (or path), lat, lon, alt_abs
+                      (or alt) and optional hdg, roll, pitch, yaw
+
+    Returns:
+        dict -- write_geo_tag keyword arguments
+    """
+    def number(*names):
+        for name in names:
+            value = row.get(name)
+            if value is not None and value != '':
+                return float(value)
+        return None
+
+    return {
+        'img_path': row.get('img_path', row.get('path')),
+        'lat': number('lat'),
+        'lon': number('lon'),
+        'alt_abs': number('alt_abs', 'alt'),
+        'hdg': number('hdg'),
+        'roll': number('roll'),
+        'pitch': number('pitch'),
+        'yaw': number('yaw'),
+    }
+
+
+class _InvalidRecord:
+    """Row of a records file that could not be parsed, reported by
+    _write_chunk as the error of its record
+
+    Arguments:
+        img_path {str} -- Path to image, None if unknown
+        error {Exception} -- Parse error
+    """
+
+    __slots__ = ('img_path', 'error')
+
+    def __init__(self, img_path, error):
+        self.img_path = img_path
+        self.error = error
+
+
+if __name__ == '__main__':
+    sys.exit(main())
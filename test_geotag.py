@@ -1,8 +1,28 @@
 import unittest
 import geotag
+import io
 import os
+import sys
+import json
+import shutil
+import asyncio
+import threading
+import time
+import math
+import pickle
+import socket
+import struct
+import subprocess
+import tempfile
+import importlib.util
+import xml.etree.ElementTree as ElementTree
+from unittest import mock
+import contextlib
 from PIL import Image
 from fractions import Fraction
+from datetime import datetime
+
+HAS_PYEXIV2 = importlib.util.find_spec('pyexiv2') is not None
 
 
 class TestConversionMethods(unittest.TestCase):
@@ -67,6 +87,70 @@ class TestConversionMethods(unittest.TestCase):
                 (Fraction(1811, 10), Fraction(0, 1), Fraction(0, 1)), 'n')
 
 
+@unittest.skipIf(geotag.np is None, 'numpy is not installed')
+class TestArrayConversionMethods(unittest.TestCase):
+    def setUp(self):
+        rng = geotag.np.random.RandomState(0)
+        self.lats = geotag.np.concatenate([rng.uniform(-90, 90, 1000),
+                                           [0, 90, -90, 49.1234, -49.1234, 33.1234568]])
+        self.lons = geotag.np.concatenate([rng.uniform(-180, 180, 1000),
+                                           [0, 180, -180, 123.123456789, -0.9235098]])
+
+    def test_lat_dec_to_dms_array(self):
+        numerators, denominators, refs = geotag.lat_dec_to_dms_array(self.lats)
+        for (i, lat) in enumerate(self.lats):
+            self.assertEqual(tuple(Fraction(int(n), int(d))
+                                   for (n, d) in zip(numerators[i], denominators[i])),
+                             geotag.coord_dec_to_dms(lat))
+            self.assertEqual(tuple(numerators[i]),
+                             tuple(f.numerator for f in geotag.coord_dec_to_dms(lat)))
+            self.assertEqual(refs[i], geotag._get_lat_ref(lat))
+        with self.assertRaises(ValueError):
+            geotag.lat_dec_to_dms_array([0, 90.0001])
+        with self.assertRaises(ValueError):
+            geotag.lat_dec_to_dms_array([float('nan')])
+
+    def test_lon_dec_to_dms_array(self):
+        numerators, denominators, refs = geotag.lon_dec_to_dms_array(self.lons)
+        for (i, lon) in enumerate(self.lons):
+            self.assertEqual(tuple(Fraction(int(n), int(d))
+                                   for (n, d) in zip(numerators[i], denominators[i])),
+                             geotag.coord_dec_to_dms(lon))
+            self.assertEqual(refs[i], geotag._get_lon_ref(lon))
+        with self.assertRaises(ValueError):
+            geotag.lon_dec_to_dms_array([-181])
+
+    def test_lat_dms_to_dec_array(self):
+        numerators, denominators, refs = geotag.lat_dec_to_dms_array(self.lats)
+        lats = geotag.lat_dms_to_dec_array(numerators, denominators, refs)
+        for i in range(len(lats)):
+            dms = tuple(Fraction(int(n), int(d)) for (n, d) in zip(numerators[i], denominators[i]))
+            self.assertEqual(lats[i].tobytes(),
+                             geotag.np.float64(geotag.lat_dms_to_dec(dms, refs[i])).tobytes())
+        with self.assertRaises(ValueError):
+            geotag.lat_dms_to_dec_array([[91, 0, 0]], [[1, 1, 1]], ['N'])
+        with self.assertRaises(ValueError):
+            geotag.lat_dms_to_dec_array([[90, 0, 0]], [[1, 1, 1]], ['e'])
+
+    def test_lon_dms_to_dec_array(self):
+        numerators, denominators, refs = geotag.lon_dec_to_dms_array(self.lons)
+        lons = geotag.lon_dms_to_dec_array(numerators, denominators, refs)
+        for i in range(len(lons)):
+            dms = tuple(Fraction(int(n), int(d)) for (n, d) in zip(numerators[i], denominators[i]))
+            self.assertEqual(lons[i].tobytes(),
+                             geotag.np.float64(geotag.lon_dms_to_dec(dms, refs[i])).tobytes())
+        with self.assertRaises(ValueError):
+            geotag.lon_dms_to_dec_array([[181, 0, 0]], [[1, 1, 1]], ['E'])
+        with self.assertRaises(ValueError):
+            geotag.lon_dms_to_dec_array([[180, 0, 0]], [[1, 1, 1]], ['n'])
+
+    def test_round_array(self):
+        values = (geotag.np.arange(-1000, 1000) + 0.5) / 1e7
+        rounded = geotag._round_array(values, 7)
+        for (value, result) in zip(values, rounded):
+            self.assertEqual(result, round(float(value), 7))
+
+
 class TestHelperFunctions(unittest.TestCase):
     def test_check_lat(self):
         geotag._check_lat(0)
@@ -242,5 +326,1427 @@ class TestGeoTag(unittest.TestCase):
                          })
 
 
+class TestFastRead(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_fast.jpg')
+
+    @unittest.skipUnless(HAS_PYEXIV2, 'pyexiv2 is not installed')
+    def test_read_geo_tag_fast(self):
+        for path in ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg']:
+            self.assertEqual(geotag.read_geo_tag_fast(path), geotag.read_geo_tag(path, backend='pyexiv2'))
+
+        img = Image.open('images/horse.jpg')
+        img.save('images/horse_fast.jpg')
+        img.close()
+        geotag.write_geo_tag('images/horse_fast.jpg', -83.0923535, -0.9235098, 189.99, 359.99,
+                             roll=123.1, pitch=0, yaw=103.23, backend='pyexiv2')
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_fast.jpg'),
+                         geotag.read_geo_tag('images/horse_fast.jpg', backend='pyexiv2'))
+
+    def test_malformed_gps_entries(self):
+        # A zero denominator and a non-ASCII ref read as missing tags
+        shutil.copy('images/horse.jpg', 'images/horse_fast.jpg')
+        geotag.write_geo_tag_fast('images/horse_fast.jpg', -83.0923535, -0.9235098, 189.99, 45)
+        with open('images/horse_fast.jpg', 'rb') as f:
+            data = bytearray(f.read())
+        with open('images/horse_fast.jpg', 'rb') as f:
+            (tiff, _) = geotag._read_app1_segments(f, read_xmp=False)
+        base = data.find(geotag._EXIF_HEADER) + len(geotag._EXIF_HEADER)
+        ifd0 = geotag._read_ifd(tiff, 8, '<')
+        gps = geotag._read_ifd(tiff, struct.unpack_from('<I', tiff, ifd0[geotag._GPS_IFD_POINTER][2])[0],
+                               '<')
+        struct.pack_into('<I', data, base + gps[0x11][2] + 4, 0)
+        data[base + gps[0x01][2]] = 0xFF
+        with open('images/horse_fast.jpg', 'wb') as f:
+            f.write(data)
+
+        tags = geotag.read_geo_tag_fast('images/horse_fast.jpg')
+        self.assertIsNone(tags['hdg'])
+        self.assertIsNone(tags['lat'])
+        self.assertEqual(tags['lon'], -0.9235098)
+        self.assertEqual(geotag.read_geo_tag('images/horse_fast.jpg', backend='segment'), tags)
+        self.assertTrue(geotag.write_geo_tag('images/horse_fast.jpg', -83.0923535, -0.9235098, 189.99, 45,
+                                             skip_unchanged=True, backend='segment'))
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_fast.jpg', fields=['lat', 'hdg']),
+                         {'lat': -83.0923535, 'hdg': 45.0})
+
+    def test_read_geo_tag_fast_pillow(self):
+        # Pillow parses the Exif and Xmp segments independently of geotag
+        for path in ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg']:
+            self.assertEqual(geotag.read_geo_tag_fast(path), geotag.read_geo_tag(path, backend='pillow'))
+
+        shutil.copy('images/horse.jpg', 'images/horse_fast.jpg')
+        geotag.write_geo_tag_fast('images/horse_fast.jpg', -83.0923535, -0.9235098, 189.99, 359.99,
+                                  roll=123.1, pitch=0, yaw=103.23)
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_fast.jpg'),
+                         geotag.read_geo_tag('images/horse_fast.jpg', backend='pillow'))
+
+        with self.assertRaises(ValueError):
+            geotag.read_geo_tag_fast('README.md')
+
+    def test_parse_attitude_xmp(self):
+        packet = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+                  b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+                  b'<rdf:Description rdf:about="" xmlns:Attitude="attitude/"'
+                  b' Attitude:Roll="123.1" Attitude:Yaw="103.23">'
+                  b'<Attitude:Pitch>2.5</Attitude:Pitch>'
+                  b'</rdf:Description></rdf:RDF></x:xmpmeta>')
+        self.assertEqual(geotag._parse_attitude_xmp(packet),
+                         {
+                             'Xmp.Attitude.Roll': '123.1',
+                             'Xmp.Attitude.Pitch': '2.5',
+                             'Xmp.Attitude.Yaw': '103.23',
+                         })
+        self.assertEqual(geotag._parse_attitude_xmp(b'<x:xmpmeta/>'), {})
+
+
+class TestFastWrite(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/Apples_fast.jpg')
+        os.unlink('images/horse_fast_write.jpg')
+        os.unlink('images/horse_below_sea.jpg')
+
+    def test_negative_altitude(self):
+        # The altitude is written as its magnitude, with the ref below sea level
+        shutil.copy('images/horse.jpg', 'images/horse_below_sea.jpg')
+        geotag.write_geo_tag('images/horse_below_sea.jpg', -10, -20, -30.5, backend='segment')
+        self.assertEqual(geotag.read_geo_tag('images/horse_below_sea.jpg', backend='segment')['alt'], -30.5)
+        geotag.write_geo_tag_fast('images/horse_below_sea.jpg', 10, 20, -0.25, 45)
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_below_sea.jpg', fields=['alt', 'hdg']),
+                         {'alt': -0.25, 'hdg': 45.0})
+
+    def test_update_exif_trailing_data(self):
+        # Bytes after the GPS IFD that no IFD points to are kept, and the
+        # larger GPS IFD is appended after them
+        (exif, _) = geotag._encode_geo_tags(49.9120223, -98.2690366, 261.64)
+        tiff = geotag._new_exif(exif) + b'\x01\x02\x03\x04'
+        (exif, _) = geotag._encode_geo_tags(-49.9120223, 98.2690366, 261.64, 45.2)
+        updated = geotag._update_exif(tiff, exif)
+        self.assertEqual(updated[len(tiff) - 4:len(tiff)], b'\x01\x02\x03\x04')
+        self.assertEqual(geotag._decode_geo_tags(geotag._parse_gps_ifd(updated), {})['hdg'], 45.2)
+
+    def test_write_geo_tag_fast(self):
+        shutil.copy('images/Apples.jpg', 'images/Apples_fast.jpg')
+        # The new GPS tags fit where the old ones were
+        self.assertTrue(geotag.write_geo_tag_fast('images/Apples_fast.jpg',
+                                                  -49.9120223, -98.2690366, 261.64))
+        self.assertEqual(os.path.getsize('images/Apples_fast.jpg'),
+                         os.path.getsize('images/Apples.jpg'))
+        self.assertEqual(geotag.read_geo_tag('images/Apples_fast.jpg'),
+                         {
+                             'lat': -49.9120223,
+                             'lon': -98.2690366,
+                             'alt': 261.64,
+                             'hdg': None,
+                             'roll': None,
+                             'pitch': None,
+                             'yaw': None,
+                         })
+
+        shutil.copy('images/horse.jpg', 'images/horse_fast_write.jpg')
+        self.assertFalse(geotag.write_geo_tag_fast('images/horse_fast_write.jpg',
+                                                   -83.0923535, -0.9235098, 189.99, 359.99,
+                                                   roll=123.1, yaw=103.23))
+        expected = {
+            'lat': -83.0923535,
+            'lon': -0.9235098,
+            'alt': 189.99,
+            'hdg': 359.99,
+            'roll': 123.1,
+            'pitch': None,
+            'yaw': 103.23,
+        }
+        self.assertEqual(geotag.read_geo_tag('images/horse_fast_write.jpg'), expected)
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_fast_write.jpg'), expected)
+
+        # Rewriting the same tags is done in place, and the image data is untouched
+        self.assertTrue(geotag.write_geo_tag_fast('images/horse_fast_write.jpg',
+                                                  83.0923535, 0.9235098, 89.99, 9.99,
+                                                  roll=12.1, pitch=3.5, yaw=13.23))
+        self.assertEqual(geotag.read_geo_tag('images/horse_fast_write.jpg')['pitch'], 3.5)
+        img = Image.open('images/horse_fast_write.jpg')
+        original = Image.open('images/horse.jpg')
+        self.assertEqual(img.tobytes(), original.tobytes())
+        img.close()
+        original.close()
+
+        with self.assertRaises(ValueError):
+            geotag.write_geo_tag_fast('images/horse_fast_write.jpg', 91, 0, 0)
+
+
+class TestTemplates(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        for path in ['images/horse_template.jpg', 'images/horse_pyexiv2.jpg']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def reference_exif(self, lat, lon, alt, hdg=None):
+        # Tag values as they were built before the templates, one Fraction at a time
+        exif = {
+            'Exif.GPSInfo.GPSLatitude': geotag.coord_dec_to_dms(lat),
+            'Exif.GPSInfo.GPSLatitudeRef': 'N' if lat >= 0 else 'S',
+            'Exif.GPSInfo.GPSLongitude': geotag.coord_dec_to_dms(lon),
+            'Exif.GPSInfo.GPSLongitudeRef': 'E' if lon >= 0 else 'W',
+            'Exif.GPSInfo.GPSAltitude': Fraction(int(abs(alt)*1e7), int(1e7)),
+            'Exif.GPSInfo.GPSAltitudeRef': b'0' if alt >= 0 else b'1',
+        }
+        if hdg is not None:
+            exif['Exif.GPSInfo.GPSImgDirection'] = Fraction(int(hdg * 100), 100)
+        return exif
+
+    def test_gps_template(self):
+        values = [(49.9120223, -98.2690366, 261.64, 45.2), (-83.0923535, 0.9235098, 0, None),
+                  (0, -180, 429.4, 359.99), (90, 179.9999999, 0.0000001, 0),
+                  (-10, -20, -30.5, None)]
+        for (lat, lon, alt, hdg) in values:
+            (exif, _) = geotag._encode_geo_tags(lat, lon, alt, hdg)
+            reference = self.reference_exif(lat, lon, alt, hdg)
+            # Reads as the pyexiv2 values, in the same order
+            self.assertEqual(list(exif.items()), list(reference.items()))
+            self.assertEqual(pickle.loads(pickle.dumps(exif)), reference)
+            # Byte for byte the same as the generic encoder
+            self.assertEqual(geotag._new_exif(exif), geotag._new_exif(reference))
+            for endian in ['<', '>']:
+                entries = geotag._encode_gps_entries(reference, endian)
+                self.assertEqual(geotag._encode_gps_entries(exif, endian), entries)
+                self.assertEqual(exif.ifd(1000, endian), geotag._build_ifd(entries, 1000, endian))
+
+    @unittest.skipUnless(HAS_PYEXIV2, 'pyexiv2 is not installed')
+    def test_pyexiv2_gps_ifd(self):
+        # The template builds the same GPS IFD as pyexiv2 writes
+        for tags in [(49.9120223, -98.2690366, 261.64), (-83.0923535, 0.9235098, -30.5),
+                     (-10, 20, 189.99, 359.99)]:
+            shutil.copy('images/horse.jpg', 'images/horse_pyexiv2.jpg')
+            geotag.write_geo_tag('images/horse_pyexiv2.jpg', *tags, backend='pyexiv2')
+            with open('images/horse_pyexiv2.jpg', 'rb') as f:
+                (tiff, _) = geotag._read_app1_segments(f, read_xmp=False)
+            endian = '<' if tiff[:2] == b'II' else '>'
+            ifd0 = geotag._read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+            offset = struct.unpack_from(endian + 'I', tiff, ifd0[geotag._GPS_IFD_POINTER][2])[0]
+
+            (exif, _) = geotag._encode_geo_tags(*tags)
+            self.assertEqual(geotag._read_gps_entries(tiff).entries, exif.encode(endian))
+            ifd = exif.ifd(offset, endian)
+            self.assertEqual(tiff[offset:offset + len(ifd)], ifd)
+
+    def test_xmp_template(self):
+        for xmp in [{'Xmp.Attitude.Roll': '1.5'},
+                    {'Xmp.Attitude.Roll': '0', 'Xmp.Attitude.Pitch': '2.25', 'Xmp.Attitude.Yaw': '359.99'}]:
+            properties = ''.join('\n    Attitude:{}="{}"'.format(tag.rsplit('.', 1)[1], value)
+                                 for (tag, value) in xmp.items())
+            padding = (' ' * 99 + '\n') * (geotag._XMP_PADDING // 100)
+            self.assertEqual(geotag._new_attitude_xmp(xmp),
+                             geotag._XMP_PACKET.format(properties, padding).encode('utf-8'))
+
+    def test_update_template(self):
+        # The second write updates a GPS IFD holding only the tags geotag writes
+        shutil.copy('images/horse.jpg', 'images/horse_template.jpg')
+        geotag.write_geo_tag_fast('images/horse_template.jpg', 49.9120223, -98.2690366, 261.64)
+        geotag.write_geo_tag_fast('images/horse_template.jpg', -49.9120223, 98.2690366, 261.64, 45.2)
+        with open('images/horse_template.jpg', 'rb') as f:
+            (tiff, _) = geotag._read_app1_segments(f, read_xmp=False)
+        ifd0 = geotag._read_ifd(tiff, 8, '<')
+        offset = struct.unpack_from('<I', tiff, ifd0[geotag._GPS_IFD_POINTER][2])[0]
+
+        ifd = geotag._build_ifd(geotag._encode_gps_entries(self.reference_exif(-49.9120223, 98.2690366,
+                                                                               261.64, 45.2), '<'),
+                                offset, '<')
+        self.assertEqual(tiff[offset:offset + len(ifd)], ifd)
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_template.jpg', fields=['lat', 'hdg']),
+                         {'lat': -49.9120223, 'hdg': 45.2})
+
+
+class TestBuffer(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_buffer.jpg')
+
+    def test_read_geo_tag_buffer(self):
+        for path in ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg']:
+            with open(path, 'rb') as f:
+                data = f.read()
+                self.assertEqual(geotag.read_geo_tag_buffer(f), geotag.read_geo_tag(path))
+            self.assertEqual(geotag.read_geo_tag_buffer(data), geotag.read_geo_tag(path))
+            self.assertEqual(geotag.read_geo_tag_buffer(memoryview(data)), geotag.read_geo_tag(path))
+        with self.assertRaises(ValueError):
+            geotag.read_geo_tag_buffer(b'GIF89a')
+
+    def test_write_geo_tag_buffer(self):
+        with open('images/horse.jpg', 'rb') as f:
+            data = f.read()
+        retagged = geotag.write_geo_tag_buffer(data, -83.0923535, -0.9235098, 189.99, 359.99,
+                                               roll=123.1, yaw=103.23)
+        self.assertIsInstance(retagged, bytes)
+        self.assertEqual(retagged, geotag.write_geo_tag_buffer(
+            io.BytesIO(data), -83.0923535, -0.9235098, 189.99, 359.99, roll=123.1, yaw=103.23))
+        with open('images/horse.jpg', 'rb') as f:
+            self.assertEqual(retagged, geotag.write_geo_tag_buffer(
+                f, -83.0923535, -0.9235098, 189.99, 359.99, roll=123.1, yaw=103.23))
+        # Truncated scan data is reported, not padded
+        with self.assertRaises(ValueError):
+            geotag._read_into(io.BytesIO(data), len(data) - 2, memoryview(bytearray(4)))
+
+        with open('images/horse_buffer.jpg', 'wb') as f:
+            f.write(retagged)
+        expected = {
+            'lat': -83.0923535,
+            'lon': -0.9235098,
+            'alt': 189.99,
+            'hdg': 359.99,
+            'roll': 123.1,
+            'pitch': None,
+            'yaw': 103.23,
+        }
+        self.assertEqual(geotag.read_geo_tag('images/horse_buffer.jpg'), expected)
+        self.assertEqual(geotag.read_geo_tag_buffer(retagged), expected)
+        with self.assertRaises(ValueError):
+            geotag.write_geo_tag_buffer(b'GIF89a', 0, 0, 0)
+
+
+class TestTelemetry(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open('images/telemetry.csv', 'w') as f:
+            f.write('time,lat,lon,alt,hdg,yaw\n'
+                    '2015-08-08T16:09:50,49.0,-122.0,100,350,10\n'
+                    '2015-08-08T16:09:55,49.5,-122.5,105,10,20\n'
+                    '2015-08-08T16:10:00,49.0,-122.0,100,20,30\n')
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/telemetry.csv')
+        os.unlink('images/telemetry_gaps.csv')
+        os.unlink('images/Apples_telemetry.jpg')
+
+    def test_read_capture_time(self):
+        self.assertEqual(geotag.read_capture_time('images/Apples.jpg'),
+                         datetime(2015, 8, 8, 16, 9, 54, 556000))
+        with self.assertRaises(ValueError):
+            geotag.read_capture_time('images/horse.jpg')
+
+    def test_interpolate_angle(self):
+        self.assertAlmostEqual(geotag._interpolate_angle(350, 10, 0.25), 355)
+        self.assertAlmostEqual(geotag._interpolate_angle(350, 10, 0.75), 5)
+        self.assertAlmostEqual(geotag._interpolate_angle(10, 30, 0.5), 20)
+        self.assertEqual(geotag._interpolate_angle(359.999, 359.999, 0), 0)
+
+    def test_sync_telemetry(self):
+        results = geotag.sync_telemetry('images/telemetry.csv',
+                                        ['images/Apples.jpg', 'images/horse.jpg', 'images/img60.jpg'])
+        (path, tags, error) = results[0]
+        self.assertEqual(path, 'images/Apples.jpg')
+        self.assertIsNone(error)
+        self.assertAlmostEqual(tags['lat'], 49.4556)
+        self.assertAlmostEqual(tags['lon'], -122.4556)
+        self.assertAlmostEqual(tags['alt_abs'], 104.556)
+        self.assertAlmostEqual(tags['hdg'], 8.224)
+        self.assertAlmostEqual(tags['yaw'], 19.112)
+        self.assertIsNone(tags['roll'])
+        self.assertIsNone(tags['pitch'])
+        self.assertIsInstance(results[1][2], ValueError)
+        self.assertIsInstance(results[2][2], ValueError)
+
+        # Capture time 1 minute earlier in the log time base
+        (_, tags, error) = geotag.sync_telemetry('images/telemetry.csv', ['images/Apples.jpg'],
+                                                 time_offset=-60)[0]
+        self.assertIsInstance(error, ValueError)
+
+    def test_sync_telemetry_gaps(self):
+        # Rows without a position fix or a valid time are skipped, and the
+        # track crosses the antimeridian between the rows around the
+        # capture time
+        with open('images/telemetry_gaps.csv', 'w') as f:
+            f.write('time,lat,lon,alt\n'
+                    '2015-08-08T16:09:50,49.0,179.0,100\n'
+                    '2015-08-08T16:09:52,,,\n'
+                    ',10.0,10.0,10\n'
+                    '2015-08-08T16:09:53,49.2,179.5,\n'
+                    'not a time,10.0,10.0,10\n'
+                    'nan,10.0,10.0,10\n'
+                    '2015-08-08T16:09:55,49.5,-179.0,105\n')
+        (_, tags, error) = geotag.sync_telemetry('images/telemetry_gaps.csv', ['images/Apples.jpg'])[0]
+        self.assertIsNone(error)
+        self.assertAlmostEqual(tags['lat'], 49.4556)
+        self.assertAlmostEqual(tags['lon'], -179.1776)
+
+        with open('images/telemetry_gaps.csv', 'w') as f:
+            f.write('time,lat,lon,alt\n100,1,2,3\n,1,2,3\n200,1,2,3\n')
+        self.assertEqual([row['time'] for row in
+                          geotag._read_telemetry('images/telemetry_gaps.csv', None)],
+                         [100.0, 200.0])
+
+        before = dict(dict.fromkeys(geotag._TELEMETRY_ANGLES), time=0, lat=0, lon=-179.0, alt=0)
+        after = dict(dict.fromkeys(geotag._TELEMETRY_ANGLES), time=1, lat=0, lon=179.0, alt=0)
+        self.assertAlmostEqual(geotag._interpolate_telemetry(before, after, 0.25)['lon'], -179.5)
+        self.assertAlmostEqual(geotag._interpolate_telemetry(before, after, 0.75)['lon'], 179.5)
+        self.assertEqual(geotag._interpolate_telemetry(after, after, 0)['lon'], 179.0)
+
+    def test_write_geo_tags_from_telemetry(self):
+        shutil.copy('images/Apples.jpg', 'images/Apples_telemetry.jpg')
+        results = geotag.write_geo_tags_from_telemetry(
+            'images/telemetry.csv', ['images/Apples_telemetry.jpg', 'images/horse.jpg'])
+        self.assertIsNone(results[0][2])
+        self.assertIsInstance(results[1][2], ValueError)
+        tags = geotag.read_geo_tag('images/Apples_telemetry.jpg')
+        self.assertEqual(tags['lat'], 49.4556)
+        self.assertEqual(tags['hdg'], 8.22)
+
+
+class TestGeoTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = geotag.GeoTagIndex('images/index.db')
+        self.paths = [os.path.abspath('images/{}.jpg'.format(name))
+                      for name in ['Apples', 'img60', 'horse']]
+
+    def tearDown(self):
+        self.index.close()
+        os.unlink('images/index.db')
+        if os.path.exists('images/horse_index.jpg'):
+            os.unlink('images/horse_index.jpg')
+
+    def test_update(self):
+        self.assertEqual(self.index.update(self.paths), [(path, None) for path in self.paths])
+        # Unchanged files are not reread
+        self.assertEqual(self.index.update(self.paths), [])
+
+        shutil.copy('images/horse.jpg', 'images/horse_index.jpg')
+        path = os.path.abspath('images/horse_index.jpg')
+        self.index.update([path])
+        self.assertEqual(self.index.query_radius(-83.0923535, -0.9235098, 1), [])
+        geotag.write_geo_tag(path, -83.0923535, -0.9235098, 189.99)
+        self.assertEqual(self.index.update([path]), [(path, None)])
+        self.assertEqual([p for (p, _) in self.index.query_radius(-83.0923535, -0.9235098, 1)],
+                         [path])
+
+        os.unlink(path)
+        self.assertEqual(self.index.prune(), 1)
+        self.assertEqual(self.index.query_radius(-83.0923535, -0.9235098, 1), [])
+
+    def test_query_bbox(self):
+        self.index.update(self.paths)
+        self.assertEqual(self.index.query_bbox(49, -123, 50, -98),
+                         [(self.paths[0], geotag.read_geo_tag(self.paths[0])),
+                          (self.paths[1], geotag.read_geo_tag(self.paths[1]))])
+        self.assertEqual([path for (path, _) in self.index.query_bbox(49, -122, 50, -98)],
+                         [self.paths[1]])
+        self.assertEqual([path for (path, _) in self.index.query_bbox(-90, 170, 90, -110)],
+                         [self.paths[0]])
+        with self.assertRaises(ValueError):
+            self.index.query_bbox(-91, 0, 0, 0)
+
+    def test_query_radius(self):
+        self.index.update(self.paths)
+        self.assertEqual([path for (path, _) in self.index.query_radius(49.0278, -122.7727, 100)],
+                         [self.paths[0]])
+        self.assertEqual([path for (path, _) in self.index.query_radius(49.9, -98.3, 2000000)],
+                         [self.paths[1], self.paths[0]])
+        self.assertEqual(self.index.query_radius(0, 0, 1000), [])
+
+    def test_haversine(self):
+        self.assertAlmostEqual(geotag._haversine(0, 0, 0, 1), 111195.08, 2)
+        self.assertAlmostEqual(geotag._haversine(0, 179.5, 0, -179.5), 111195.08, 2)
+        self.assertEqual(geotag._haversine(49, -122, 49, -122), 0)
+
+
+class TestGeoTagQueue(unittest.TestCase):
+    def setUp(self):
+        self.paths = ['images/horse_queue_{}.jpg'.format(i) for i in range(4)]
+        for path in self.paths:
+            shutil.copy('images/horse.jpg', path)
+
+    def tearDown(self):
+        for path in self.paths + ['images/queue.db']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_run(self):
+        with geotag.GeoTagQueue('images/queue.db', max_attempts=2) as queue:
+            self.assertEqual(queue.put([(path, 10 + i, -20, 100) for (i, path)
+                                        in enumerate(self.paths)]), 4)
+            queue.put([{'img_path': 'images/missing.jpg', 'lat': 1, 'lon': 2, 'alt_abs': 3},
+                       ('images/horse_queue_0.jpg', geotag.GeoTag(1.5, 2.5, 3.5, yaw=4.5))])
+            self.assertEqual(queue.stats(), {'pending': 6, 'claimed': 0, 'done': 0, 'failed': 0})
+
+            self.assertEqual(queue.run(batch=2), {'done': 5, 'failed': 2})
+            self.assertEqual(queue.stats(), {'pending': 0, 'claimed': 0, 'done': 5, 'failed': 1})
+            [(_, record, error)] = queue.failed()
+            self.assertEqual(record['img_path'], 'images/missing.jpg')
+            self.assertTrue(error.startswith('FileNotFoundError'))
+
+            self.assertEqual(geotag.read_geo_tag('images/horse_queue_1.jpg')['lat'], 11.0)
+            self.assertEqual(geotag.read_geo_tag('images/horse_queue_0.jpg', fields=['lat', 'yaw']),
+                             {'lat': 1.5, 'yaw': 4.5})
+
+            self.assertEqual(queue.retry_failed(), 1)
+            self.assertEqual(queue.stats()['pending'], 1)
+
+    def test_run_processes(self):
+        with geotag.GeoTagQueue('images/queue.db') as queue:
+            queue.put([(path, 10 + i, -20, 100) for (i, path) in enumerate(self.paths)])
+            self.assertEqual(queue.run(jobs=2, batch=1), {'done': 4, 'failed': 0})
+            self.assertEqual(queue.stats()['done'], 4)
+        for (i, path) in enumerate(self.paths):
+            self.assertEqual(geotag.read_geo_tag(path, fields='lat'), {'lat': 10.0 + i})
+
+    def test_lease(self):
+        first = geotag.GeoTagQueue('images/queue.db', lease=0.05, max_attempts=2, worker='first')
+        second = geotag.GeoTagQueue('images/queue.db', lease=0.05, max_attempts=2,
+                                    worker='second')
+        first.put([(self.paths[0], 1, 2, 3)])
+
+        [(job_id, kwargs)] = first.claim()
+        self.assertEqual(kwargs['img_path'], self.paths[0])
+        self.assertEqual(second.claim(), [])
+
+        # The first worker "crashed", so its claim expires and passes on
+        time.sleep(0.1)
+        self.assertEqual([job for (job, _) in second.claim()], [job_id])
+        self.assertEqual(first.complete([(job_id, None)]), 0)
+        self.assertEqual(second.renew([job_id]), 1)
+
+        # Once out of attempts, an expired claim fails the job
+        time.sleep(0.1)
+        self.assertEqual(first.claim(), [])
+        self.assertEqual(first.stats()['failed'], 1)
+        first.close()
+        second.close()
+
+
+class TestGeoTagCache(unittest.TestCase):
+    def tearDown(self):
+        for path in ['images/cache.db', 'images/horse_cache.jpg']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_read(self):
+        cache = geotag.GeoTagCache(maxsize=2)
+        for path in ['images/Apples.jpg', 'images/img60.jpg', 'images/Apples.jpg',
+                     'images/horse.jpg', 'images/img60.jpg']:
+            self.assertEqual(cache.read(path), geotag.read_geo_tag(path))
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 4, 'evictions': 2, 'size': 2, 'maxsize': 2})
+
+        # Returned dicts are copies
+        cache.read('images/horse.jpg')['lat'] = 0
+        self.assertIsNone(cache.read('images/horse.jpg')['lat'])
+
+        with self.assertRaises(ValueError):
+            geotag.GeoTagCache(maxsize=0)
+
+    def test_invalidate_on_write(self):
+        cache = geotag.GeoTagCache()
+        shutil.copy('images/horse.jpg', 'images/horse_cache.jpg')
+        self.assertIsNone(cache.read('images/horse_cache.jpg')['lat'])
+        geotag.write_geo_tag('images/horse_cache.jpg', -83.0923535, -0.9235098, 189.99)
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.read('images/horse_cache.jpg')['lat'], -83.0923535)
+        geotag.write_geo_tag_fast('images/horse_cache.jpg', 83.0923535, -0.9235098, 189.99)
+        self.assertEqual(cache.read('images/horse_cache.jpg')['lat'], 83.0923535)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_persistent(self):
+        with geotag.GeoTagCache(db_path='images/cache.db') as cache:
+            cache.read('images/img60.jpg')
+        with geotag.GeoTagCache(db_path='images/cache.db') as cache:
+            self.assertEqual(cache.read('images/img60.jpg'), geotag.read_geo_tag('images/img60.jpg'))
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 0)
+
+
+class TestProfiling(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_profile.jpg')
+
+    def test_stage_stats(self):
+        stats = geotag.StageStats()
+        for seconds in [0.5e-6, 3e-6, 3e-6, 1e-3]:
+            stats.record('stage', seconds, 10)
+        exported = stats.to_dict()['stage']
+        self.assertEqual(exported['count'], 4)
+        self.assertEqual(exported['bytes'], 40)
+        self.assertEqual(exported['min'], 0.5e-6)
+        self.assertEqual(exported['max'], 1e-3)
+        self.assertEqual(exported['histogram'][0], [1e-6, 1])
+        self.assertEqual(exported['histogram'][2], [4e-6, 3])
+        self.assertEqual(exported['histogram'][-1], [None, 4])
+        self.assertEqual(stats.percentile('stage', 50), 4e-6)
+        self.assertEqual(stats.percentile('stage', 100), 1e-3)
+
+    @unittest.skipUnless(HAS_PYEXIV2, 'pyexiv2 is not installed')
+    def test_collect_stages(self):
+        shutil.copy('images/horse.jpg', 'images/horse_profile.jpg')
+        with geotag.collect_stages() as stats:
+            geotag.read_geo_tag('images/horse_profile.jpg', backend='pyexiv2')
+            geotag.write_geo_tag('images/horse_profile.jpg', -83.0923535, -0.9235098, 189.99,
+                                 backend='pyexiv2')
+        self.assertEqual(stats.stages(), [
+            'read_geo_tag.decode',
+            'read_geo_tag.get_tags',
+            'read_geo_tag.image_open',
+            'read_geo_tag.metadata_read',
+            'write_geo_tag.encode',
+            'write_geo_tag.image_open',
+            'write_geo_tag.metadata_read',
+            'write_geo_tag.metadata_write',
+            'write_geo_tag.set_tags',
+        ])
+        exported = stats.to_dict()
+        self.assertEqual(exported['read_geo_tag.metadata_read']['bytes'],
+                         os.path.getsize('images/horse.jpg'))
+        self.assertEqual(exported['write_geo_tag.metadata_write']['bytes'],
+                         os.path.getsize('images/horse_profile.jpg'))
+
+        # Nothing is recorded outside the context
+        geotag.read_geo_tag('images/horse_profile.jpg', backend='pyexiv2')
+        self.assertEqual(stats.to_dict()['read_geo_tag.decode']['count'], 1)
+
+    def test_collect_segment_stages(self):
+        # The segment backend reads and writes in one stage each
+        shutil.copy('images/horse.jpg', 'images/horse_profile.jpg')
+        with geotag.collect_stages() as stats:
+            geotag.read_geo_tag('images/horse_profile.jpg', backend='segment')
+            geotag.write_geo_tag('images/horse_profile.jpg', -83.0923535, -0.9235098, 189.99,
+                                 backend='segment')
+        self.assertEqual(stats.stages(), [
+            'read_geo_tag.decode',
+            'read_geo_tag.metadata_read',
+            'write_geo_tag.encode',
+            'write_geo_tag.metadata_write',
+        ])
+        # Only the segments are read, not the image data
+        exported = stats.to_dict()
+        self.assertGreater(exported['read_geo_tag.metadata_read']['bytes'], 0)
+        self.assertLess(exported['read_geo_tag.metadata_read']['bytes'],
+                        os.path.getsize('images/horse.jpg') // 2)
+
+        # Patching in place writes only the new segments
+        with geotag.collect_stages() as stats:
+            geotag.write_geo_tag('images/horse_profile.jpg', -83.0923535, -0.9235098, 180.5,
+                                 backend='segment')
+        nbytes = stats.to_dict()['write_geo_tag.metadata_write']['bytes']
+        self.assertGreater(nbytes, 0)
+        self.assertLess(nbytes, os.path.getsize('images/horse_profile.jpg') // 2)
+
+    def test_collect_stages_per_thread(self):
+        # A collector only records the stages run by its own thread
+        started = threading.Event()
+        done = threading.Event()
+        other_stages = []
+
+        def other():
+            with geotag.collect_stages() as other_stats:
+                started.set()
+                done.wait(5)
+            other_stages.extend(other_stats.stages())
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        started.wait(5)
+        with geotag.collect_stages() as stats:
+            geotag.read_geo_tag('images/horse.jpg', backend='segment')
+        done.set()
+        thread.join()
+        self.assertIn('read_geo_tag.metadata_read', stats.stages())
+        self.assertEqual(other_stages, [])
+
+    @unittest.skipUnless(HAS_PYEXIV2, 'pyexiv2 is not installed')
+    def test_custom_collector(self):
+        class Collector:
+            def __init__(self):
+                self.stages = []
+
+            def record(self, stage, seconds, nbytes):
+                self.stages.append(stage)
+
+        with geotag.collect_stages(Collector()) as collector:
+            geotag.read_geo_tag('images/horse.jpg', backend='pyexiv2')
+        self.assertEqual(collector.stages, ['read_geo_tag.image_open', 'read_geo_tag.metadata_read',
+                                            'read_geo_tag.get_tags', 'read_geo_tag.decode'])
+
+
+class TestBatch(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/Apples_batch.jpg')
+        os.unlink('images/horse_batch.jpg')
+
+    def test_read_geo_tags_batch(self):
+        paths = ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg']
+        for jobs in [1, 2]:
+            results = geotag.read_geo_tags_batch(paths, jobs=jobs, chunksize=1)
+            self.assertEqual([path for (path, _, _) in results], paths)
+            for (path, tags, error) in results:
+                self.assertIsNone(error)
+                self.assertEqual(tags, geotag.read_geo_tag(path))
+
+    def test_read_geo_tags_batch_errors(self):
+        results = geotag.read_geo_tags_batch(['images/missing.jpg', 'images/horse.jpg'], jobs=2)
+        self.assertEqual(results[0][0], 'images/missing.jpg')
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[0][2], Exception)
+        self.assertIsNone(results[1][2])
+        with self.assertRaises(ValueError):
+            geotag.read_geo_tags_batch(['images/horse.jpg'], jobs=0)
+
+    def test_write_geo_tags_batch(self):
+        for name in ['Apples', 'horse']:
+            img = Image.open('images/{}.jpg'.format(name))
+            img.save('images/{}_batch.jpg'.format(name))
+            img.close()
+        results = geotag.write_geo_tags_batch([
+            ('images/Apples_batch.jpg', -49.9120223, -98.2690366, 261.64),
+            {'img_path': 'images/horse_batch.jpg', 'lat': -83.0923535, 'lon': -0.9235098,
+             'alt_abs': 189.99, 'hdg': 359.99, 'roll': 123.1},
+            ('images/horse_batch.jpg', 91, 0, 0),
+        ], jobs=2, chunksize=1)
+        self.assertEqual([error is None for (_, _, error) in results], [True, True, False])
+        self.assertIsInstance(results[2][2], ValueError)
+        self.assertEqual(geotag.read_geo_tag('images/horse_batch.jpg'),
+                         {
+                             'lat': -83.0923535,
+                             'lon': -0.9235098,
+                             'alt': 189.99,
+                             'hdg': 359.99,
+                             'roll': 123.1,
+                             'pitch': None,
+                             'yaw': None,
+                         })
+
+
+class TestPropagate(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        for name in ['ref', 'Apples', 'horse']:
+            os.unlink('images/{}_propagate.jpg'.format(name))
+
+    def raw_tags(self, path):
+        with open(path, 'rb') as f:
+            return geotag._read_segment_tags(f, geotag._GPS_TAGS, geotag._ATTITUDE_TAGS)
+
+    def test_propagate_geo_tags(self):
+        targets = ['images/Apples_propagate.jpg', 'images/horse_propagate.jpg']
+        for jobs in [1, 2]:
+            shutil.copy('images/Apples.jpg', targets[0])
+            shutil.copy('images/horse.jpg', targets[1])
+            results = geotag.propagate_geo_tags('images/img60.jpg', targets, jobs=jobs,
+                                                chunksize=1)
+            self.assertEqual(results, [(path, True, None) for path in targets])
+            for path in targets:
+                self.assertEqual(self.raw_tags(path), self.raw_tags('images/img60.jpg'))
+                self.assertEqual(geotag.read_geo_tag_fast(path),
+                                 geotag.read_geo_tag_fast('images/img60.jpg'))
+
+    def test_exact_values(self):
+        # Rationals a float round trip would not give back
+        ref = 'images/ref_propagate.jpg'
+        shutil.copy('images/horse.jpg', ref)
+        geotag._write_segments(ref, {
+            'Exif.GPSInfo.GPSLatitude': [Fraction(49), Fraction(7), Fraction(1, 3)],
+            'Exif.GPSInfo.GPSLatitudeRef': 'N',
+            'Exif.GPSInfo.GPSLongitude': [Fraction(98), Fraction(16), Fraction(2, 7)],
+            'Exif.GPSInfo.GPSLongitudeRef': 'W',
+            'Exif.GPSInfo.GPSAltitude': Fraction(1000, 3),
+            'Exif.GPSInfo.GPSAltitudeRef': b'1',
+        }, {'Xmp.Attitude.Roll': '1.23456789012345'})
+
+        target = 'images/Apples_propagate.jpg'
+        shutil.copy('images/Apples.jpg', target)
+        self.assertEqual(geotag.propagate_geo_tags(ref, [target]), [(target, True, None)])
+        exif, xmp = self.raw_tags(target)
+        self.assertEqual(exif['Exif.GPSInfo.GPSLatitude'][2], Fraction(1, 3))
+        self.assertEqual(exif['Exif.GPSInfo.GPSAltitude'], Fraction(1000, 3))
+        self.assertEqual(xmp, {'Xmp.Attitude.Roll': '1.23456789012345'})
+        self.assertEqual((exif, xmp), self.raw_tags(ref))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            geotag.propagate_geo_tags('images/horse.jpg', ['images/Apples.jpg'])
+        results = geotag.propagate_geo_tags('images/img60.jpg', ['images/missing.jpg'])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[0][2], OSError)
+
+
+class TestExport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Images taken in the reverse order of their names, after img60,
+        # plus one without a capture time or geotags
+        cls.paths = []
+        for i in range(4):
+            path = 'images/export_{}.jpg'.format(i)
+            img = Image.new('RGB', (8, 8))
+            exif = Image.Exif()
+            exif.get_ifd(0x8769)[0x9003] = '2020:01:01 00:00:{:02d}'.format(50 - 10 * i)
+            img.save(path, exif=exif)
+            img.close()
+            geotag.write_geo_tag(path, 10 + i, -20 - i, 100 + i, hdg=90)
+            cls.paths.append(path)
+        shutil.copy('images/img60.jpg', 'images/export_4.jpg')
+        shutil.copy('images/horse.jpg', 'images/export_5.jpg')
+        cls.paths += ['images/export_4.jpg', 'images/export_5.jpg']
+
+    @classmethod
+    def tearDownClass(cls):
+        for path in cls.paths:
+            os.unlink(path)
+
+    def test_sort_by_capture_time(self):
+        for run_size in [2, 100]:
+            self.assertEqual(list(geotag._sort_by_capture_time(self.paths, 1, run_size)), [
+                ('images/export_4.jpg', datetime(2014, 4, 25, 9, 51, 29, 720000)),
+                ('images/export_3.jpg', datetime(2020, 1, 1, 0, 0, 20)),
+                ('images/export_2.jpg', datetime(2020, 1, 1, 0, 0, 30)),
+                ('images/export_1.jpg', datetime(2020, 1, 1, 0, 0, 40)),
+                ('images/export_0.jpg', datetime(2020, 1, 1, 0, 0, 50)),
+                ('images/export_5.jpg', None),
+            ])
+
+    def test_geojson(self):
+        for jobs in [1, 2]:
+            output = io.StringIO()
+            self.assertEqual(geotag.export_geo_tags(self.paths, output, jobs=jobs), 5)
+            collection = json.loads(output.getvalue())
+            features = collection['features']
+            self.assertEqual([feature['properties']['path'] for feature in features],
+                             ['images/export_{}.jpg'.format(i) for i in [4, 3, 2, 1, 0]])
+            self.assertEqual(features[1]['geometry'],
+                             {'type': 'Point', 'coordinates': [-23.0, 13.0, 103.0]})
+            self.assertEqual(features[0]['properties']['time'], '2014-04-25T09:51:29.720000')
+            self.assertEqual(features[1]['properties']['time'], '2020-01-01T00:00:20')
+            self.assertEqual(features[1]['properties']['hdg'], 90.0)
+
+    def test_gpx_kml(self):
+        gpx = ElementTree.fromstring(''.join(geotag.iter_export_geo_tags(self.paths, 'gpx')))
+        points = gpx.findall('.//{http://www.topografix.com/GPX/1/1}trkpt')
+        self.assertEqual([point.get('lat') for point in points],
+                         ['49.9120223', '13.0', '12.0', '11.0', '10.0'])
+        # The heading is an extension, not the magnetic variation
+        self.assertIsNone(points[1].find('{http://www.topografix.com/GPX/1/1}magvar'))
+        self.assertEqual(points[1].find('{http://www.topografix.com/GPX/1/1}extensions/{geotag/}heading').text,
+                         '90.0')
+        self.assertEqual(list(points[1])[-1].tag, '{http://www.topografix.com/GPX/1/1}extensions')
+
+        kml = ElementTree.fromstring(''.join(geotag.iter_export_geo_tags(self.paths, 'kml')))
+        coordinates = kml.findall('.//{http://www.opengis.net/kml/2.2}coordinates')
+        self.assertEqual(coordinates[1].text, '-23.0,13.0,103.0')
+        self.assertEqual(len(coordinates), 5)
+
+        with self.assertRaises(ValueError):
+            list(geotag.iter_export_geo_tags(self.paths, 'shp'))
+
+
+class TestSelectiveRead(unittest.TestCase):
+    def test_read_fields(self):
+        for read in [geotag.read_geo_tag, geotag.read_geo_tag_fast]:
+            self.assertEqual(read('images/img60.jpg', fields=['lat', 'lon']),
+                             {'lat': 49.9120223, 'lon': -98.2690366})
+            self.assertEqual(read('images/img60.jpg', fields='hdg'), {'hdg': 45.2})
+            self.assertEqual(read('images/img60.jpg', fields=['lat'], as_record=True),
+                             geotag.GeoTag(lat=49.9120223))
+            with self.assertRaises(ValueError):
+                read('images/img60.jpg', fields=['lat', 'altitude'])
+
+    def test_read_fields_skips_xmp(self):
+        with open('images/img60.jpg', 'rb') as f:
+            data = geotag.write_geo_tag_buffer(f.read(), 49.9120223, -98.2690366, 261.64,
+                                               roll=1.5)
+        with mock.patch('geotag._parse_attitude_xmp') as parse:
+            self.assertEqual(geotag.read_geo_tag_buffer(data, fields=['lat', 'lon', 'alt']),
+                             {'lat': 49.9120223, 'lon': -98.2690366, 'alt': 261.64})
+            parse.assert_not_called()
+        self.assertEqual(geotag.read_geo_tag_buffer(data, fields=['roll']), {'roll': 1.5})
+
+    def test_batch_fields(self):
+        paths = ['images/Apples.jpg', 'images/img60.jpg']
+        results = geotag.read_geo_tags_batch(paths, jobs=1, fields=['lat'])
+        self.assertEqual([tags for (_, tags, _) in results],
+                         [{'lat': 49.0278408}, {'lat': 49.9120223}])
+        columns = geotag.read_geo_tags_batch(paths, jobs=1, fields=['lat'], columnar=True)
+        self.assertEqual(list(columns.lat), [49.0278408, 49.9120223])
+        self.assertTrue(all(math.isnan(value) for value in columns.lon))
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_skip.jpg')
+
+    def test_skip_unchanged(self):
+        shutil.copy('images/horse.jpg', 'images/horse_skip.jpg')
+        tags = ('images/horse_skip.jpg', 49.9120223, -98.2690366, 261.64, 45.2, 1.5, None, 3.25)
+        self.assertTrue(geotag.write_geo_tag(*tags, skip_unchanged=True))
+        mtime = os.stat('images/horse_skip.jpg').st_mtime_ns
+        self.assertFalse(geotag.write_geo_tag(*tags, skip_unchanged=True))
+        self.assertEqual(os.stat('images/horse_skip.jpg').st_mtime_ns, mtime)
+
+        # Differences below the encoded precision don't count
+        self.assertFalse(geotag.write_geo_tag('images/horse_skip.jpg', 49.9120223, -98.2690366,
+                                              261.64, hdg=45.201, skip_unchanged=True))
+        self.assertTrue(geotag.write_geo_tag('images/horse_skip.jpg', 49.9120223, -98.2690366,
+                                             261.64, yaw=3.5, skip_unchanged=True))
+        self.assertTrue(geotag.write_geo_tag('images/horse_skip.jpg', 49.9120223, -98.2690366,
+                                             261.64, pitch=1, skip_unchanged=True))
+
+    def test_batch_skip_unchanged(self):
+        shutil.copy('images/horse.jpg', 'images/horse_skip.jpg')
+        records = [('images/horse_skip.jpg', 10.5, -20.25, 100.0)]
+        for written in [True, False]:
+            results = geotag.write_geo_tags_batch(records, jobs=1, skip_unchanged=True)
+            self.assertEqual(results, [('images/horse_skip.jpg', written, None)])
+
+
+class TestSidecar(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/Apples_sidecar.jpg')
+        os.unlink('images/Apples_sidecar.jpg.xmp')
+        for path in ['images/p_sidecar.jpg', 'images/p_sidecar.mpo']:
+            os.unlink(path)
+            os.unlink(path + '.xmp')
+
+    def test_write_read_sidecar(self):
+        shutil.copy('images/Apples.jpg', 'images/Apples_sidecar.jpg')
+        with open('images/Apples_sidecar.jpg', 'rb') as f:
+            data = f.read()
+
+        args = ('images/Apples_sidecar.jpg', -10.1234567, 20.2, 5.5)
+        self.assertTrue(geotag.write_geo_tag(*args, roll=1.5, sidecar=True))
+        self.assertFalse(geotag.write_geo_tag(*args, roll=1.5, sidecar=True, skip_unchanged=True))
+        self.assertTrue(geotag.write_geo_tag(*args, yaw=3.25, sidecar=True, skip_unchanged=True))
+        with open('images/Apples_sidecar.jpg', 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        expected = {
+            'lat': -10.1234567,
+            'lon': 20.2,
+            'alt': 5.5,
+            'hdg': None,
+            'roll': 1.5,
+            'pitch': None,
+            'yaw': 3.25,
+        }
+        self.assertEqual(geotag.read_geo_tag('images/Apples_sidecar.jpg', sidecar=True), expected)
+        self.assertEqual(geotag.read_geo_tag_fast('images/Apples_sidecar.jpg', sidecar=True),
+                         expected)
+        self.assertEqual(geotag.read_geo_tag('images/Apples_sidecar.jpg'),
+                         geotag.read_geo_tag('images/Apples.jpg'))
+
+    def test_merge_sidecar(self):
+        shutil.copy('images/img60.jpg', 'images/Apples_sidecar.jpg')
+        with open('images/Apples_sidecar.jpg.xmp', 'wb') as f:
+            f.write(b'<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+                    b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+                    b'<rdf:Description xmlns:exif="http://ns.adobe.com/exif/1.0/">'
+                    b'<exif:GPSLatitude>10,30.5S</exif:GPSLatitude>'
+                    b'<exif:GPSLongitude>20,15,0E</exif:GPSLongitude>'
+                    b'</rdf:Description></rdf:RDF></x:xmpmeta>')
+
+        # Sidecar fields win, the rest come from the image
+        self.assertEqual(geotag.read_geo_tag('images/Apples_sidecar.jpg', sidecar=True),
+                         {
+                             'lat': -10.5083333,
+                             'lon': 20.25,
+                             'alt': 261.64,
+                             'hdg': 45.2,
+                             'roll': None,
+                             'pitch': None,
+                             'yaw': None,
+                         })
+
+    def test_sidecar_collision(self):
+        # Images differing only in extension each get their own sidecar
+        shutil.copy('images/Apples.jpg', 'images/p_sidecar.jpg')
+        shutil.copy('images/Apples.jpg', 'images/p_sidecar.mpo')
+        geotag.write_geo_tag('images/p_sidecar.jpg', 10.5, 20.5, 30.5, sidecar=True)
+        geotag.write_geo_tag('images/p_sidecar.mpo', -40.5, -50.5, 60.5, sidecar=True)
+        self.assertTrue(os.path.exists('images/p_sidecar.jpg.xmp'))
+        self.assertTrue(os.path.exists('images/p_sidecar.mpo.xmp'))
+
+        jpg = geotag.read_geo_tag('images/p_sidecar.jpg', sidecar=True)
+        mpo = geotag.read_geo_tag('images/p_sidecar.mpo', sidecar=True)
+        self.assertEqual((jpg['lat'], jpg['lon'], jpg['alt']), (10.5, 20.5, 30.5))
+        self.assertEqual((mpo['lat'], mpo['lon'], mpo['alt']), (-40.5, -50.5, 60.5))
+
+
+class TestGeoTagRecord(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_record.jpg')
+
+    def test_record(self):
+        tag = geotag.GeoTag(lat=10.5, lon=-20.25, alt=100.0, yaw=12.5)
+        self.assertFalse(hasattr(tag, '__dict__'))
+        self.assertEqual(tag.to_dict(), {'lat': 10.5, 'lon': -20.25, 'alt': 100.0, 'hdg': None,
+                                         'roll': None, 'pitch': None, 'yaw': 12.5})
+        self.assertEqual(geotag.GeoTag.from_dict(tag.to_dict()), tag)
+        self.assertEqual(pickle.loads(pickle.dumps(tag)), tag)
+        self.assertNotEqual(tag, geotag.GeoTag(lat=10.5))
+
+    def test_write_read_record(self):
+        shutil.copy('images/horse.jpg', 'images/horse_record.jpg')
+        tag = geotag.GeoTag(lat=-83.0923535, lon=-0.9235098, alt=189.99, hdg=359.99, roll=123.1)
+        geotag.write_geo_tag('images/horse_record.jpg', tag)
+        self.assertEqual(geotag.read_geo_tag('images/horse_record.jpg', as_record=True), tag)
+        self.assertEqual(geotag.read_geo_tag_fast('images/horse_record.jpg', as_record=True), tag)
+
+        with self.assertRaises(ValueError):
+            geotag.write_geo_tag('images/horse_record.jpg', geotag.GeoTag(lat=1, lon=2))
+        with self.assertRaises(ValueError):
+            geotag.write_geo_tag('images/horse_record.jpg', 1, 2)
+
+    def test_columnar_batch(self):
+        paths = ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg',
+                 'images/missing.jpg']
+        for jobs in [1, 2]:
+            columns = geotag.read_geo_tags_batch(paths, jobs=jobs, chunksize=1, columnar=True)
+            self.assertEqual(len(columns), 4)
+            self.assertEqual(columns.paths, paths)
+            self.assertEqual([error is None for error in columns.errors],
+                             [True, True, True, False])
+            self.assertEqual(list(columns.lat[:2]), [49.0278408, 49.9120223])
+            self.assertTrue(math.isnan(columns.lat[2]))
+            self.assertTrue(math.isnan(columns.hdg[0]))
+            self.assertEqual(columns.hdg[1], 45.2)
+            self.assertEqual(columns.record(1),
+                             geotag.read_geo_tag('images/img60.jpg', as_record=True))
+            self.assertEqual(sorted(columns.to_dict()), sorted(('path',) + geotag.GeoTag.__slots__))
+
+        # Columns are copies, so they can be edited and the container grown
+        lat = columns.lat
+        lat[1] = 99
+        columns.append('images/extra.jpg', {'lat': 1.5})
+        self.assertEqual(columns.record(1).lat, 49.9120223)
+        self.assertEqual(list(columns.to_dict()['lat'][:2]), [49.0278408, 49.9120223])
+        self.assertEqual(columns.lat[4], 1.5)
+
+
+class TestAsync(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink('images/horse_async.jpg')
+
+    def test_read_write_async(self):
+        shutil.copy('images/horse.jpg', 'images/horse_async.jpg')
+
+        async def run():
+            await geotag.write_geo_tag_async('images/horse_async.jpg', 10.5, -20.25, 100,
+                                             hdg=90, yaw=12.5)
+            return await geotag.read_geo_tag_async('images/horse_async.jpg')
+
+        self.assertEqual(asyncio.run(run()),
+                         {
+                             'lat': 10.5,
+                             'lon': -20.25,
+                             'alt': 100.0,
+                             'hdg': 90.0,
+                             'roll': None,
+                             'pitch': None,
+                             'yaw': 12.5,
+                         })
+
+    def test_read_many(self):
+        paths = ['images/Apples.jpg', 'images/img60.jpg', 'images/horse.jpg',
+                 'images/missing.jpg']
+
+        async def paths_async():
+            for path in paths:
+                yield path
+
+        async def run():
+            async with geotag.AsyncGeoTagger(max_open=2) as tagger:
+                return [result async for result in tagger.read_many(paths_async())]
+
+        results = {path: (tags, error) for (path, tags, error) in asyncio.run(run())}
+        self.assertEqual(sorted(results), sorted(paths))
+        for path in paths[:3]:
+            self.assertEqual(results[path], (geotag.read_geo_tag(path), None))
+        self.assertIsNone(results['images/missing.jpg'][0])
+        self.assertIsInstance(results['images/missing.jpg'][1], Exception)
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def reader(img_path):
+            started.set()
+            release.wait(5)
+            return img_path
+
+        async def run():
+            tagger = geotag.AsyncGeoTagger(max_open=1, reader=reader)
+            running = asyncio.ensure_future(tagger.read('a'))
+            waiting = asyncio.ensure_future(tagger.read('b'))
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            for task in [running, waiting]:
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            # The running read still holds its slot until it returns
+            self.assertTrue(tagger._semaphore.locked())
+            release.set()
+            self.assertEqual(await asyncio.wait_for(tagger.read('c'), 5), 'c')
+            await tagger.close()
+
+        asyncio.run(run())
+
+
+class TestBoundedMemory(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        for path in ['images/frames.mpo', 'images/large.jpg']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def frame_tags(self, path):
+        with open(path, 'rb') as f:
+            frames = geotag._read_mp_index(f)['frames']
+            tags = []
+            for (offset, _) in frames:
+                f.seek(offset)
+                tags.append(geotag._read_segment_geo_tags(f, ['lat', 'hdg']))
+        return tags
+
+    def test_image_format(self):
+        frames = [Image.new('RGB', (64, 48), color) for color in ['red', 'green']]
+        frames[0].save('images/frames.mpo', 'MPO', save_all=True, append_images=frames[1:])
+        self.assertEqual(geotag._check_image_format('images/Apples.jpg'), 'JPEG')
+        self.assertEqual(geotag._check_image_format('images/frames.mpo'), 'MPO')
+        with self.assertRaises(ValueError):
+            geotag._check_image_format('test_geotag.py')
+
+    def test_mpo_frames(self):
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+        frames = [Image.new('RGB', (64, 48), color) for color in colors]
+        frames[0].save('images/frames.mpo', 'MPO', save_all=True, append_images=frames[1:])
+
+        self.assertFalse(geotag.write_geo_tag_fast('images/frames.mpo', 49.9120223, -98.2690366,
+                                                   261.64, hdg=45.2, frames='all'))
+        self.assertEqual(self.frame_tags('images/frames.mpo'),
+                         [{'lat': 49.9120223, 'hdg': 45.2}] * 3)
+
+        # Only frame 1 changes, in place
+        self.assertTrue(geotag.write_geo_tag_fast('images/frames.mpo', 49.9120223, -98.2690366,
+                                                  261.64, hdg=90, frames=[1]))
+        self.assertEqual([tags['hdg'] for tags in self.frame_tags('images/frames.mpo')],
+                         [45.2, 90.0, 45.2])
+        with self.assertRaises(ValueError):
+            geotag.write_geo_tag_fast('images/frames.mpo', 0, 0, 0, frames=[3])
+
+        # The MP Index still points at every frame
+        with Image.open('images/frames.mpo') as img:
+            self.assertEqual(img.format, 'MPO')
+            self.assertEqual(img.n_frames, 3)
+            for (i, color) in enumerate(colors):
+                img.seek(i)
+                self.assertTrue(all(abs(a - b) < 8 for (a, b) in zip(img.getpixel((8, 8)), color)))
+
+    @unittest.skipIf(sys.platform != 'linux', 'peak RSS is measured with resource on linux')
+    def test_peak_rss(self):
+        # 64 MiB of scan data, which the segment functions never read
+        with open('images/horse.jpg', 'rb') as f:
+            data = f.read()
+        block = os.urandom(1 << 20)
+        with open('images/large.jpg', 'wb') as f:
+            f.write(data[:-2])
+            for _ in range(64):
+                f.write(block)
+            f.write(data[-2:])
+
+        code = (
+            'import os, sys, resource, geotag\n'
+            'if sys.argv[2] == "buffer":\n'
+            '    del os.sendfile\n'
+            'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+            'geotag.write_geo_tag_fast(sys.argv[1], 49.9120223, -98.2690366, 261.64, hdg=45.2,\n'
+            '                          frames="all", buffer_size=1 << 16)\n'
+            'assert geotag.read_geo_tag_fast(sys.argv[1])["hdg"] == 45.2\n'
+            'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)\n'
+        )
+        for mode in ['sendfile', 'buffer']:
+            output = subprocess.run([sys.executable, '-c', code, 'images/large.jpg', mode],
+                                    check=True, capture_output=True, text=True).stdout
+            # Peak RSS grows by less than 8 MiB (ru_maxrss is in KiB)
+            self.assertLess(int(output), 8 * 1024, mode)
+        self.assertGreater(os.path.getsize('images/large.jpg'), 64 << 20)
+
+
+class TestBackends(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        for backend in ['pillow', 'segment']:
+            os.remove('images/horse_{}.jpg'.format(backend))
+        os.remove('images/backend.png')
+
+    def test_read(self):
+        Image.new('RGB', (8, 8)).save('images/backend.png')
+        for backend in ['pillow', 'segment']:
+            for name in ['Apples', 'img60', 'horse']:
+                path = 'images/{}.jpg'.format(name)
+                self.assertEqual(geotag.read_geo_tag(path, backend=backend),
+                                 geotag.read_geo_tag_fast(path))
+            self.assertEqual(geotag.read_geo_tag('images/img60.jpg', fields=['hdg'],
+                                                 backend=backend), {'hdg': 45.2})
+            with self.assertRaises(ValueError):
+                geotag.read_geo_tag('images/backend.png', backend=backend)
+
+    def test_write(self):
+        for backend in ['pillow', 'segment']:
+            path = 'images/horse_{}.jpg'.format(backend)
+            shutil.copy('images/horse.jpg', path)
+            self.assertTrue(geotag.write_geo_tag(path, 49.9120223, -98.2690366, 261.64,
+                                                 hdg=45.2, roll=123.1, backend=backend))
+            self.assertFalse(geotag.write_geo_tag(path, 49.9120223, -98.2690366, 261.64,
+                                                  hdg=45.2, roll=123.1, skip_unchanged=True,
+                                                  backend=backend))
+            for reader in ['pillow', 'segment']:
+                tags = geotag.read_geo_tag(path, backend=reader)
+                self.assertEqual(tags['lat'], 49.9120223)
+                self.assertEqual(tags['alt'], 261.64)
+                self.assertEqual(tags['roll'], 123.1)
+
+    def test_select_backend(self):
+        self.assertIn(geotag.get_backend(), ['pyexiv2', 'pillow', 'segment'])
+        with self.assertRaises(ValueError):
+            geotag.read_geo_tag('images/Apples.jpg', backend='exiftool')
+        with self.assertRaises(ValueError):
+            geotag.set_backend('exiftool')
+
+        with mock.patch.dict(os.environ), mock.patch.object(geotag, '_backend', None):
+            os.environ['GEOTAG_BACKEND'] = 'pillow'
+            self.assertEqual(geotag.get_backend(), 'pillow')
+            geotag.set_backend('segment')
+            self.assertEqual(geotag.get_backend(), 'segment')
+            self.assertEqual(os.environ['GEOTAG_BACKEND'], 'segment')
+            with mock.patch.object(geotag._SegmentBackend, 'read',
+                                   return_value=({}, {})) as read:
+                geotag.read_geo_tag('images/Apples.jpg')
+            read.assert_called_once()
+
+    def test_lazy_imports(self):
+        # Backends and numpy are imported when first used, not with geotag
+        code = ('import sys, geotag; '
+                'print([m for m in ["pyexiv2", "PIL", "numpy", "asyncio"] if m in sys.modules])')
+        output = subprocess.run([sys.executable, '-c', code], check=True,
+                                capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy('images/horse.jpg', 'images/horse_server.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.unlink('images/horse_server.jpg')
+
+    def start(self, address, **kwargs):
+        server = geotag.GeoTagServer(address, jobs=1, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server
+
+    def test_read_write(self):
+        address = os.path.join(self.directory, 'geotag.sock')
+        self.start(address)
+        with geotag.GeoTagClient(address, timeout=10) as client:
+            self.assertEqual(client.read('images/img60.jpg'), geotag.read_geo_tag('images/img60.jpg'))
+            self.assertTrue(client.write('images/horse_server.jpg', 10.5, -20.25, 100, hdg=90))
+            self.assertEqual(client.read('images/horse_server.jpg', fields=['lat', 'hdg']),
+                             {'lat': 10.5, 'hdg': 90.0})
+            with self.assertRaises(FileNotFoundError):
+                client.read('images/missing.jpg')
+            with self.assertRaises(ValueError):
+                client.write('images/horse_server.jpg', 91, 0, 0)
+
+            paths = ['images/Apples.jpg', 'images/img60.jpg', 'images/missing.jpg'] * 20
+            results = list(client.read_many(paths, window=8))
+            self.assertEqual(sorted(path for (path, _, _) in results), sorted(paths))
+            self.assertEqual(sum(error is not None for (_, _, error) in results), 20)
+
+            stats = client.stats()
+            self.assertEqual(stats['requests'], 65)
+            self.assertEqual(stats['errors'], 22)
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(stats['in_flight'], 0)
+            self.assertEqual(stats['latency']['read']['count'], 63)
+
+    def test_close_rejects_queued(self):
+        address = os.path.join(self.directory, 'geotag.sock')
+        server = self.start(address)
+        # Stop the dispatcher as close does, before the request is queued
+        server._queue.put(None)
+        server._dispatcher.join()
+
+        with geotag.GeoTagClient(address, timeout=10) as client:
+            errors = []
+
+            def read():
+                try:
+                    client.read('images/img60.jpg')
+                except Exception as e:
+                    errors.append(e)
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            deadline = time.monotonic() + 10
+            while server.stats()['queue_depth'] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            server.close()
+            reader.join(10)
+            self.assertFalse(reader.is_alive())
+            self.assertEqual(len(errors), 1)
+            self.assertIsInstance(errors[0], RuntimeError)
+            self.assertIn('shutting down', str(errors[0]))
+        self.assertEqual(server.stats()['errors'], 1)
+
+    def test_backpressure(self):
+        address = os.path.join(self.directory, 'geotag.sock')
+        server = self.start(address, batch=4, max_queue=8)
+        release = threading.Event()
+
+        def read(img_path, **kwargs):
+            release.wait(10)
+            return {'lat': None}
+
+        with mock.patch.object(geotag, 'read_geo_tag', read), \
+                geotag.GeoTagClient(address, timeout=10) as client:
+            results = []
+            reader = threading.Thread(target=lambda: results.extend(
+                client.read_many(['images/img60.jpg'] * 100, window=100)))
+            reader.start()
+
+            # Two batches run while the queue fills, then the connection
+            # is no longer read
+            deadline = time.monotonic() + 10
+            while server.stats()['queue_depth'] < 8 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            stats = server.stats()
+            self.assertEqual(stats['queue_depth'], 8)
+            self.assertEqual(stats['in_flight'], 8)
+            self.assertEqual(stats['requests'], 0)
+
+            release.set()
+            reader.join(10)
+            self.assertEqual(len(results), 100)
+            stats = server.stats()
+            self.assertEqual(stats['requests'], 100)
+            self.assertLessEqual(stats['max_queue_depth'], 8)
+            self.assertLess(stats['batches'], 100)
+
+    def test_tcp_latency(self):
+        server = self.start(('127.0.0.1', 0))
+        with geotag.GeoTagClient(server.address, timeout=10) as client:
+            latencies = []
+            for _ in range(200):
+                start = time.perf_counter()
+                client.read('images/img60.jpg', fields=['lat'])
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        self.assertLess(latencies[198], 0.05)
+
+    def test_bad_requests(self):
+        address = os.path.join(self.directory, 'geotag.sock')
+        self.start(address)
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(address)
+            sock.sendall(b'not json\n{"id": 1, "op": "delete", "path": "a.jpg"}\n'
+                         b'{"id": 2, "op": "read"}\n')
+            sock.shutdown(socket.SHUT_WR)
+            lines = [json.loads(line) for line in sock.makefile('rb')]
+        self.assertEqual([line['id'] for line in lines], [None, 1, 2])
+        self.assertTrue(lines[0]['error'].startswith('JSONDecodeError'))
+        self.assertEqual(lines[1]['error'], "ValueError: Unknown op 'delete'")
+        self.assertEqual(lines[2]['error'], 'ValueError: Missing path')
+
+
+class TestCommandLine(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree('images/cli', ignore_errors=True)
+
+    def run_main(self, argv):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            status = geotag.main(argv + ['--no-progress'])
+        return status, [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_read(self):
+        paths = ['images/Apples.jpg', 'images/img60.jpg', 'images/missing.jpg']
+        status, lines = self.run_main(['read', '--jobs', '2'] + paths)
+        self.assertEqual(status, 1)
+        self.assertEqual([line['path'] for line in lines], paths)
+        self.assertEqual(lines[0]['lat'], 49.0278408)
+        self.assertEqual(lines[1]['hdg'], 45.2)
+        self.assertIn('error', lines[2])
+
+    def test_scan_and_write(self):
+        os.makedirs('images/cli/sub', exist_ok=True)
+        shutil.copy('images/Apples.jpg', 'images/cli/Apples.jpg')
+        shutil.copy('images/horse.jpg', 'images/cli/sub/horse.JPG')
+        open('images/cli/notes.txt', 'w').close()
+
+        status, lines = self.run_main(['scan', 'images/cli', '--untagged'])
+        self.assertEqual(status, 0)
+        self.assertEqual([line['path'] for line in lines],
+                         [os.path.join('images/cli/sub', 'horse.JPG')])
+
+        with open('images/cli/records.jsonl', 'w') as f:
+            f.write(json.dumps({'path': 'images/cli/sub/horse.JPG', 'lat': 10.5,
+                                'lon': -20.25, 'alt': 100, 'hdg': 90}) + '\n')
+        status, lines = self.run_main(['write', 'images/cli/records.jsonl', '--jobs', '1'])
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [{'path': 'images/cli/sub/horse.JPG'}])
+
+        status, lines = self.run_main(['scan', 'images/cli', '--tagged', '--jobs', '2'])
+        self.assertEqual([line['path'] for line in lines],
+                         [os.path.join('images/cli', 'Apples.jpg'),
+                          os.path.join('images/cli/sub', 'horse.JPG')])
+        self.assertEqual(lines[1]['lat'], 10.5)
+        self.assertEqual(lines[1]['hdg'], 90.0)
+
+    def test_write_bad_records(self):
+        os.makedirs('images/cli', exist_ok=True)
+        shutil.copy('images/horse.jpg', 'images/cli/horse_records.jpg')
+        with open('images/cli/bad.jsonl', 'w') as f:
+            f.write(json.dumps({'path': 'images/cli/horse_records.jpg', 'lat': 1, 'lon': 2, 'alt': 3}) + '\n')
+            f.write('{"path": "images/cli/horse_records.jpg", "lat": \n')
+            f.write(json.dumps({'path': 'images/cli/horse_records.jpg', 'lat': 'north', 'lon': 2,
+                                'alt': 3}) + '\n')
+            f.write(json.dumps({'path': 'images/cli/horse_records.jpg', 'lat': 4, 'lon': 5, 'alt': 6}) + '\n')
+        for jobs in ['1', '2']:
+            status, lines = self.run_main(['write', 'images/cli/bad.jsonl', '--jobs', jobs])
+            self.assertEqual(status, 1)
+            self.assertEqual([line['path'] for line in lines],
+                             ['images/cli/horse_records.jpg', None, 'images/cli/horse_records.jpg',
+                              'images/cli/horse_records.jpg'])
+            self.assertTrue(lines[1]['error'].startswith('ValueError: Invalid record on line 2'))
+            self.assertTrue(lines[2]['error'].startswith('ValueError: Invalid record on line 3'))
+            self.assertNotIn('error', lines[3])
+        self.assertEqual(geotag.read_geo_tag_fast('images/cli/horse_records.jpg', fields=['lat']),
+                         {'lat': 4.0})
+
+        with open('images/cli/bad.csv', 'w') as f:
+            f.write('img_path,lat,lon,alt\nimages/cli/horse_records.jpg,1,x,3\n'
+                    'images/cli/horse_records.jpg,7,8,9\n')
+        status, lines = self.run_main(['write', 'images/cli/bad.csv', '--jobs', '1'])
+        self.assertEqual(status, 1)
+        self.assertTrue(lines[0]['error'].startswith('ValueError: Invalid record on line 2'))
+        self.assertEqual(lines[1], {'path': 'images/cli/horse_records.jpg'})
+
+
 if __name__ == '__main__':
     unittest.main()